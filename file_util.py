@@ -1,3 +1,4 @@
+import os
 from pathlib import Path
 from string import punctuation
 
@@ -79,6 +80,51 @@ def read_large_file(a_file, block_size=10000):
         yield block
 
 
+def file_shards(a_file, n_shards):
+    """Split a text file into byte ranges that start at line boundaries,
+    so that each range can be read by a different process
+    
+    Arguments:
+        a_file {str or Path} -- path to the file
+        n_shards {int} -- number of ranges (fewer are returned for small files)
+    
+    Returns:
+        [(int, int)] -- start and end byte offsets of each range
+    """
+    size = os.path.getsize(a_file)
+    bounds = [0]
+    with open(a_file, "rb") as f:
+        for i in range(1, n_shards):
+            offset = max(size * i // n_shards, bounds[-1])
+            if offset > 0:
+                # move to the first line that starts at or after offset
+                f.seek(offset - 1)
+                f.readline()
+                offset = f.tell()
+            bounds.append(min(offset, size))
+    bounds.append(size)
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+
+def read_file_shard(a_file, start, end):
+    """A generator of the lines (bytes, with line breaks) in a byte range from file_shards
+    
+    Arguments:
+        a_file {str or Path} -- path to the file
+        start {int} -- offset of the first line
+        end {int} -- offset after the last line
+    """
+    with open(a_file, "rb") as f:
+        f.seek(start)
+        offset = start
+        while offset < end:
+            line = f.readline()
+            if not line:
+                break
+            offset += len(line)
+            yield line
+
+
 def preprocess_string(s: str) -> "[tokens (str)]":
     """preporcessing str
 
@@ -109,12 +155,50 @@ def get_csv_files(DIR=global_options.PDF_PARSED_PATH):
     return list(parsed_csvs)
 
 
+def parsed_dataset_exists(DIR=global_options.PDF_PARSED_DATASET):
+    """whether the parsed transcripts are in a dataset (see read_parsed_dataset) instead of csv files"""
+    return DIR is not None and Path(DIR).exists()
+
+
+def read_parsed_dataset(DIR=global_options.PDF_PARSED_DATASET, columns=None):
+    """Read the parsed paragraphs from the dataset written by pdf2text.import_pdfs (one parquet
+    file per call date, in DIR/date_EST=<date>/). Requires pyarrow.
+
+    Keyword Arguments:
+        columns {[str]} -- columns to read (default: {None}, all: Title, ROUND, Paragraph, speaker, speaker_title, speaker_role, text)
+
+    Returns:
+        pd.DataFrame -- paragraphs ordered by call date, with a first column call_title_date (Title
+        and call date, the name of the csv file of the call) if Title is read. Empty strings are NaN,
+        as when the csv files are read.
+    """
+    import pyarrow.parquet as pq
+
+    frames = []
+    for partition in sorted(Path(DIR).glob("date_EST=*")):
+        date_EST = partition.name.split("=", 1)[1]
+        for parquet_f in sorted(partition.glob("*.parquet")):
+            a_df = pq.read_table(str(parquet_f), columns=columns).to_pandas()
+            if "Title" in a_df.columns:
+                a_df.insert(0, "call_title_date", a_df["Title"] + " " + date_EST)
+            frames.append(a_df)
+    if not frames:
+        return pd.DataFrame(columns=columns)
+    paragraphs = pd.concat(frames, axis=0, ignore_index=True)
+    for col in paragraphs.columns:
+        if not pd.api.types.is_numeric_dtype(paragraphs[col]):
+            paragraphs[col] = paragraphs[col].mask(paragraphs[col] == "")
+    return paragraphs
+
+
 def get_corpus(csv_files: "[Path]"):
-    """return corpus from parsed transcripts
+    """return corpus from parsed transcripts (from the parsed dataset if there is one)
 
     Returns:
         [str]: a list of paragraphs from all transcripts
     """
+    if parsed_dataset_exists():
+        return read_parsed_dataset(columns=["text"]).text.to_list()
     csv_files = get_csv_files()
     corpus_all = []
     for csv_f in tqdm(csv_files):
@@ -123,12 +207,19 @@ def get_corpus(csv_files: "[Path]"):
     return corpus_all
 
 
-def combine_all_csv(csv_files: "[Path]"):
+def combine_all_csv(csv_files: "[Path]" = None):
     """Combine all csv files in a list
     
+    Keyword Arguments:
+        csv_files {[Path]} -- csv files (default: {None}, all parsed transcripts, from the parsed dataset if there is one)
+
     Returns:
         [str]: a list of paragraphs from all transcripts
     """
+    if csv_files is None:
+        if parsed_dataset_exists():
+            return read_parsed_dataset().drop("call_title_date", axis=1)
+        csv_files = get_csv_files()
     csv_all = []
     for csv_f in tqdm(csv_files):
         a_df = pd.read_csv(str(csv_f), index_col=0)
@@ -144,3 +235,42 @@ def if_contains_words(doc_list, words_set) -> "[bool]":
     """
     n_words_in_doc = [len(set(x.split()).intersection(words_set)) for x in doc_list]
     return [x > 0 for x in n_words_in_doc]
+
+
+def paragraphs_contain_words(
+    words_set,
+    corpus_file=Path(
+        global_options.DATA_PATH, "text_corpra", "all_transcripts_parsed.csv.gz"
+    ),
+    index_path=Path(
+        global_options.DATA_PATH, "text_corpra", "paragraph_index", "paragraphs"
+    ),
+) -> "[bool]":
+    """check if each paragraph of the consolidated corpus contains any of the words in a set, as
+    if_contains_words on the text_parsed of the paragraphs in lower case. The postings of the
+    paragraph index (see generate_word_list.paragraph_index) are used if the index is built from
+    corpus_file, otherwise text_parsed is scanned.
+    Args:
+        words_set (set(str)): set of words (tokens or phrases)
+        corpus_file (str/path, optional): consolidated paragraphs. Defaults to DATA_PATH/text_corpra/all_transcripts_parsed.csv.gz.
+        index_path (str/path, optional): path of the index files without extension. Defaults to DATA_PATH/text_corpra/paragraph_index/paragraphs.
+    """
+    from generate_word_list import paragraph_index
+
+    if os.path.exists(str(index_path) + ".meta.json"):
+        index = paragraph_index.paragraph_index(index_path)
+        if index.is_built_from(corpus_file):
+            return index.contains_words(words_set).tolist()
+    words_set = {w.lower() for w in words_set}
+    contains = []
+    for transcripts in pd.read_csv(
+        corpus_file,
+        dtype=str,
+        keep_default_na=False,
+        usecols=["text_parsed"],
+        chunksize=100000,
+    ):
+        contains.extend(
+            if_contains_words(transcripts.text_parsed.str.lower(), words_set)
+        )
+    return contains
@@ -1,7 +1,14 @@
+import argparse
+import collections
 import datetime
 import functools
+import json
 import logging
+import os
+import shutil
+import struct
 import sys
+import zlib
 from pathlib import Path
 
 import file_util
@@ -9,13 +16,20 @@ import gensim
 import global_options
 
 from generate_word_list import parse
-from generate_word_list.nlp_process import nlp_models, preprocess
+from generate_word_list.nlp_process import (
+    corpus_counts,
+    nlp_models,
+    preprocess,
+    token_table,
+    vector_index,
+)
 
 logging.basicConfig(stream=sys.stdout, level=logging.DEBUG)
 
 
 def clean_file(in_file, out_file, lower_case=False, lemma_only=False):
-    """clean the entire corpus (output from CoreNLP)
+    """clean the entire corpus (output from CoreNLP), and write the document frequency of the
+    output next to it (see token_table.write_document_frequency)
 
     Arguments:
         in_file {str or Path} -- input corpus, each line is a sentence
@@ -34,6 +48,7 @@ def clean_file(in_file, out_file, lower_case=False, lemma_only=False):
             output_index_file=None,
             function_name=functools.partial(a_text_clearner.return_lemmas),
             chunk_size=200000,
+            streaming=True,
         )
     else:
         parse.process_largefile(
@@ -45,16 +60,22 @@ def clean_file(in_file, out_file, lower_case=False, lemma_only=False):
             output_index_file=None,
             function_name=functools.partial(a_text_clearner.clean),
             chunk_size=200000,
+            streaming=True,
         )
+    token_table.write_document_frequency(out_file)
 
 
-def remove_low_freq_compounds_line(line, id, word_freq_dict):
-    """Remove phrases with freq fewer than threshold"""
+def remove_low_freq_compounds_line(line, id, word_freq):
+    """Remove phrases with freq fewer than threshold
+
+    Arguments:
+        word_freq {mapping} -- document frequency of the phrases, looked up with word_freq.get(phrase), e.g. a token_table
+    """
     tokens = line.strip().split(" ")
     filtered_tokens = []
     for t in tokens:
         if "_" in t:
-            freq = word_freq_dict.dfs.get(word_freq_dict.token2id.get(t))
+            freq = word_freq.get(t)
             if freq is not None:
                 if freq >= global_options.PHRASE_MIN_COUNT:
                     filtered_tokens.append(t)
@@ -67,9 +88,19 @@ def remove_low_freq_compounds_line(line, id, word_freq_dict):
 
 
 def remove_low_freq_compounds_file(in_file, out_file):
-    """Remove phrases with freq fewer than threshold"""
-    word_dict = gensim.corpora.dictionary.Dictionary(
-        documents=gensim.models.word2vec.LineSentence(in_file), prune_at=20000000
+    """Remove phrases with freq fewer than threshold
+
+    The document frequency of the phrases is taken from the table written with in_file (see
+    clean_file) and saved as a token_table (phrase_dfs.* next to in_file), which the workers
+    memory-map instead of receiving a copy.
+    """
+    phrase_dfs = token_table.build_token_table(
+        Path(in_file).parent / "phrase_dfs",
+        {
+            t: df
+            for t, df in token_table.load_document_frequency(in_file).items()
+            if "_" in t
+        },
     )
     parse.process_largefile(
         input_file=in_file,
@@ -79,138 +110,577 @@ def remove_low_freq_compounds_file(in_file, out_file):
         ],  # fake IDs (do not need IDs for this function).
         output_index_file=None,
         function_name=functools.partial(
-            remove_low_freq_compounds_line, word_freq_dict=word_dict
+            remove_low_freq_compounds_line, word_freq=phrase_dfs
         ),
         chunk_size=200000,
+        streaming=True,
     )
+    token_table.write_document_frequency(out_file)
 
 
-if __name__ == "__main__":
-    Path(global_options.DATA_PATH, "text_corpra", "processed", "unigram").mkdir(
-        parents=True, exist_ok=True
+# ==== streaming pipeline ====
+# Intermediate corpora are kept as spill files of zlib-compressed blocks of lines
+# (each block: length prefix + "\n".join(lines)), which are written and read only by this module.
+SPILL_PREFIX = struct.Struct("<I")
+SPILL_BLOCK_SIZE = 10000  # number of lines in a block
+
+
+def _pack_lines(lines):
+    return zlib.compress("\n".join(lines).encode("utf-8"), 1)
+
+
+def _unpack_lines(blob):
+    return zlib.decompress(blob).decode("utf-8").split("\n")
+
+
+def _write_block(f, blob):
+    f.write(SPILL_PREFIX.pack(len(blob)))
+    f.write(blob)
+
+
+def _read_spill(spill_file):
+    """Yield the blocks of a spill file"""
+    with open(spill_file, "rb") as f:
+        while True:
+            prefix = f.read(SPILL_PREFIX.size)
+            if not prefix:
+                return
+            yield f.read(SPILL_PREFIX.unpack(prefix)[0])
+
+
+def _lemma_block(lines, cleaner):
+    """Lemmatize a block of parsed lines and count the document frequency of its phrases
+    the way Dictionary(LineSentence(lemma_file)) does in remove_low_freq_compounds_file"""
+    lemma_lines = cleaner.return_lemmas_lines(lines)
+    return _pack_lines(lemma_lines), token_table.count_lines_document_frequency(
+        lemma_lines, phrases_only=True
     )
-    Path(global_options.DATA_PATH, "text_corpra", "processed", "bigram").mkdir(
-        parents=True, exist_ok=True
+
+
+def _filter_clean_block(blob, cleaner, phrase_dfs, common_terms, delimiter):
+    """Remove low frequency phrases from a block of lemmas, then clean it and count its
+    phrase candidates (see nlp_models.count_phrase_vocab)"""
+    lines = cleaner.clean_lines(
+        [
+            remove_low_freq_compounds_line(line, None, phrase_dfs)[0]
+            for line in _unpack_lines(blob)
+        ]
     )
-    Path(global_options.DATA_PATH, "text_corpra", "processed", "trigram").mkdir(
-        parents=True, exist_ok=True
+    return (_pack_lines(lines),) + nlp_models.count_phrase_vocab(
+        nlp_models.line_sentences(lines), common_terms, delimiter
     )
 
-    # get lemmas
-    clean_file(
-        in_file=Path(
-            global_options.DATA_PATH, "text_corpra", "parsed", "documents.txt"
-        ),
-        out_file=Path(
-            global_options.DATA_PATH,
-            "text_corpra",
-            "processed",
-            "unigram",
-            "documents_lemmas.txt",
-        ),
-        lemma_only=True,
+
+def _phrase_block(blob, bigram_phraser):
+    """Apply a phrase model to a block of lines (see nlp_models.file_bigramer) and count the
+    document frequency of the output"""
+    text = nlp_models.bigram_transform_lines(_unpack_lines(blob), bigram_phraser)
+    return text, token_table.count_lines_document_frequency(text.split("\n"))
+
+
+def _phrase_count_block(blob, bigram_phraser, common_terms, delimiter):
+    """Apply a phrase model to a block of lines and count the phrase candidates of the output"""
+    lines = [
+        nlp_models.bigram_transform(line, bigram_phraser)
+        for line in _unpack_lines(blob)
+    ]
+    return (_pack_lines(lines),) + nlp_models.count_phrase_vocab(
+        nlp_models.line_sentences(lines), common_terms, delimiter
     )
 
-    # remove low freq phrases
-    remove_low_freq_compounds_file(
-        in_file=Path(
-            global_options.DATA_PATH,
-            "text_corpra",
-            "processed",
-            "unigram",
-            "documents_lemmas.txt",
-        ),
-        out_file=Path(
-            global_options.DATA_PATH,
-            "text_corpra",
-            "processed",
-            "unigram",
-            "documents_temp.txt",
-        ),
+
+def _imap_blocks(function_name, blocks):
+    return parse.imap_streaming(
+        function_name, ((block,) for block in blocks), global_options.N_CORES * 4
     )
 
-    # trainsform to lower case
-    clean_file(
-        in_file=Path(
-            global_options.DATA_PATH,
-            "text_corpra",
-            "processed",
-            "unigram",
-            "documents_temp.txt",
-        ),
-        out_file=Path(
-            global_options.DATA_PATH,
-            "text_corpra",
-            "processed",
-            "unigram",
-            "documents_clean_phrases.txt",
-        ),
-        lower_case=True,
+
+def _phrase_model(model_path, update):
+    if update:
+        return gensim.models.phrases.Phrases.load(str(model_path))
+    return nlp_models.new_phrase_model()
+
+
+def streaming_pipeline(
+    in_file,
+    out_file,
+    bigram_model_path,
+    trigram_model_path,
+    spill_dir,
+    update=False,
+    save_dir=None,
+):
+    """Lemmatize, remove low frequency phrases, clean, and learn and apply the bigram and trigram
+    models in one read of the parsed corpus. Gives the same output and phrase models as the file
+    stages in __main__ (clean_file, remove_low_freq_compounds_file, clean_file, train_bigram_model
+    and file_bigramer twice).
+
+    Stages are chained as generators over blocks of lines. A corpus is materialized only where a
+    global statistic is needed before the corpus can be transformed (phrase frequencies, and each
+    phrase model), as a compressed spill file in spill_dir that is removed once it is consumed.
+    Phrase candidates are counted by the workers with each block and merged into the phrase
+    models (see nlp_models.count_phrase_vocab), and so is the document frequency of the output,
+    written next to out_file (see token_table.write_document_frequency).
+
+    With update=True, in_file is a batch of new documents: its counts are added to the saved
+    phrase frequencies and phrase models (as if they had been trained on both corpora), and
+    out_file only has the new documents. Earlier output is not re-phrased with the updated models.
+
+    Arguments:
+        in_file {str or Path} -- parsed corpus (output from CoreNLP), each line is a sentence
+        out_file {str or Path} -- output corpus with 2- and 3-word phrases
+        bigram_model_path {str or Path} -- where to save the bigram model
+        trigram_model_path {str or Path} -- where to save the trigram model
+        spill_dir {str or Path} -- directory of the temporary spill files and the phrase_dfs token_table
+
+    Keyword Arguments:
+        update {bool} -- update the saved phrase frequencies and models instead of starting from scratch (default: {False})
+        save_dir {str or Path} -- save the phrase frequencies and models in this directory (with the same file names) instead of in place, e.g. to replace the saved ones only once an update finishes (default: {None})
+    """
+    lemma_spill = Path(spill_dir, "documents_lemmas.spill")
+    clean_spill = Path(spill_dir, "documents_clean_phrases.spill")
+    bigram_spill = Path(spill_dir, "documents_bigram.spill")
+    Path(out_file).parent.mkdir(parents=True, exist_ok=True)
+    Path(bigram_model_path).parent.mkdir(parents=True, exist_ok=True)
+    Path(trigram_model_path).parent.mkdir(parents=True, exist_ok=True)
+    phrase_dfs_path = Path(spill_dir, "phrase_dfs")
+    bigram_save_path, trigram_save_path = bigram_model_path, trigram_model_path
+    if save_dir is not None:
+        phrase_dfs_path = Path(save_dir, "phrase_dfs")
+        bigram_save_path = Path(save_dir, Path(bigram_model_path).name)
+        trigram_save_path = Path(save_dir, Path(trigram_model_path).name)
+
+    # lemmas + phrase frequencies
+    print(datetime.datetime.now())
+    print("Lemmatizing...")
+    phrase_dfs = collections.Counter()
+    if update:
+        phrase_dfs.update(
+            dict(token_table.token_table(Path(spill_dir, "phrase_dfs")).items())
+        )
+    with open(lemma_spill, "wb") as f:
+        for blob, block_dfs in _imap_blocks(
+            functools.partial(_lemma_block, cleaner=preprocess.text_cleaner()),
+            file_util.read_large_file(in_file, block_size=SPILL_BLOCK_SIZE),
+        ):
+            _write_block(f, blob)
+            phrase_dfs.update(block_dfs)
+    phrase_dfs = token_table.build_token_table(phrase_dfs_path, phrase_dfs)
+
+    # remove low freq phrases, transform to lower case, and learn the bigram model
+    print(datetime.datetime.now())
+    print("Cleaning and training phraser...")
+    bigram_model = _phrase_model(bigram_model_path, update)
+    with open(clean_spill, "wb") as f:
+        for blob, vocab, total_words in _imap_blocks(
+            functools.partial(
+                _filter_clean_block,
+                cleaner=preprocess.text_cleaner(lower_case=True),
+                phrase_dfs=phrase_dfs,
+                common_terms=bigram_model.common_terms,
+                delimiter=bigram_model.delimiter,
+            ),
+            _read_spill(lemma_spill),
+        ):
+            _write_block(f, blob)
+            nlp_models.merge_phrase_vocab(bigram_model, vocab, total_words)
+    os.remove(lemma_spill)
+    bigram_model.save(str(bigram_save_path))
+
+    # apply the bigram model and learn the trigram model
+    print(datetime.datetime.now())
+    print("Applying bigram model and training phraser...")
+    bigram_phraser = nlp_models.frozen_phrases(
+        nlp_models.set_phrase_scoring(
+            bigram_model, global_options.PHRASE_THRESHOLD, "original_scorer"
+        )
     )
+    del bigram_model
+    trigram_model = _phrase_model(trigram_model_path, update)
+    with open(bigram_spill, "wb") as f:
+        for blob, vocab, total_words in _imap_blocks(
+            functools.partial(
+                _phrase_count_block,
+                bigram_phraser=bigram_phraser,
+                common_terms=trigram_model.common_terms,
+                delimiter=trigram_model.delimiter,
+            ),
+            _read_spill(clean_spill),
+        ):
+            _write_block(f, blob)
+            nlp_models.merge_phrase_vocab(trigram_model, vocab, total_words)
+    os.remove(clean_spill)
+    del bigram_phraser
+    trigram_model.save(str(trigram_save_path))
 
-    # train and apply a phrase model to detect 2-word phrases ----------------
-    nlp_models.train_bigram_model(
-        input_path=Path(
-            global_options.DATA_PATH,
-            "text_corpra",
-            "processed",
-            "unigram",
-            "documents_clean_phrases.txt",
-        ),
-        model_path=Path(global_options.MODEL_PATH, "bigram.mod"),
+    # apply the trigram model
+    print(datetime.datetime.now())
+    print("Applying trigram model...")
+    trigram_phraser = nlp_models.frozen_phrases(
+        nlp_models.set_phrase_scoring(
+            trigram_model, global_options.PHRASE_THRESHOLD, "original_scorer"
+        )
     )
-    nlp_models.file_bigramer(
-        input_path=Path(
-            global_options.DATA_PATH,
-            "text_corpra",
-            "processed",
-            "unigram",
-            "documents_clean_phrases.txt",
-        ),
-        output_path=Path(
+    del trigram_model
+    dfs = collections.Counter()
+    with open(out_file, "w") as f:
+        for text, block_dfs in _imap_blocks(
+            functools.partial(_phrase_block, bigram_phraser=trigram_phraser),
+            _read_spill(bigram_spill),
+        ):
+            f.write(text)
+            dfs.update(block_dfs)
+    os.remove(bigram_spill)
+    token_table.write_document_frequency(out_file, dfs)
+
+
+def _input_record(in_file, out_file):
+    in_stat = os.stat(str(in_file))
+    return {
+        "input_file": str(in_file),
+        "input_size": in_stat.st_size,
+        "input_mtime_ns": in_stat.st_mtime_ns,
+        "output_file": str(out_file),
+        "absorbed_at": datetime.datetime.now().isoformat(),
+    }
+
+
+def read_absorbed_inputs(manifest_file):
+    """Return the records of the parsed corpora the models were trained on (see incremental_update)"""
+    try:
+        with open(manifest_file) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+def write_absorbed_inputs(manifest_file, records):
+    with open(str(manifest_file) + ".tmp", "w") as f:
+        json.dump(records, f, indent=2)
+    os.replace(str(manifest_file) + ".tmp", str(manifest_file))
+
+
+def _commit_staged(staging_dir, manifest_file, absorbed):
+    """Move the files staged for an absorbed corpus in place and record the corpus in
+    manifest_file, as listed in staging_dir/commit.json (see incremental_update). Running it
+    again after an interruption finishes the commit.
+
+    Returns:
+        [dict] -- the records of the absorbed corpora
+    """
+    with open(Path(staging_dir, "commit.json")) as f:
+        commit = json.load(f)
+    # a meta file marks a complete table: the old one is removed before the table is replaced
+    for staged_file, target_file in commit["moves"]:
+        if (
+            target_file.endswith(".meta.json")
+            and os.path.exists(staged_file)
+            and os.path.exists(target_file)
+        ):
+            os.remove(target_file)
+    for staged_file, target_file in commit["moves"]:
+        if os.path.exists(staged_file):
+            os.replace(staged_file, target_file)
+    if commit["record"] not in absorbed:
+        absorbed = absorbed + [commit["record"]]
+        write_absorbed_inputs(manifest_file, absorbed)
+    shutil.rmtree(staging_dir)
+    return absorbed
+
+
+def incremental_update(in_files, manifest_file):
+    """Update the phrase frequencies, the phrase models and the word2vec model with new parsed
+    corpora (output of generate_word_list.parse for new documents), instead of training on
+    the full history again (see streaming_pipeline with update=True).
+
+    Each file is recorded in manifest_file once it is absorbed, and files in the manifest
+    (same path, size and modification time) are skipped. The output of each file (cleaned,
+    with phrases) is written to processed/trigram/increments/, and its document frequency is
+    added to the table of processed/trigram/documents.txt (see
+    token_table.add_document_frequency).
+
+    The updated phrase frequencies, document frequencies and models are written to a staging
+    directory next to manifest_file, and replace the saved ones only once all stages finish:
+    the moves are listed in a commit file first, then done, then the file is recorded in
+    manifest_file (see
+    _commit_staged). A run interrupted before the commit file is written leaves the saved
+    frequencies and models as they were, so the file is absorbed again from the start; a run
+    interrupted after it is finished by the next run.
+
+    Arguments:
+        in_files {[str or Path]} -- new parsed corpora, each line is a sentence
+        manifest_file {str or Path} -- json list of the absorbed corpora
+    """
+    spill_dir = Path(global_options.DATA_PATH, "text_corpra", "processed", "unigram")
+    main_corpus = Path(
+        global_options.DATA_PATH, "text_corpra", "processed", "trigram", "documents.txt"
+    )
+    staging_dir = Path(str(manifest_file) + ".staging")
+    absorbed = read_absorbed_inputs(manifest_file)
+    if Path(staging_dir, "commit.json").exists():
+        print("Finishing the update of an interrupted run.")
+        absorbed = _commit_staged(staging_dir, manifest_file, absorbed)
+    for in_file in in_files:
+        record = _input_record(in_file, None)
+        if any(
+            r["input_file"] == record["input_file"]
+            and r["input_size"] == record["input_size"]
+            and r["input_mtime_ns"] == record["input_mtime_ns"]
+            for r in absorbed
+        ):
+            print(f"{in_file} has been absorbed, skipping.")
+            continue
+        out_file = Path(
             global_options.DATA_PATH,
             "text_corpra",
             "processed",
-            "bigram",
-            "documents.txt",
-        ),
-        model_path=Path(global_options.MODEL_PATH, "bigram.mod"),
-        scoring="original_scorer",
-        threshold=global_options.PHRASE_THRESHOLD,
+            "trigram",
+            "increments",
+            "documents_{:04d}.txt".format(len(absorbed)),
+        )
+        print(datetime.datetime.now())
+        print(f"Absorbing {in_file}...")
+        # files of an interrupted run that was not committed
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        staging_dir.mkdir(parents=True)
+        streaming_pipeline(
+            in_file=in_file,
+            out_file=out_file,
+            bigram_model_path=Path(global_options.MODEL_PATH, "bigram.mod"),
+            trigram_model_path=Path(global_options.MODEL_PATH, "trigram.mod"),
+            spill_dir=spill_dir,
+            update=True,
+            save_dir=staging_dir,
+        )
+        print(datetime.datetime.now())
+        print("Updating w2v model...")
+        nlp_models.update_w2v_model(
+            input_path=out_file,
+            model_path=Path(global_options.MODEL_PATH, "w2v.mod"),
+            corpus=corpus_counts.build_corpus_counts(
+                out_file, out_file.with_suffix("")
+            ),
+            out_path=Path(staging_dir, "w2v.mod"),
+        )
+        # the document frequency of the main corpus counts the new documents too (for the
+        # n_sentence of word_list)
+        token_table.add_document_frequency(
+            main_corpus, out_file, path=Path(staging_dir, main_corpus.stem + ".dfs")
+        )
+        record["output_file"] = str(out_file)
+        moves = [
+            (
+                str(staged_file),
+                str(
+                    Path(
+                        spill_dir
+                        if staged_file.name.startswith("phrase_dfs.")
+                        else main_corpus.parent
+                        if staged_file.name.startswith(main_corpus.stem + ".dfs.")
+                        else global_options.MODEL_PATH,
+                        staged_file.name,
+                    )
+                ),
+            )
+            # meta files last: they mark a complete table
+            for staged_file in sorted(
+                staging_dir.iterdir(),
+                key=lambda f: (f.name.endswith(".meta.json"), f.name),
+            )
+        ]
+        with open(Path(staging_dir, "commit.json.tmp"), "w") as f:
+            json.dump({"moves": moves, "record": record}, f, indent=2)
+        os.replace(
+            str(Path(staging_dir, "commit.json.tmp")),
+            str(Path(staging_dir, "commit.json")),
+        )
+        absorbed = _commit_staged(staging_dir, manifest_file, absorbed)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Clean the parsed corpus, identify phrases, and train a word2vec model."
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="run the cleaning and phrase stages as one streaming pipeline, without writing the intermediate corpora",
     )
+    parser.add_argument(
+        "--incremental",
+        nargs="+",
+        metavar="PARSED_FILE",
+        help="update the trained phrase and w2v models with new parsed documents (output of generate_word_list.parse) instead of training from scratch",
+    )
+    args = parser.parse_args()
+    absorbed_inputs_file = Path(global_options.MODEL_PATH, "absorbed_inputs.json")
 
-    # train and apply a phrase model to detect 3-word phrases ----------------
-    nlp_models.train_bigram_model(
-        input_path=Path(
-            global_options.DATA_PATH,
-            "text_corpra",
-            "processed",
-            "bigram",
-            "documents.txt",
-        ),
-        model_path=Path(global_options.MODEL_PATH, "trigram.mod"),
+    if args.incremental:
+        incremental_update(args.incremental, absorbed_inputs_file)
+        sys.exit(0)
+
+    Path(global_options.DATA_PATH, "text_corpra", "processed", "unigram").mkdir(
+        parents=True, exist_ok=True
     )
-    nlp_models.file_bigramer(
-        input_path=Path(
-            global_options.DATA_PATH,
-            "text_corpra",
-            "processed",
-            "bigram",
-            "documents.txt",
-        ),
-        output_path=Path(
+    Path(global_options.DATA_PATH, "text_corpra", "processed", "bigram").mkdir(
+        parents=True, exist_ok=True
+    )
+    Path(global_options.DATA_PATH, "text_corpra", "processed", "trigram").mkdir(
+        parents=True, exist_ok=True
+    )
+
+    if args.streaming:
+        streaming_pipeline(
+            in_file=Path(
+                global_options.DATA_PATH, "text_corpra", "parsed", "documents.txt"
+            ),
+            out_file=Path(
+                global_options.DATA_PATH,
+                "text_corpra",
+                "processed",
+                "trigram",
+                "documents.txt",
+            ),
+            bigram_model_path=Path(global_options.MODEL_PATH, "bigram.mod"),
+            trigram_model_path=Path(global_options.MODEL_PATH, "trigram.mod"),
+            spill_dir=Path(
+                global_options.DATA_PATH, "text_corpra", "processed", "unigram"
+            ),
+        )
+    else:
+        # get lemmas
+        clean_file(
+            in_file=Path(
+                global_options.DATA_PATH, "text_corpra", "parsed", "documents.txt"
+            ),
+            out_file=Path(
+                global_options.DATA_PATH,
+                "text_corpra",
+                "processed",
+                "unigram",
+                "documents_lemmas.txt",
+            ),
+            lemma_only=True,
+        )
+
+        # remove low freq phrases
+        remove_low_freq_compounds_file(
+            in_file=Path(
+                global_options.DATA_PATH,
+                "text_corpra",
+                "processed",
+                "unigram",
+                "documents_lemmas.txt",
+            ),
+            out_file=Path(
+                global_options.DATA_PATH,
+                "text_corpra",
+                "processed",
+                "unigram",
+                "documents_temp.txt",
+            ),
+        )
+
+        # trainsform to lower case
+        clean_file(
+            in_file=Path(
+                global_options.DATA_PATH,
+                "text_corpra",
+                "processed",
+                "unigram",
+                "documents_temp.txt",
+            ),
+            out_file=Path(
+                global_options.DATA_PATH,
+                "text_corpra",
+                "processed",
+                "unigram",
+                "documents_clean_phrases.txt",
+            ),
+            lower_case=True,
+        )
+
+        # train and apply a phrase model to detect 2-word phrases ----------------
+        nlp_models.train_bigram_model(
+            input_path=Path(
+                global_options.DATA_PATH,
+                "text_corpra",
+                "processed",
+                "unigram",
+                "documents_clean_phrases.txt",
+            ),
+            model_path=Path(global_options.MODEL_PATH, "bigram.mod"),
+            sharded=True,
+            max_vocab_size=global_options.PHRASE_SPILL_VOCAB_SIZE,
+        )
+        nlp_models.file_bigramer(
+            input_path=Path(
+                global_options.DATA_PATH,
+                "text_corpra",
+                "processed",
+                "unigram",
+                "documents_clean_phrases.txt",
+            ),
+            output_path=Path(
+                global_options.DATA_PATH,
+                "text_corpra",
+                "processed",
+                "bigram",
+                "documents.txt",
+            ),
+            model_path=Path(global_options.MODEL_PATH, "bigram.mod"),
+            scoring="original_scorer",
+            threshold=global_options.PHRASE_THRESHOLD,
+        )
+
+        # train and apply a phrase model to detect 3-word phrases ----------------
+        nlp_models.train_bigram_model(
+            input_path=Path(
+                global_options.DATA_PATH,
+                "text_corpra",
+                "processed",
+                "bigram",
+                "documents.txt",
+            ),
+            model_path=Path(global_options.MODEL_PATH, "trigram.mod"),
+            sharded=True,
+            max_vocab_size=global_options.PHRASE_SPILL_VOCAB_SIZE,
+        )
+        nlp_models.file_bigramer(
+            input_path=Path(
+                global_options.DATA_PATH,
+                "text_corpra",
+                "processed",
+                "bigram",
+                "documents.txt",
+            ),
+            output_path=Path(
+                global_options.DATA_PATH,
+                "text_corpra",
+                "processed",
+                "trigram",
+                "documents.txt",
+            ),
+            model_path=Path(global_options.MODEL_PATH, "trigram.mod"),
+            scoring="original_scorer",
+            threshold=global_options.PHRASE_THRESHOLD,
+        )
+
+    # train a word2vec model ----------------
+    print(datetime.datetime.now())
+    print("Counting the tokens of the corpus...")
+    trigram_corpus = corpus_counts.build_corpus_counts(
+        in_file=Path(
             global_options.DATA_PATH,
             "text_corpra",
             "processed",
             "trigram",
             "documents.txt",
         ),
-        model_path=Path(global_options.MODEL_PATH, "trigram.mod"),
-        scoring="original_scorer",
-        threshold=global_options.PHRASE_THRESHOLD,
+        path=Path(
+            global_options.DATA_PATH, "text_corpra", "processed", "trigram", "documents"
+        ),
     )
-
-    # train a word2vec model ----------------
     print(datetime.datetime.now())
     print("Training w2v model...")
     nlp_models.train_w2v_model(
@@ -222,8 +692,29 @@ if __name__ == "__main__":
             "documents.txt",
         ),
         model_path=Path(global_options.MODEL_PATH, "w2v.mod"),
+        corpus=trigram_corpus,
         size=global_options.W2V_DIM,
         window=global_options.W2V_WINDOW,
         workers=global_options.N_CORES,
         iter=global_options.W2V_ITER,
     )
+    print(datetime.datetime.now())
+    print("Building the w2v vector index...")
+    vector_index.build_vector_index(Path(global_options.MODEL_PATH, "w2v.mod"))
+    write_absorbed_inputs(
+        absorbed_inputs_file,
+        [
+            _input_record(
+                Path(
+                    global_options.DATA_PATH, "text_corpra", "parsed", "documents.txt"
+                ),
+                Path(
+                    global_options.DATA_PATH,
+                    "text_corpra",
+                    "processed",
+                    "trigram",
+                    "documents.txt",
+                ),
+            )
+        ],
+    )
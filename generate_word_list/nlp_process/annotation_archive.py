@@ -0,0 +1,146 @@
+"""compressed archive of raw CoreNLP annotations (protobuf Documents), one record per paragraph
+"""
+import mmap
+import os
+import struct
+import threading
+import zlib
+
+from stanfordnlp.protobuf import Document
+
+from generate_word_list.nlp_process.annotation_cache import paragraph_key
+
+# index record: paragraph_key, offset of the compressed Document, its length
+INDEX_RECORD = struct.Struct("<20sQI")
+LENGTH_PREFIX = struct.Struct("<I")
+
+
+class annotation_archive(object):
+    """An append-only archive of annotated paragraphs
+
+    Files:
+        {path}.bin -- length-prefixed, zlib-compressed serialized Documents
+        {path}.idx -- fixed-size index records (see INDEX_RECORD) for random access by paragraph_key
+
+    Paragraphs are stored once, keyed by the hash of their text (see annotation_cache). Records
+    should be added from a single process (threads are fine). The archive is pickled by path, so
+    worker processes reopen it read-only.
+    """
+
+    def __init__(self, path):
+        """
+        Arguments:
+            path {str or Path} -- path of the archive files without extension
+        """
+        self.path = str(path)
+        self.data_file = self.path + ".bin"
+        self.index_file = self.path + ".idx"
+        self.index = {}
+        self._lock = threading.Lock()
+        self._f_data = None
+        self._f_index = None
+        self._mmap = None
+        self._load_index()
+
+    def _load_index(self):
+        """Read the index, ignoring records that point past the end of the data file"""
+        if not os.path.exists(self.index_file) or not os.path.exists(self.data_file):
+            return
+        data_size = os.path.getsize(self.data_file)
+        with open(self.index_file, "rb") as f:
+            index_bytes = f.read()
+        n_records = len(index_bytes) // INDEX_RECORD.size
+        for key, offset, length in INDEX_RECORD.iter_unpack(
+            index_bytes[: n_records * INDEX_RECORD.size]
+        ):
+            if offset + length <= data_size:
+                self.index[key] = (offset, length)
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, doc):
+        return paragraph_key(doc) in self.index
+
+    def put(self, doc, doc_ann):
+        """Add the annotation of a paragraph (skipped if the paragraph is already archived)
+
+        Arguments:
+            doc {str} -- raw string of the paragraph
+            doc_ann {CoreNLP_pb2.Document} -- annotation of the paragraph
+        """
+        key = paragraph_key(doc)
+        if key in self.index:
+            return
+        blob = zlib.compress(doc_ann.SerializeToString(), 3)
+        with self._lock:
+            if key in self.index:
+                return
+            if self._f_data is None:
+                self._f_data = open(self.data_file, "ab")
+                self._f_index = open(self.index_file, "ab")
+            offset = self._f_data.tell() + LENGTH_PREFIX.size
+            self._f_data.write(LENGTH_PREFIX.pack(len(blob)) + blob)
+            self._f_index.write(INDEX_RECORD.pack(key, offset, len(blob)))
+            self.index[key] = (offset, len(blob))
+
+    def get(self, doc):
+        """Return the archived annotation of a paragraph
+
+        Arguments:
+            doc {str} -- raw string of the paragraph
+
+        Returns:
+            CoreNLP_pb2.Document -- the annotation, None if the paragraph is not archived
+        """
+        location = self.index.get(paragraph_key(doc))
+        if location is None:
+            return None
+        offset, length = location
+        if self._mmap is None:
+            self.flush()
+            with open(self.data_file, "rb") as f:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        elif offset + length > len(self._mmap):
+            # written after the file was mapped
+            self._mmap.close()
+            self._mmap = None
+            return self.get(doc)
+        doc_ann = Document()
+        doc_ann.ParseFromString(zlib.decompress(self._mmap[offset : offset + length]))
+        return doc_ann
+
+    def flush(self):
+        with self._lock:
+            if self._f_data is not None:
+                # data before index, so that the index never points past the data
+                self._f_data.flush()
+                self._f_index.flush()
+
+    def sync(self):
+        """Flush the archive and make it durable (e.g. before a checkpoint records the paragraphs
+        as processed)"""
+        with self._lock:
+            if self._f_data is not None:
+                # data before index, so that the index never points past the data
+                self._f_data.flush()
+                os.fsync(self._f_data.fileno())
+                self._f_index.flush()
+                os.fsync(self._f_index.fileno())
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            if self._f_data is not None:
+                self._f_data.close()
+                self._f_index.close()
+                self._f_data, self._f_index = None, None
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
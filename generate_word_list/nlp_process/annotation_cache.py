@@ -0,0 +1,166 @@
+"""persistent cache of processed CoreNLP annotations, keyed by a hash of the paragraph text
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+
+
+def paragraph_key(doc):
+    """Return the cache key of a document: SHA-1 of its text without surrounding newlines
+
+    Arguments:
+        doc {str} -- raw string of a document
+
+    Returns:
+        bytes -- 20-byte digest
+    """
+    return hashlib.sha1(doc.strip("\n").encode("utf-8")).digest()
+
+
+def fingerprint(*settings):
+    """Return a fingerprint of the settings that produce the cached annotations (e.g. the CoreNLP
+    properties and the source of the preprocess rules)
+
+    Arguments:
+        *settings -- json-serializable values
+
+    Returns:
+        str -- SHA-1 (hex) of the settings
+    """
+    return hashlib.sha1(
+        json.dumps(settings, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+class annotation_cache(object):
+    """An on-disk (sqlite) map from paragraph_key to the processed sentences of the paragraph,
+    i.e. the first output of preprocessor.process_document.
+
+    The cache can be shared by threads; each process opens its own connection.
+    """
+
+    def __init__(self, cache_path, fingerprint=None):
+        """
+        Arguments:
+            cache_path {str or Path} -- sqlite database of the cache
+
+        Keyword Arguments:
+            fingerprint {str} -- fingerprint of the settings of the annotations (see fingerprint).
+                The cache is cleared when it differs from the fingerprint stored in the database
+                (default: {None}, not checked)
+        """
+        self.cache_path = str(cache_path)
+        self.fingerprint = fingerprint
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+
+    def _connection(self):
+        if self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.cache_path, check_same_thread=False)
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS annotations "
+                "(key BLOB PRIMARY KEY, n_sentences INTEGER, sentences TEXT)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS settings (name TEXT PRIMARY KEY, value TEXT)"
+            )
+            self._conn.commit()
+            if self.fingerprint is not None:
+                self._check_fingerprint()
+            self._pid = os.getpid()
+        return self._conn
+
+    def _check_fingerprint(self):
+        """Clear the cache if it was filled with other settings"""
+        conn = self._conn
+        # one writer at a time, so that the cache is cleared once
+        conn.execute("BEGIN IMMEDIATE")
+        row = conn.execute(
+            "SELECT value FROM settings WHERE name = 'fingerprint'"
+        ).fetchone()
+        if row is None or row[0] != self.fingerprint:
+            n_cleared = conn.execute("DELETE FROM annotations").rowcount
+            conn.execute(
+                "INSERT OR REPLACE INTO settings (name, value) VALUES ('fingerprint', ?)",
+                (self.fingerprint,),
+            )
+            if n_cleared > 0:
+                print(
+                    "Annotation cache: the preprocess rules or CoreNLP settings changed, "
+                    "{} cached paragraphs cleared.".format(n_cleared)
+                )
+        conn.commit()
+
+    def get_many(self, docs):
+        """Look up a list of documents
+
+        Arguments:
+            docs {[str]} -- raw strings of the documents
+
+        Returns:
+            [[str] or None] -- processed sentences of each document, None if not cached
+        """
+        keys = [paragraph_key(doc) for doc in docs]
+        found = {}
+        with self._lock:
+            conn = self._connection()
+            unique_keys = list(set(keys))
+            # stay under sqlite's limit on the number of query parameters
+            for i in range(0, len(unique_keys), 500):
+                key_block = unique_keys[i : i + 500]
+                rows = conn.execute(
+                    "SELECT key, n_sentences, sentences FROM annotations WHERE key IN ({})".format(
+                        ",".join("?" * len(key_block))
+                    ),
+                    key_block,
+                )
+                for key, n_sentences, sentences in rows:
+                    found[key] = sentences.split("\n") if n_sentences > 0 else []
+            results = [found.get(key) for key in keys]
+            n_hits = sum(1 for r in results if r is not None)
+            self.hits += n_hits
+            self.misses += len(results) - n_hits
+        return results
+
+    def put_many(self, docs, sentences_processed):
+        """Store the processed sentences of a list of documents
+
+        Arguments:
+            docs {[str]} -- raw strings of the documents
+            sentences_processed {[[str]]} -- processed sentences of each document
+        """
+        rows = [
+            (paragraph_key(doc), len(sentences), "\n".join(sentences))
+            for doc, sentences in zip(docs, sentences_processed)
+        ]
+        with self._lock:
+            conn = self._connection()
+            conn.executemany(
+                "INSERT OR IGNORE INTO annotations (key, n_sentences, sentences) VALUES (?, ?, ?)",
+                rows,
+            )
+            conn.commit()
+
+    def stats(self):
+        """Return lookup statistics of this process
+
+        Returns:
+            {str: number} -- hits, misses and hit_rate
+        """
+        n_lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / n_lookups if n_lookups > 0 else 0.0,
+        }
+
+    def report(self):
+        stats = self.stats()
+        return "Annotation cache: {} hits, {} misses, hit rate {:.1%}".format(
+            stats["hits"], stats["misses"], stats["hit_rate"]
+        )
@@ -0,0 +1,90 @@
+"""several local CoreNLP servers used through the CoreNLPClient.annotate interface
+"""
+import threading
+
+from stanfordnlp.server import CoreNLPClient
+
+
+class corenlp_pool(object):
+    """Start n_servers CoreNLP servers on consecutive ports and send each request to the server
+    with the fewest outstanding requests.
+
+    If a request fails because its server died (e.g. JVM out of memory), the server is restarted
+    and the request is retried. Failures on a live server (e.g. a bad document) are raised as usual.
+    The pool can replace a CoreNLPClient, e.g. in preprocess.preprocessor.
+    """
+
+    def __init__(self, n_servers, base_port=9000, max_retries=3, **client_kwargs):
+        """
+        Arguments:
+            n_servers {int} -- number of CoreNLP servers
+
+        Keyword Arguments:
+            base_port {int} -- port of the first server, the others use the next ports (default: {9000})
+            max_retries {int} -- number of retries of a request after its server died (default: {3})
+            client_kwargs -- passed to each CoreNLPClient (properties, memory, threads, ...)
+        """
+        self.clients = [
+            CoreNLPClient(
+                endpoint="http://localhost:{}".format(base_port + i), **client_kwargs
+            )
+            for i in range(n_servers)
+        ]
+        self.max_retries = max_retries
+        self.outstanding = [0] * n_servers
+        self._lock = threading.Lock()
+        self._restart_locks = [threading.Lock() for _ in range(n_servers)]
+
+    def start(self):
+        for client in self.clients:
+            client.start()
+
+    def stop(self):
+        for client in self.clients:
+            client.stop()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _acquire(self):
+        """Pick the server with the fewest outstanding requests"""
+        with self._lock:
+            server_i = min(
+                range(len(self.clients)), key=self.outstanding.__getitem__
+            )
+            self.outstanding[server_i] += 1
+        return server_i
+
+    def _release(self, server_i):
+        with self._lock:
+            self.outstanding[server_i] -= 1
+
+    def is_alive(self, server_i):
+        """Check if the server process is still running"""
+        server = self.clients[server_i].server
+        return server is not None and server.poll() is None
+
+    def restart(self, server_i):
+        """Restart a dead server (once, even if several requests failed on it)"""
+        with self._restart_locks[server_i]:
+            if not self.is_alive(server_i):
+                print("Restarting CoreNLP server {}.".format(server_i))
+                self.clients[server_i].stop()
+                self.clients[server_i].start()
+
+    def annotate(self, text, *args, **kwargs):
+        """Annotate text on the least busy server, same arguments as CoreNLPClient.annotate"""
+        for attempt in range(self.max_retries + 1):
+            server_i = self._acquire()
+            try:
+                return self.clients[server_i].annotate(text, *args, **kwargs)
+            except Exception:
+                if self.is_alive(server_i) or attempt == self.max_retries:
+                    raise
+                self.restart(server_i)
+            finally:
+                self._release(server_i)
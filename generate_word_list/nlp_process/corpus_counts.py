@@ -0,0 +1,181 @@
+"""token counts of a LineSentence text file, counted once in parallel, for building word2vec vocabs
+"""
+import collections
+import json
+import os
+from multiprocessing import Pool
+
+import file_util
+import global_options
+import numpy as np
+
+from generate_word_list.nlp_process import token_table
+
+MAX_SENTENCE_LENGTH = 10000000  # as PathLineSentences in nlp_models
+
+
+def _read_vocab(path):
+    with open(path + ".vocab.txt", encoding="utf-8") as f:
+        return [line.rstrip("\n") for line in f]
+
+
+def _count_shard(args):
+    """Term frequency of a byte range of a corpus, its number of lines and examples (as
+    PathLineSentences), and the number of tokens of its longest line"""
+    in_file, start, end = args
+    counts = collections.Counter()
+    n_lines = 0
+    n_examples = 0
+    max_line_tokens = 0
+    for line in file_util.read_file_shard(in_file, start, end):
+        tokens = line.decode("utf-8").split()
+        counts.update(tokens)
+        n_lines += 1
+        n_examples += -(-len(tokens) // MAX_SENTENCE_LENGTH)
+        max_line_tokens = max(max_line_tokens, len(tokens))
+    return counts, n_lines, n_examples, max_line_tokens
+
+
+def build_corpus_counts(in_file, path, n_workers=None):
+    """Count the tokens of a corpus (each line is a sentence of space-separated tokens) into a
+    corpus_counts. The text is counted on byte ranges of the file in a Pool.
+
+    Arguments:
+        in_file {str or Path} -- corpus text file
+        path {str or Path} -- path of the count files without extension
+
+    Keyword Arguments:
+        n_workers {int} -- number of processes (default: {None}, N_CORES)
+
+    Returns:
+        corpus_counts -- the counts
+    """
+    path = str(path)
+    # the meta file marks complete counts; the token id arrays of earlier versions are not used
+    for ext in (".meta.json", ".ids", ".offsets.npy"):
+        if os.path.exists(path + ext):
+            os.remove(path + ext)
+    n_workers = n_workers or global_options.N_CORES
+    shards = file_util.file_shards(in_file, n_workers)
+    counts = collections.Counter()
+    n_sentences = 0
+    n_examples = 0
+    max_line_tokens = 0
+    with Pool(n_workers) as pool:
+        for shard_counts, n_lines, shard_examples, shard_max_tokens in pool.imap(
+            _count_shard, [(str(in_file), start, end) for start, end in shards]
+        ):
+            counts.update(shard_counts)
+            n_sentences += n_lines
+            n_examples += shard_examples
+            max_line_tokens = max(max_line_tokens, shard_max_tokens)
+    # most frequent first, ties by token, so that the vocab does not depend on the shards
+    vocab = sorted(counts, key=lambda t: (-counts[t], t))
+    with open(path + ".vocab.txt", "w", encoding="utf-8") as f:
+        for token in vocab:
+            f.write(token + "\n")
+    np.save(
+        path + ".counts.npy",
+        np.fromiter((counts[t] for t in vocab), dtype=np.int64, count=len(vocab)),
+    )
+    n_tokens = sum(counts.values())
+    source_stat = os.stat(str(in_file))
+    with open(path + ".meta.json", "w") as f:
+        json.dump(
+            {
+                "source": str(in_file),
+                "source_size": source_stat.st_size,
+                "source_mtime_ns": source_stat.st_mtime_ns,
+                "n_sentences": n_sentences,
+                "n_examples": n_examples,
+                "n_tokens": n_tokens,
+                "max_line_tokens": max_line_tokens,
+                "vocab_size": len(vocab),
+            },
+            f,
+            indent=2,
+        )
+    return corpus_counts(path)
+
+
+def load_corpus_counts(in_file, path):
+    """Return the corpus_counts of a corpus text file, counting it if it is missing or older
+    than the text file
+
+    Arguments:
+        in_file {str or Path} -- corpus text file
+        path {str or Path} -- path of the count files without extension
+
+    Returns:
+        corpus_counts -- the counts
+    """
+    if os.path.exists(str(path) + ".meta.json"):
+        counts = corpus_counts(path)
+        if counts.is_built_from(in_file):
+            return counts
+    return build_corpus_counts(in_file, path)
+
+
+class corpus_counts(object):
+    """The token counts of a corpus, so that a word2vec vocab is built without a pass over the
+    text (the epochs are trained from the text file, see nlp_models.train_w2v_model)
+
+    Files:
+        {path}.vocab.txt -- tokens, one per line (most frequent first)
+        {path}.counts.npy -- number of occurrences of each token (int64)
+        {path}.meta.json -- source text file and sizes (sentences, examples of PathLineSentences, tokens, tokens of the longest line)
+
+    The counts are pickled by path.
+    """
+
+    def __init__(self, path):
+        """
+        Arguments:
+            path {str or Path} -- path of the count files without extension
+        """
+        self.path = str(path)
+        with open(self.path + ".meta.json") as f:
+            self.meta = json.load(f)
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def __len__(self):
+        return self.meta["n_sentences"]
+
+    @property
+    def n_tokens(self):
+        return self.meta["n_tokens"]
+
+    def is_built_from(self, in_file):
+        source_stat = os.stat(str(in_file))
+        return (
+            self.meta["source_size"] == source_stat.st_size
+            and self.meta["source_mtime_ns"] == source_stat.st_mtime_ns
+        )
+
+    def vocab(self):
+        """
+        Returns:
+            [str] -- token of each id
+        """
+        return _read_vocab(self.path)
+
+    def word_freq(self):
+        """
+        Returns:
+            {str: int} -- number of occurrences of each token, e.g. for Word2Vec.build_vocab_from_freq
+        """
+        counts = np.load(self.path + ".counts.npy").tolist()
+        return dict(zip(self.vocab(), counts))
+
+    def document_frequency(self):
+        """
+        Returns:
+            token_table -- number of documents (lines, split every 10000 tokens) with each token,
+            the table next to the source file (see token_table.load_document_frequency)
+        """
+        return token_table.load_document_frequency(self.meta["source"])
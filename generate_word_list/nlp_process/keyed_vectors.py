@@ -0,0 +1,242 @@
+"""query-only word vectors of a word2vec model in memory-mapped files, loaded lazily and shared by processes through the page cache
+"""
+import json
+import mmap
+import os
+
+import gensim
+import numpy as np
+
+from generate_word_list.nlp_process import token_table
+
+
+def unit_vectors(vectors):
+    """Normalize the rows of a matrix of word vectors as gensim's init_sims does
+
+    Arguments:
+        vectors {np.ndarray} -- word vectors (e.g. w2v_mod.wv.vectors)
+
+    Returns:
+        np.ndarray -- unit vectors (float32)
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return (vectors / np.sqrt((vectors**2).sum(-1))[..., np.newaxis]).astype(
+        np.float32
+    )
+
+
+def export_keyed_vectors(model_path, w2v_mod=None):
+    """Write the keyed_vectors of a word2vec model next to the model ({model_path}.kv.*)
+
+    Arguments:
+        model_path {str or Path} -- path of the (saved) word2vec model
+
+    Keyword Arguments:
+        w2v_mod {gensim.models.Word2Vec} -- the loaded model (default: {None}, load it from model_path)
+
+    Returns:
+        keyed_vectors -- the vectors
+    """
+    path = str(model_path) + ".kv"
+    if os.path.exists(path + ".meta.json"):
+        # the meta file marks a complete export
+        os.remove(path + ".meta.json")
+    if w2v_mod is None:
+        w2v_mod = gensim.models.Word2Vec.load(str(model_path))
+    wv = w2v_mod.wv
+    np.save(path + ".vectors.npy", np.asarray(wv.vectors, dtype=np.float32))
+    np.save(path + ".vectors_norm.npy", unit_vectors(wv.vectors))
+    np.save(
+        path + ".counts.npy",
+        np.fromiter(
+            (wv.vocab[word].count for word in wv.index2word),
+            dtype=np.int64,
+            count=len(wv.index2word),
+        ),
+    )
+    word_bytes = [word.encode("utf-8") for word in wv.index2word]
+    word_offsets = np.zeros(len(word_bytes) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in word_bytes], out=word_offsets[1:])
+    np.save(path + ".word_offsets.npy", word_offsets)
+    with open(path + ".words", "wb") as f:
+        f.write(b"".join(word_bytes))
+    token_table.build_token_table(
+        path + ".word_ids", {word: i for i, word in enumerate(wv.index2word)}
+    )
+    model_stat = os.stat(str(model_path))
+    with open(path + ".meta.json", "w") as f:
+        json.dump(
+            {
+                "model_size": model_stat.st_size,
+                "model_mtime_ns": model_stat.st_mtime_ns,
+                "vocab_size": len(word_bytes),
+                "vector_size": int(wv.vectors.shape[1]),
+            },
+            f,
+            indent=2,
+        )
+    return keyed_vectors(model_path)
+
+
+def load_keyed_vectors(model_path):
+    """Return the keyed_vectors of a word2vec model, exporting them if they are missing or older
+    than the model
+
+    Arguments:
+        model_path {str or Path} -- path of the word2vec model
+
+    Returns:
+        keyed_vectors -- the vectors
+    """
+    meta_file = str(model_path) + ".kv.meta.json"
+    if os.path.exists(meta_file):
+        kv = keyed_vectors(model_path)
+        if kv.is_exported_from(model_path):
+            return kv
+    return export_keyed_vectors(model_path)
+
+
+class keyed_vectors(object):
+    """The word vectors of a word2vec model, for queries only (no training state)
+
+    Files ({model_path}.kv.*):
+        vectors.npy -- vector of each word (float32, as w2v_mod.wv.vectors)
+        vectors_norm.npy -- unit vector of each word (float32, as w2v_mod.wv.vectors_norm)
+        counts.npy -- number of occurrences of each word in the training corpus (int64)
+        words, word_offsets.npy -- utf-8 words in the order of the vectors, and the start of each word plus the end of the last
+        word_ids.* -- token_table of the row of each word
+        meta.json -- model file the vectors were exported from, and sizes
+
+    Nothing is read until the first query; the arrays are opened with mmap, so concurrent
+    processes share one copy in the page cache. The vectors are pickled by path.
+    """
+
+    def __init__(self, model_path):
+        """
+        Arguments:
+            model_path {str or Path} -- path of the word2vec model
+        """
+        self.model_path = str(model_path)
+        self.path = self.model_path + ".kv"
+        with open(self.path + ".meta.json") as f:
+            self.meta = json.load(f)
+        self._word_ids = token_table.token_table(self.path + ".word_ids")
+        self._vectors = None
+        self._vectors_norm = None
+        self._counts = None
+        self._words = None
+        self._word_offsets = None
+
+    def __getstate__(self):
+        return {"model_path": self.model_path}
+
+    def __setstate__(self, state):
+        self.__init__(state["model_path"])
+
+    def __len__(self):
+        return self.meta["vocab_size"]
+
+    def is_exported_from(self, model_path):
+        model_stat = os.stat(str(model_path))
+        return (
+            self.meta["model_size"] == model_stat.st_size
+            and self.meta["model_mtime_ns"] == model_stat.st_mtime_ns
+        )
+
+    @property
+    def vectors(self):
+        if self._vectors is None:
+            self._vectors = np.load(self.path + ".vectors.npy", mmap_mode="r")
+        return self._vectors
+
+    @property
+    def vectors_norm(self):
+        if self._vectors_norm is None:
+            self._vectors_norm = np.load(self.path + ".vectors_norm.npy", mmap_mode="r")
+        return self._vectors_norm
+
+    def index(self, word):
+        """
+        Returns:
+            int -- row of the word, -1 if the word is not in the vocab
+        """
+        return self._word_ids.get(word, -1)
+
+    def word(self, i):
+        """
+        Returns:
+            str -- word of row i
+        """
+        if self._words is None:
+            self._word_offsets = np.load(self.path + ".word_offsets.npy", mmap_mode="r")
+            if self._word_offsets[-1] > 0:
+                with open(self.path + ".words", "rb") as f:
+                    self._words = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self._words = b""
+        return self._words[self._word_offsets[i] : self._word_offsets[i + 1]].decode(
+            "utf-8"
+        )
+
+    def __contains__(self, word):
+        return self.index(word) >= 0
+
+    def _row(self, word):
+        i = self.index(word)
+        if i < 0:
+            raise KeyError("word '%s' not in vocabulary" % word)
+        return i
+
+    def word_vec(self, word, use_norm=False):
+        """
+        Returns:
+            np.ndarray -- vector of the word (unit vector if use_norm)
+        """
+        if use_norm:
+            return np.asarray(self.vectors_norm[self._row(word)])
+        return np.asarray(self.vectors[self._row(word)])
+
+    def __getitem__(self, word):
+        return self.word_vec(word)
+
+    def count(self, word):
+        """
+        Returns:
+            int -- number of occurrences of the word in the training corpus
+        """
+        if self._counts is None:
+            self._counts = np.load(self.path + ".counts.npy", mmap_mode="r")
+        return int(self._counts[self._row(word)])
+
+    def most_similar(self, positive=None, negative=None, topn=10):
+        """Words most similar to the mean of the unit vectors of positive minus negative, as
+        gensim KeyedVectors.most_similar
+
+        Keyword Arguments:
+            positive {str or [str]} -- words that contribute positively (default: {None})
+            negative {[str]} -- words that contribute negatively (default: {None})
+            topn {int} -- number of words (default: {10})
+
+        Returns:
+            [(str, float)] -- words and cosine similarities, most similar first, without the
+            words of the query
+        """
+        if isinstance(positive, str):
+            positive = [positive]
+        weighted_rows = [(self._row(word), 1.0) for word in positive or []] + [
+            (self._row(word), -1.0) for word in negative or []
+        ]
+        if not weighted_rows:
+            raise ValueError("cannot compute similarity with no input")
+        mean = np.array(
+            [weight * self.vectors_norm[row] for row, weight in weighted_rows]
+        ).mean(axis=0)
+        mean = (mean / np.linalg.norm(mean)).astype(np.float32)
+        sims = np.dot(self.vectors_norm, mean)
+        query_rows = {row for row, _ in weighted_rows}
+        n_best = min(len(sims), topn + len(query_rows))
+        best = np.argpartition(-sims, n_best - 1)[:n_best]
+        best = best[np.argsort(-sims[best], kind="stable")]
+        return [(self.word(i), float(sims[i])) for i in best if i not in query_rows][
+            :topn
+        ]
@@ -2,6 +2,14 @@ import sys
 
 sys.path.append("..")
 import datetime
+import functools
+import heapq
+import itertools
+import os
+import struct
+import tempfile
+from collections import Counter, defaultdict
+from multiprocessing import Pool
 from pathlib import Path
 
 import file_util
@@ -9,15 +17,29 @@ import gensim
 import global_options
 import stopwordsiso as stopwords
 import tqdm
-from gensim import models
+from gensim import models, utils
 
+from generate_word_list import parse
+from generate_word_list.nlp_process import keyed_vectors, token_table
 
-def train_bigram_model(input_path, model_path):
+# gensim's corpus_file mode cuts lines into sentences of at most this many words (MAX_SENTENCE_LEN
+# of word2vec_corpusfile), whereas PathLineSentences(max_sentence_length=10000000) keeps them whole
+CORPUSFILE_MAX_SENTENCE_LENGTH = 10000
+
+
+def train_bigram_model(
+    input_path, model_path, sharded=False, n_workers=None, max_vocab_size=None
+):
     """ Train a phrase model and save it to the disk. 
     
     Arguments:
         input_path {str or Path} -- input corpus
         model_path {str or Path} -- where to save the trained phrase model?
+
+    Keyword Arguments:
+        sharded {bool} -- count byte ranges of the corpus in parallel and merge the counts (default: {False})
+        n_workers {int} -- number of processes when sharded (default: {None}, N_CORES)
+        max_vocab_size {int} -- when sharded, the number of counts a worker keeps in memory before spilling them to disk (default: {None}, no limit)
     
     Returns:
         gensim.models.phrases.Phrases -- the trained phrase model
@@ -25,21 +47,218 @@ def train_bigram_model(input_path, model_path):
     Path(model_path).parent.mkdir(parents=True, exist_ok=True)
     print(datetime.datetime.now())
     print("Training phraser...")
-    corpus = gensim.models.word2vec.PathLineSentences(
-        str(input_path), max_sentence_length=10000000
-    )
-    n_lines = file_util.line_counter(input_path)
-    bigram_model = models.phrases.Phrases(
-        tqdm.tqdm(corpus, total=n_lines),
+    bigram_model = new_phrase_model()
+    if sharded:
+        count_phrase_vocab_file(
+            bigram_model, input_path, n_workers, max_vocab_size, Path(model_path).parent
+        )
+    else:
+        corpus = gensim.models.word2vec.PathLineSentences(
+            str(input_path), max_sentence_length=10000000
+        )
+        n_lines = file_util.line_counter(input_path)
+        bigram_model.add_vocab(tqdm.tqdm(corpus, total=n_lines))
+    bigram_model.save(str(model_path))
+    return bigram_model
+
+
+def new_phrase_model():
+    """An empty phrase model with the options used by train_bigram_model.
+    Learn the vocab with add_vocab, e.g. from a stream of token lists.
+
+    Returns:
+        gensim.models.phrases.Phrases -- phrase model without vocab
+    """
+    return models.phrases.Phrases(
         min_count=global_options.PHRASE_MIN_COUNT,
         scoring="default",
         threshold=global_options.PHRASE_THRESHOLD,
         common_terms=stopwords.stopwords("en"),
     )
-    bigram_model.save(str(model_path))
+
+
+def set_phrase_scoring(bigram_model, threshold=None, scoring=None):
+    """Override the scoring function and threshold of a phrase model before applying it
+
+    Arguments:
+        bigram_model {gensim.models.phrases.Phrases} -- phrase model
+
+    Keyword Arguments:
+        threshold {float} -- score threshold (default: {None}, keep the model's)
+        scoring {str} -- name of a scoring function in gensim.models.phrases (default: {None}, keep the model's)
+
+    Returns:
+        gensim.models.phrases.Phrases -- the same model
+    """
+    if scoring is not None:
+        bigram_model.scoring = getattr(gensim.models.phrases, scoring)
+    if threshold is not None:
+        bigram_model.threshold = threshold
     return bigram_model
 
 
+def line_sentences(lines, max_sentence_length=10000000):
+    """Sentences of lines as PathLineSentences(max_sentence_length) reads them
+
+    Arguments:
+        lines {iterable of str or bytes} -- lines of a corpus
+    """
+    for line in lines:
+        words = utils.to_unicode(line).split()
+        for i in range(0, len(words), max_sentence_length):
+            yield words[i : i + max_sentence_length]
+
+
+def count_phrase_vocab(sentences, common_terms, delimiter=b"_"):
+    """Count words and phrase candidates as Phrases.learn_vocab does, without pruning, so that
+    the counts of parts of a corpus can be merged (see merge_phrase_vocab).
+
+    Arguments:
+        sentences {iterable of [str]} -- tokens of each sentence
+        common_terms {frozenset of bytes} -- the model's common_terms
+        delimiter {bytes} -- the model's delimiter
+
+    Returns:
+        defaultdict(int), int -- counts (keys are utf-8 bytes), number of words
+    """
+    vocab = defaultdict(int)
+    total_words = 0
+    for sentence in sentences:
+        last_uncommon = None
+        in_between = []
+        for word in sentence:
+            word = utils.any2utf8(word)
+            if word not in common_terms:
+                vocab[word] += 1
+                if last_uncommon is not None:
+                    vocab[delimiter.join([last_uncommon] + in_between + [word])] += 1
+                last_uncommon = word
+                in_between = []
+            elif last_uncommon is not None:
+                in_between.append(word)
+        total_words += len(sentence)
+    return vocab, total_words
+
+
+def merge_phrase_vocab(bigram_model, vocab, total_words):
+    """Add counts from count_phrase_vocab to a phrase model (as Phrases.add_vocab merges them)
+
+    Arguments:
+        bigram_model {gensim.models.phrases.Phrases} -- phrase model
+        vocab {mapping} -- counts
+        total_words {int} -- number of words counted
+    """
+    model_vocab = bigram_model.vocab
+    for word, count in vocab.items():
+        model_vocab[word] += count
+    bigram_model.corpus_word_count += total_words
+
+
+# spilled counts: records of key length, count and key, sorted by key
+RUN_RECORD = struct.Struct("<IQ")
+
+
+def _write_run(vocab, run_dir):
+    with tempfile.NamedTemporaryFile(
+        "wb", dir=str(run_dir), prefix="phrase_counts_", suffix=".run", delete=False
+    ) as f:
+        for word in sorted(vocab):
+            f.write(RUN_RECORD.pack(len(word), vocab[word]))
+            f.write(word)
+        return f.name
+
+
+def _read_run(run_file):
+    with open(run_file, "rb") as f:
+        while True:
+            record = f.read(RUN_RECORD.size)
+            if not record:
+                return
+            length, count = RUN_RECORD.unpack(record)
+            yield f.read(length), count
+
+
+def _count_phrase_shard(args):
+    """count_phrase_vocab on a byte range of a corpus file (sentences as read by
+    PathLineSentences), spilling sorted runs to run_dir every max_vocab_size counts"""
+    input_path, start, end, common_terms, delimiter, max_vocab_size, run_dir = args
+    vocab = defaultdict(int)
+    runs = []
+    total_words = 0
+    lines = file_util.read_file_shard(input_path, start, end)
+    while True:
+        block = list(itertools.islice(lines, 10000))
+        if not block:
+            break
+        block_vocab, block_words = count_phrase_vocab(
+            line_sentences(block), common_terms, delimiter
+        )
+        for word, count in block_vocab.items():
+            vocab[word] += count
+        total_words += block_words
+        if max_vocab_size is not None and len(vocab) >= max_vocab_size:
+            runs.append(_write_run(vocab, run_dir))
+            vocab = defaultdict(int)
+    if max_vocab_size is not None:
+        if vocab:
+            runs.append(_write_run(vocab, run_dir))
+        return runs, total_words
+    return vocab, total_words
+
+
+def count_phrase_vocab_file(
+    bigram_model, input_path, n_workers=None, max_vocab_size=None, run_dir=None
+):
+    """Count the words and phrase candidates of a corpus file into a phrase model, in parallel.
+
+    Byte ranges of the file are counted in a Pool (map), then the counts are summed (reduce),
+    so the result does not depend on the number of workers. With max_vocab_size, each worker
+    spills sorted runs of counts to run_dir and the runs are merged with a k-way merge, which
+    bounds the memory of the workers. Gives the same model as add_vocab(PathLineSentences)
+    when gensim does not prune the vocab (more than max_vocab_size of the model, 40M by default).
+
+    Arguments:
+        bigram_model {gensim.models.phrases.Phrases} -- phrase model, e.g. from new_phrase_model
+        input_path {str or Path} -- corpus, each line is a sentence
+
+    Keyword Arguments:
+        n_workers {int} -- number of processes (default: {None}, N_CORES)
+        max_vocab_size {int} -- number of counts a worker keeps in memory (default: {None}, no limit)
+        run_dir {str or Path} -- directory of the spilled runs (default: {None}, next to input_path)
+    """
+    n_workers = n_workers or global_options.N_CORES
+    run_dir = run_dir or Path(input_path).parent
+    shard_args = [
+        (
+            str(input_path),
+            start,
+            end,
+            bigram_model.common_terms,
+            bigram_model.delimiter,
+            max_vocab_size,
+            str(run_dir),
+        )
+        for start, end in file_util.file_shards(input_path, n_workers)
+    ]
+    runs = []
+    with Pool(n_workers) as pool:
+        for shard_counts, total_words in pool.imap(_count_phrase_shard, shard_args):
+            if max_vocab_size is None:
+                merge_phrase_vocab(bigram_model, shard_counts, total_words)
+            else:
+                runs.extend(shard_counts)
+                bigram_model.corpus_word_count += total_words
+    if runs:
+        try:
+            model_vocab = bigram_model.vocab
+            merged = heapq.merge(*[_read_run(run) for run in runs])
+            for word, counts in itertools.groupby(merged, key=lambda r: r[0]):
+                model_vocab[word] += sum(count for _, count in counts)
+        finally:
+            for run in runs:
+                os.remove(run)
+
+
 def bigram_transform(line, bigram_phraser):
     """ Helper file fore file_bigramer
     Note: Needs a phraser object in the enviroment.
@@ -51,41 +270,237 @@ def bigram_transform(line, bigram_phraser):
     return " ".join(bigram_phraser[line.split()])
 
 
+def bigram_transform_lines(lines, bigram_phraser):
+    """Batch version of bigram_transform
+
+    Arguments:
+        lines {[str]} -- lines (line breaks are ignored)
+        bigram_phraser {frozen_phrases or Phrases} -- phrase model
+
+    Returns:
+        str -- the transformed lines, each ending with a line break
+    """
+    return "".join(bigram_transform(l, bigram_phraser) + "\n" for l in lines)
+
+
+class frozen_phrases(object):
+    """Read-only phrase lookup frozen from a trained Phrases model.
+
+    phrase_model[sentence] gives exactly the same output as the Phrases model with its current
+    scoring and threshold (unlike gensim's Phraser, tokens may contain the delimiter, e.g. when
+    applying the trigram model to bigrams). Only the phrases that pass the threshold are kept,
+    so it is much smaller than the model and cheap to send to worker processes.
+    """
+
+    def __init__(self, bigram_model):
+        """
+        Arguments:
+            bigram_model {gensim.models.phrases.Phrases} -- trained phrase model
+        """
+        if bigram_model.threshold < -1:
+            # Phrases joins words that are not in its vocab (score -1) below this threshold
+            raise ValueError("Threshold below -1 is not supported.")
+        vocab = bigram_model.vocab
+        delimiter = bigram_model.delimiter
+        scorer = functools.partial(
+            bigram_model.scoring,
+            len_vocab=float(len(vocab)),
+            min_count=float(bigram_model.min_count),
+            corpus_word_count=float(bigram_model.corpus_word_count),
+        )
+        self.delimiter = utils.to_unicode(delimiter)
+        self.common_terms = frozenset(
+            utils.to_unicode(w) for w in bigram_model.common_terms
+        )
+        # (length of worda, length of wordb, joined phrase) of every phrase above the threshold:
+        # a vocab key "a_of_b" could be scored as a + b, a_of + b, etc.
+        self.phrasegrams = set()
+        for phrase, phrase_count in vocab.items():
+            positions = []
+            i = phrase.find(delimiter)
+            while i >= 0:
+                positions.append(i)
+                i = phrase.find(delimiter, i + 1)
+            for a, i in enumerate(positions):
+                worda = phrase[:i]
+                if worda not in vocab:
+                    continue
+                for j in positions[a:]:
+                    wordb = phrase[j + len(delimiter) :]
+                    if (
+                        wordb in vocab
+                        and scorer(
+                            worda_count=float(vocab[worda]),
+                            wordb_count=float(vocab[wordb]),
+                            bigram_count=float(phrase_count),
+                        )
+                        > bigram_model.threshold
+                    ):
+                        self.phrasegrams.add(
+                            (
+                                len(utils.to_unicode(worda)),
+                                len(utils.to_unicode(wordb)),
+                                utils.to_unicode(phrase),
+                            )
+                        )
+
+    def __len__(self):
+        return len(self.phrasegrams)
+
+    def __getitem__(self, sentence):
+        """Join the phrases in a sentence (Phrases.analyze_sentence with the frozen scores)
+
+        Arguments:
+            sentence {[str]} -- tokens
+
+        Returns:
+            [str] -- tokens with phrases joined by the delimiter
+        """
+        new_s = []
+        last_uncommon = None
+        in_between = []
+        for word in sentence:
+            if word in self.common_terms:
+                if last_uncommon:
+                    # wait for uncommon resolution
+                    in_between.append(word)
+                else:
+                    new_s.append(word)
+            elif last_uncommon:
+                phrase = self.delimiter.join([last_uncommon] + in_between + [word])
+                if (len(last_uncommon), len(word), phrase) in self.phrasegrams:
+                    new_s.append(phrase)
+                    last_uncommon = None
+                else:
+                    # release words individually
+                    new_s.append(last_uncommon)
+                    new_s.extend(in_between)
+                    last_uncommon = word
+                in_between = []
+            else:
+                last_uncommon = word
+        if last_uncommon:
+            new_s.append(last_uncommon)
+            new_s.extend(in_between)
+        return new_s
+
+
 def file_bigramer(input_path, output_path, model_path, threshold=None, scoring=None):
     """ Transform an input text file into a file with 2-word phrases. 
     Apply again to learn 3-word phrases. 
 
+    The model is frozen into a frozen_phrases lookup, the file is transformed in blocks by a
+    Pool, and blocks are written in order as they finish. The workers also count the document
+    frequency of the output tokens, written next to output_path (see
+    token_table.write_document_frequency).
+
     Arguments:
         input_path {str}: Each line is a sentence
         ouput_file {str}: Each line is a sentence with 2-word phraes concatenated
     """
     Path(output_path).parent.mkdir(parents=True, exist_ok=True)
     Path(model_path).parent.mkdir(parents=True, exist_ok=True)
-    bigram_model = gensim.models.phrases.Phrases.load(str(model_path))
-    if scoring is not None:
-        bigram_model.scoring = getattr(gensim.models.phrases, scoring)
-    if threshold is not None:
-        bigram_model.threshold = threshold
-    # bigram_phraser = models.phrases.Phraser(bigram_model)
-    with open(input_path, "r") as f:
-        input_data = f.readlines()
-    data_bigram = [bigram_transform(l, bigram_model) for l in tqdm.tqdm(input_data)]
+    bigram_model = set_phrase_scoring(
+        gensim.models.phrases.Phrases.load(str(model_path)), threshold, scoring
+    )
+    bigram_phraser = frozen_phrases(bigram_model)
+    del bigram_model
+    n_lines = 0
+    dfs = Counter()
     with open(output_path, "w") as f:
-        f.write("\n".join(data_bigram) + "\n")
-    assert len(input_data) == file_util.line_counter(output_path)
+        for lines, output_lines, block_dfs in parse.imap_streaming(
+            functools.partial(_bigram_transform_block, bigram_phraser=bigram_phraser),
+            ((block,) for block in file_util.read_large_file(input_path)),
+            global_options.N_CORES * 4,
+        ):
+            f.write(output_lines)
+            dfs.update(block_dfs)
+            n_lines += lines
+            print(datetime.datetime.now())
+            print("Processed " + str(n_lines) + " lines.")
+    token_table.write_document_frequency(output_path, dfs)
+
+
+def _bigram_transform_block(lines, bigram_phraser):
+    output_lines = bigram_transform_lines(lines, bigram_phraser)
+    return (
+        len(lines),
+        output_lines,
+        token_table.count_lines_document_frequency(output_lines.split("\n")),
+    )
 
 
-def train_w2v_model(input_path, model_path, *args, **kwargs):
+def train_w2v_model(input_path, model_path, *args, corpus=None, **kwargs):
     """ Train a word2vec model using the LineSentence file in input_path, 
-    save the model to model_path.count
+    save the model to model_path, and its query-only vectors next to it (see keyed_vectors).
     
     Arguments:
         input_path {str} -- Corpus for training, each line is a sentence
         model_path {str} -- Where to save the model? 
+
+    Keyword Arguments:
+        corpus {corpus_counts} -- token counts of input_path (default: {None}). If set, the
+            vocab is built from its counts instead of a pass over the text, and the epochs are
+            trained with gensim's corpus_file mode (if gensim was built with it and no line is
+            longer than CORPUSFILE_MAX_SENTENCE_LENGTH tokens, so that the sentences are the
+            same as with PathLineSentences), instead of re-reading and splitting the text in
+            Python.
     """
     Path(model_path).parent.mkdir(parents=True, exist_ok=True)
-    corpus_confcall = gensim.models.word2vec.PathLineSentences(
-        str(input_path), max_sentence_length=10000000
-    )
-    model = gensim.models.Word2Vec(corpus_confcall, min_count=1, *args, **kwargs)
+    if corpus is None:
+        corpus_confcall = gensim.models.word2vec.PathLineSentences(
+            str(input_path), max_sentence_length=10000000
+        )
+        model = gensim.models.Word2Vec(corpus_confcall, min_count=1, *args, **kwargs)
+    else:
+        model = gensim.models.Word2Vec(None, min_count=1, *args, **kwargs)
+        model.build_vocab_from_freq(
+            corpus.word_freq(), corpus_count=corpus.meta["n_examples"]
+        )
+        _train_w2v_epochs(model, input_path, corpus)
     model.save(str(model_path))
+    keyed_vectors.export_keyed_vectors(model_path, model)
+
+
+def update_w2v_model(input_path, model_path, corpus, out_path=None):
+    """Add the words of a new corpus to a saved word2vec model and continue training it
+    on the new corpus only.
+
+    Arguments:
+        input_path {str} -- new corpus, each line is a sentence
+        model_path {str} -- the model to update
+        corpus {corpus_counts} -- token counts of input_path
+
+    Keyword Arguments:
+        out_path {str} -- where to save the updated model and its query-only vectors (default: {None}, model_path)
+    """
+    out_path = model_path if out_path is None else out_path
+    model = gensim.models.Word2Vec.load(str(model_path))
+    model.build_vocab_from_freq(
+        corpus.word_freq(), corpus_count=corpus.meta["n_examples"], update=True
+    )
+    _train_w2v_epochs(model, input_path, corpus)
+    model.save(str(out_path))
+    keyed_vectors.export_keyed_vectors(out_path, model)
+
+
+def _train_w2v_epochs(model, input_path, corpus):
+    max_line_tokens = corpus.meta.get("max_line_tokens")
+    if (
+        gensim.models.word2vec.CORPUSFILE_VERSION >= 0
+        and max_line_tokens is not None
+        and max_line_tokens <= CORPUSFILE_MAX_SENTENCE_LENGTH
+    ):
+        model.train(
+            corpus_file=str(input_path),
+            total_words=corpus.n_tokens,
+            epochs=model.epochs,
+        )
+    else:
+        model.train(
+            gensim.models.word2vec.PathLineSentences(
+                str(input_path), max_sentence_length=10000000
+            ),
+            total_examples=model.corpus_count,
+            epochs=model.epochs,
+        )
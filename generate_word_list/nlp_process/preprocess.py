@@ -1,14 +1,72 @@
-import functools
+import bisect
 import re
 
 import global_options
 import stopwordsiso as stopwords
+from stanfordnlp.protobuf import Document
 from stanfordnlp.server import CoreNLPClient
 
 
+DEPENDENCY_GRAPHS = [
+    "basicDependencies",
+    "collapsedDependencies",
+    "collapsedCCProcessedDependencies",
+    "alternativeDependencies",
+    "enhancedDependencies",
+    "enhancedPlusPlusDependencies",
+]
+
+
+def _shift(message, fields, offset):
+    """Subtract offset from the fields of a protobuf message that are set"""
+    for field in fields:
+        if message.HasField(field):
+            setattr(message, field, getattr(message, field) - offset)
+
+
+def _rebase_sentence(
+    sentence_ann, sentence_offset, token_offset, char_offset, mention_offset
+):
+    """Make the document-level offsets of a sentence annotated in a packed request relative to
+    its own document, as if the document had been annotated alone
+
+    Arguments:
+        sentence_ann {CoreNLP_pb2.Sentence} -- An annotated sentence (modified in place)
+        sentence_offset {int} -- index of the first sentence of the document in the request
+        token_offset {int} -- tokenBeginIndex of the first token of the document
+        char_offset {int} -- character offset of the document (UTF-16 code units)
+        mention_offset {int} -- number of entity mentions before the document
+    """
+    _shift(sentence_ann, ["sentenceIndex"], sentence_offset)
+    _shift(sentence_ann, ["tokenOffsetBegin", "tokenOffsetEnd"], token_offset)
+    _shift(sentence_ann, ["characterOffsetBegin", "characterOffsetEnd"], char_offset)
+    for t in sentence_ann.token:
+        _shift(t, ["tokenBeginIndex", "tokenEndIndex"], token_offset)
+        _shift(t, ["beginChar", "endChar"], char_offset)
+        _shift(t, ["entityMentionIndex"], mention_offset)
+    for m in sentence_ann.mentions:
+        _shift(m, ["sentenceIndex"], sentence_offset)
+        _shift(m, ["entityMentionIndex", "canonicalEntityMentionIndex"], mention_offset)
+    for graph in DEPENDENCY_GRAPHS:
+        for node in getattr(sentence_ann, graph).node:
+            _shift(node, ["sentenceIndex"], sentence_offset)
+
+
 class preprocessor(object):
-    def __init__(self, client):
+    def __init__(self, client, cache=None, archive=None):
+        """
+        Arguments:
+            client {CoreNLPClient} -- client used to annotate documents
+
+        Keyword Arguments:
+            cache {annotation_cache} -- if set, processed sentences are looked up in (and added to)
+                the cache, so documents that were seen before are not sent to CoreNLP (default: {None})
+            archive {annotation_archive} -- if set, the raw annotation of every document is added to
+                the archive; cached documents missing from the archive are annotated again (default: {None})
+        """
         self.client = client
+        self.cache = cache
+        self.archive = archive
 
     def process_document(self, doc, doc_id=None):
         """Main method: Annotate a document using CoreNLP client
@@ -35,7 +93,31 @@ class preprocessor(object):
         Note:
             When the doc is empty, both doc_id and sentences processed will be too. (@TODO: fix for consistensy)
         """
+        if self.cache is not None and (self.archive is None or doc in self.archive):
+            sentences_processed = self.cache.get_many([doc])[0]
+            if sentences_processed is not None:
+                doc_ids = [
+                    str(doc_id) + "_" + str(i) for i in range(len(sentences_processed))
+                ]
+                return sentences_processed, doc_ids
         doc_ann = self.client.annotate(doc)
+        if self.archive is not None:
+            self.archive.put(doc, doc_ann)
+        sentences_processed, doc_ids = self.process_annotation(doc_ann, doc_id)
+        if self.cache is not None:
+            self.cache.put_many([doc], [sentences_processed])
+        return sentences_processed, doc_ids
+
+    def process_annotation(self, doc_ann, doc_id=None):
+        """Process an annotated document (e.g. read from an annotation_archive)
+
+        Arguments:
+            doc_ann {CoreNLP_pb2.Document} -- An annotated document
+            doc_id {str} -- raw string of a document ID
+
+        Returns:
+            sentences_processed, doc_ids -- same as process_document
+        """
         sentences_processed = []
         doc_ids = []
         for i, sentence in enumerate(doc_ann.sentence):
@@ -43,6 +125,100 @@ class preprocessor(object):
             doc_ids.append(str(doc_id) + "_" + str(i))
         return sentences_processed, doc_ids
 
+    def process_documents(self, docs, doc_ids, max_chars=100000):
+        """Annotate a batch of documents with as few CoreNLP requests as possible
+
+        Documents are packed into one request, separated by blank lines (the client needs
+        "ssplit.newlineIsSentenceBreak": "two" so that no sentence spans two documents).
+        Each sentence is assigned back to its document using the character offset of its
+        first token. Documents found in the cache and repeated documents are not sent again.
+
+        Arguments:
+            docs {[str]} -- raw strings of the documents
+            doc_ids {[str]} -- raw strings of the document IDs
+
+        Keyword Arguments:
+            max_chars {int} -- start a new request when the packed text exceeds this length
+                (default: {100000})
+
+        Returns:
+            [([str], [str])] -- (sentences_processed, doc_ids) for each document,
+                same as process_document
+        """
+        docs = [doc.strip("\n") for doc in docs]
+        if self.cache is not None:
+            cached = self.cache.get_many(docs)
+            if self.archive is not None:
+                cached = [
+                    c if doc in self.archive else None for doc, c in zip(docs, cached)
+                ]
+        else:
+            cached = [None] * len(docs)
+        # unique documents to annotate, in order of first appearance
+        annotated = {doc: None for doc, c in zip(docs, cached) if c is None}
+        to_annotate = list(annotated)
+        batch, batch_chars = [], 0
+        for doc in to_annotate:
+            if batch and batch_chars + len(doc) > max_chars:
+                annotated.update(zip(batch, self._process_packed(batch)))
+                batch, batch_chars = [], 0
+            batch.append(doc)
+            batch_chars += len(doc) + 2
+        if batch:
+            annotated.update(zip(batch, self._process_packed(batch)))
+        if self.cache is not None and to_annotate:
+            self.cache.put_many(to_annotate, [annotated[doc] for doc in to_annotate])
+
+        results = []
+        for doc, doc_id, sentences_processed in zip(docs, doc_ids, cached):
+            if sentences_processed is None:
+                sentences_processed = annotated[doc]
+            doc_sent_ids = [
+                str(doc_id) + "_" + str(i) for i in range(len(sentences_processed))
+            ]
+            results.append((sentences_processed, doc_sent_ids))
+        return results
+
+    def _process_packed(self, docs):
+        """Annotate documents packed in a single request, see process_documents
+
+        Returns:
+            [[str]] -- processed sentences of each document
+        """
+        # CoreNLP character offsets count UTF-16 code units
+        doc_begins = []
+        offset = 0
+        for doc in docs:
+            doc_begins.append(offset)
+            offset += len(doc.encode("utf-16-le")) // 2 + 2
+        doc_ann = self.client.annotate("\n\n".join(docs))
+        results = [[] for _ in docs]
+        doc_sentences = [[] for _ in docs]
+        # sentence, token, character and mention offsets of each document in the request
+        doc_offsets = [None] * len(docs)
+        n_mentions = 0
+        for sentence_i, sentence in enumerate(doc_ann.sentence):
+            doc_i = bisect.bisect_right(doc_begins, sentence.token[0].beginChar) - 1
+            if doc_offsets[doc_i] is None:
+                doc_offsets[doc_i] = (
+                    sentence_i,
+                    sentence.token[0].tokenBeginIndex,
+                    doc_begins[doc_i],
+                    n_mentions,
+                )
+            n_mentions += len(sentence.mentions)
+            # offsets as if the document had been annotated alone, before caching and archiving
+            _rebase_sentence(sentence, *doc_offsets[doc_i])
+            results[doc_i].append(self.process_sentence(sentence))
+            doc_sentences[doc_i].append(sentence)
+        if self.archive is not None:
+            # one Document per paragraph
+            for doc, sentences in zip(docs, doc_sentences):
+                paragraph_ann = Document(text=doc)
+                paragraph_ann.sentence.extend(sentences)
+                self.archive.put(doc, paragraph_ann)
+        return results
+
     def sentence_mwe_finder(
         self, sentence_ann, dep_types=set(["compound", "compound:prt"])
     ):
@@ -94,7 +270,14 @@ class preprocessor(object):
                 [m.tokenStartInSentenceInclusive, m.tokenEndInSentenceExclusive]
             )
             # Note: edge in NEs's end index is at the end of the last token
-            NE_edges.append([edge[0], edge[1] - 1])
+            # (+ sentence_ann.token[0].tokenBeginIndex) as in sentence_mwe_finder: the mention
+            # indices are for the current sentence, whereas tokenBeginIndex are for the document.
+            NE_edges.append(
+                [
+                    edge[0] + sentence_ann.token[0].tokenBeginIndex,
+                    edge[1] - 1 + sentence_ann.token[0].tokenBeginIndex,
+                ]
+            )
             NE_types.append(m.entityType)
             # # alternative method:
             # NE_edges.append(sorted([field[1]
@@ -159,6 +342,17 @@ class preprocessor(object):
         return "".join(sentence_parsed)
 
 
+# precompiled patterns and stopwords used by text_cleaner
+NER_MISC_PATTERN = re.compile(r"(\[NER:MISC\])(\S+)")
+NER_ORDINAL_PATTERN = re.compile(r"(\[NER:ORDINAL\])(\S+)")
+NER_PATTERN = re.compile(r"(\[NER:\w+\])(\S+)")
+NER_TAG_PATTERN = re.compile(r"\[NER:.*?\]")
+POS_TAG_PATTERN = re.compile(r"\[pos:.*?\]")
+# these are tagged bracket and parenthesises
+BRACKETS = frozenset(["-lrb-", "-rrb-", "-lsb-", "-rsb-"])
+PUNCTS_STOPS = frozenset(BRACKETS | {"'s"} | set(stopwords.stopwords("en")))
+
+
 class text_cleaner(object):
     """Clean the text parsed by CoreNLP (preprocessor)"""
 
@@ -175,16 +369,10 @@ class text_cleaner(object):
             str -- text with NE replaced by NE tags,
             e.g. [NER:PERCENT]16_% becomes [NER:PERCENT]
         """
-        NERs = re.compile(
-            "(\[NER:MISC\])(\S+)"
-        )  # remove MISC tag (sometimes cvoid tagged)
-        line = re.sub(NERs, r"\2", line)
-        NERs = re.compile(
-            "(\[NER:ORDINAL\])(\S+)"
-        )  # remove MISC tag (sometimes cvoid tagged)
-        line = re.sub(NERs, r"\2", line)
-        NERs = re.compile("(\[NER:\w+\])(\S+)")
-        line = re.sub(NERs, r"\1", line)
+        # remove MISC tag (sometimes cvoid tagged)
+        line = NER_MISC_PATTERN.sub(r"\2", line)
+        line = NER_ORDINAL_PATTERN.sub(r"\2", line)
+        line = NER_PATTERN.sub(r"\1", line)
         return line
 
     def remove_puct_num(self, line):
@@ -197,16 +385,12 @@ class text_cleaner(object):
             str -- text with stopwords, numerics, 1-letter words removed
         """
         tokens = line.strip().split(" ")
-        tokens = [re.sub("\[pos:.*?\]", "", t) for t in tokens]
-        # these are tagged bracket and parenthesises
-        puncts_stops = set(
-            ["-lrb-", "-rrb-", "-lsb-", "-rsb-", "'s"]
-        ) | stopwords.stopwords("en")
+        tokens = [POS_TAG_PATTERN.sub("", t) for t in tokens]
         # filter out numerics and 1-letter words as recommend by
         # https://sraf.nd.edu/textual-analysis/resources/#StopWords
         tokens = filter(
             lambda t: any(c.isalpha() for c in t)
-            and t not in puncts_stops
+            and t not in PUNCTS_STOPS
             and len(t) > 1,
             tokens,
         )
@@ -215,22 +399,25 @@ class text_cleaner(object):
     def remove_pos(self, line):
         """Remove pos tags only and return all lemmas"""
         tokens = line.strip().split(" ")
-        tokens = [re.sub("\[pos:.*?\]", "", t) for t in tokens]
+        tokens = [POS_TAG_PATTERN.sub("", t) for t in tokens]
         # tokens = [
         #     re.sub("\[NER:.*?\]", "", t) for t in tokens
         # ]  # remove NEs compeltely instead of using tags to replace
-        puncts_stops = set(["-lrb-", "-rrb-", "-lsb-", "-rsb-"])
         tokens = filter(
-            lambda t: t not in puncts_stops,
+            lambda t: t not in BRACKETS,
             tokens,
         )
         return " ".join(tokens)
 
     def _return_lemmas_only(self, line):
         """Remove pos tags only and return all lemmas"""
-        tokens = line.strip().split(" ")
-        tokens = [re.sub("\[pos:.*?\]", "", t) for t in tokens]
-        tokens = [re.sub("\[NER:.*?\]", "", t) for t in tokens]
+        tokens = []
+        for t in line.strip().split(" "):
+            if "[pos:" in t:
+                t = POS_TAG_PATTERN.sub("", t)
+            if "[NER:" in t:
+                t = NER_TAG_PATTERN.sub("", t)
+            tokens.append(t)
         return " ".join(tokens)
 
     def lower_case_transform(self, line):
@@ -239,32 +426,65 @@ class text_cleaner(object):
         else:
             return line
 
+    def _clean_line(self, line):
+        """Single token scan with the same output as remove_NER, remove_pos, remove_puct_num
+        and lower_case_transform applied in turn"""
+        tokens = []
+        for t in line.strip().split(" "):
+            # the NER patterns never match across whitespace, so they can be applied per token
+            if "[NER:" in t:
+                t = NER_MISC_PATTERN.sub(r"\2", t)
+                t = NER_ORDINAL_PATTERN.sub(r"\2", t)
+                t = NER_PATTERN.sub(r"\1", t)
+            if "[pos:" in t:
+                t = POS_TAG_PATTERN.sub("", t)
+            if t not in BRACKETS:
+                tokens.append(t)
+        if tokens and (
+            not tokens[0]
+            or not tokens[-1]
+            or tokens[0][0].isspace()
+            or tokens[-1][-1].isspace()
+        ):
+            # remove_puct_num strips the joined line again, which can change edge tokens
+            tokens = " ".join(tokens).strip().split(" ")
+        kept = []
+        for t in tokens:
+            if "[pos:" in t:
+                t = POS_TAG_PATTERN.sub("", t)
+            if len(t) > 1 and t not in PUNCTS_STOPS and any(c.isalpha() for c in t):
+                kept.append(t)
+        return self.lower_case_transform(" ".join(kept))
+
     def clean(self, line, id):
         """Main function that chains all filters together and applies to a string."""
-        return (
-            functools.reduce(
-                lambda obj, func: func(obj),
-                [
-                    self.remove_NER,
-                    self.remove_pos,
-                    self.remove_puct_num,
-                    self.lower_case_transform,
-                ],
-                line,
-            ),
-            "0",
-        )
+        return self._clean_line(line), "0"
 
     def return_lemmas(self, line, id):
         """Main function that chains all filters together and applies to a string."""
-        return (
-            functools.reduce(
-                lambda obj, func: func(obj),
-                [self._return_lemmas_only],
-                line,
-            ),
-            "0",
-        )
+        return self._return_lemmas_only(line), "0"
+
+    def clean_lines(self, lines):
+        """Batch version of clean
+
+        Arguments:
+            lines {[str]} -- text processed by the preprocessor
+
+        Returns:
+            [str] -- cleaned lines
+        """
+        return [self._clean_line(line) for line in lines]
+
+    def return_lemmas_lines(self, lines):
+        """Batch version of return_lemmas
+
+        Arguments:
+            lines {[str]} -- text processed by the preprocessor
+
+        Returns:
+            [str] -- lemmas of the lines
+        """
+        return [self._return_lemmas_only(line) for line in lines]
 
 
 if __name__ == "__main__":
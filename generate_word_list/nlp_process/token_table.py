@@ -0,0 +1,329 @@
+"""read-only token -> count table in memory-mapped files, shared by worker processes without pickling its content
+"""
+import collections
+import hashlib
+import json
+import mmap
+import os
+from multiprocessing import Pool
+from pathlib import Path
+
+import file_util
+import global_options
+import numpy as np
+
+MAX_WORDS_IN_DOC = 10000  # LineSentence splits longer lines into documents of this size
+
+
+def token_hash(token):
+    """Stable 64-bit hash of a token (the same in every process and run)
+
+    Arguments:
+        token {str} -- a token
+
+    Returns:
+        int -- unsigned 64-bit hash
+    """
+    return int.from_bytes(
+        hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "little"
+    )
+
+
+class token_table(object):
+    """A read-only map from tokens to counts
+
+    Files:
+        {path}.hashes.npy -- sorted token_hash of the tokens (uint64)
+        {path}.counts.npy -- count of each token (int64)
+        {path}.offsets.npy -- start of each token in {path}.tokens, plus the end of the last (int64)
+        {path}.tokens -- utf-8 tokens, in the order of the hashes
+
+    A lookup is a binary search of the hash, verified against the stored token, so hash
+    collisions are handled. The files are opened lazily with mmap, so the OS page cache
+    holds a single copy for all processes, and the table is pickled by path.
+    """
+
+    def __init__(self, path):
+        """
+        Arguments:
+            path {str or Path} -- path of the table files without extension
+        """
+        self.path = str(path)
+        self._hashes = None
+        self._counts = None
+        self._offsets = None
+        self._tokens = None
+
+    def _open(self):
+        self._hashes = np.load(self.path + ".hashes.npy", mmap_mode="r")
+        self._counts = np.load(self.path + ".counts.npy", mmap_mode="r")
+        self._offsets = np.load(self.path + ".offsets.npy", mmap_mode="r")
+        if os.path.getsize(self.path + ".tokens") > 0:
+            with open(self.path + ".tokens", "rb") as f:
+                self._tokens = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            self._tokens = b""
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def _index(self, token):
+        """Position of a token in the table, -1 if the token is not in the table"""
+        if self._hashes is None:
+            self._open()
+        token_hash_ = np.uint64(token_hash(token))
+        token_bytes = token.encode("utf-8")
+        i = int(self._hashes.searchsorted(token_hash_))
+        while i < len(self._hashes) and self._hashes[i] == token_hash_:
+            if self._tokens[self._offsets[i] : self._offsets[i + 1]] == token_bytes:
+                return i
+            i += 1
+        return -1
+
+    def get(self, token, default=None):
+        i = self._index(token)
+        if i < 0:
+            return default
+        return int(self._counts[i])
+
+    def __getitem__(self, token):
+        i = self._index(token)
+        if i < 0:
+            raise KeyError(token)
+        return int(self._counts[i])
+
+    def __contains__(self, token):
+        return self._index(token) >= 0
+
+    def __len__(self):
+        if self._hashes is None:
+            self._open()
+        return len(self._hashes)
+
+    def items(self):
+        """Yield (token, count) pairs, in hash order"""
+        if self._hashes is None:
+            self._open()
+        for i in range(len(self._hashes)):
+            yield (
+                self._tokens[self._offsets[i] : self._offsets[i + 1]].decode("utf-8"),
+                int(self._counts[i]),
+            )
+
+
+def _replace_file(file_name, write):
+    with open(file_name + ".tmp", "wb") as f:
+        write(f)
+    os.replace(file_name + ".tmp", file_name)
+
+
+def build_token_table(path, counts):
+    """Write a token_table
+
+    Arguments:
+        path {str or Path} -- path of the table files without extension
+        counts {mapping} -- token -> count, e.g. a collections.Counter
+
+    Returns:
+        token_table -- the table
+    """
+    path = str(path)
+    tokens = list(counts.keys())
+    hashes = np.fromiter(
+        (token_hash(t) for t in tokens), dtype=np.uint64, count=len(tokens)
+    )
+    order = np.argsort(hashes, kind="stable")
+    token_bytes = [tokens[i].encode("utf-8") for i in order]
+    offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in token_bytes], out=offsets[1:])
+    # write new files and replace the old ones, so that processes that still map an old
+    # table of the same path keep reading it
+    _replace_file(path + ".hashes.npy", lambda f: np.save(f, hashes[order]))
+    _replace_file(
+        path + ".counts.npy",
+        lambda f: np.save(
+            f,
+            np.fromiter(
+                (counts[tokens[i]] for i in order), dtype=np.int64, count=len(tokens)
+            ),
+        ),
+    )
+    _replace_file(path + ".offsets.npy", lambda f: np.save(f, offsets))
+    _replace_file(path + ".tokens", lambda f: f.write(b"".join(token_bytes)))
+    return token_table(path)
+
+
+def count_lines_document_frequency(lines, phrases_only=False):
+    """Document frequency of the tokens in lines of a corpus (documents as in LineSentence)
+
+    Arguments:
+        lines {iterable of str} -- lines of a corpus, each line is a sentence
+
+    Keyword Arguments:
+        phrases_only {bool} -- only count tokens with "_" (default: {False})
+
+    Returns:
+        collections.Counter -- token -> number of documents with the token
+    """
+    dfs = collections.Counter()
+    for line in lines:
+        tokens = line.split()
+        for i in range(0, len(tokens), MAX_WORDS_IN_DOC):
+            doc_tokens = tokens[i : i + MAX_WORDS_IN_DOC]
+            if phrases_only:
+                dfs.update({t for t in doc_tokens if "_" in t})
+            else:
+                dfs.update(set(doc_tokens))
+    return dfs
+
+
+def _count_shard(in_file, start, end, phrases_only):
+    """Document frequency of the tokens in a byte range of a corpus file"""
+    return count_lines_document_frequency(
+        (
+            line.decode("utf-8")
+            for line in file_util.read_file_shard(in_file, start, end)
+        ),
+        phrases_only,
+    )
+
+
+def count_document_frequency(in_file, phrases_only=False, n_workers=None):
+    """Count the document frequency of the tokens in a corpus file in parallel
+    (map: count byte ranges of the file in a Pool; reduce: sum the counts).
+    Same counts as the dfs of gensim Dictionary(LineSentence(in_file)).
+
+    Arguments:
+        in_file {str or Path} -- corpus, each line is a sentence
+
+    Keyword Arguments:
+        phrases_only {bool} -- only count tokens with "_" (default: {False})
+        n_workers {int} -- number of processes (default: {None}, N_CORES)
+
+    Returns:
+        collections.Counter -- token -> number of documents with the token
+    """
+    n_workers = n_workers or global_options.N_CORES
+    dfs = collections.Counter()
+    with Pool(n_workers) as pool:
+        for shard_dfs in pool.starmap(
+            _count_shard,
+            [
+                (str(in_file), start, end, phrases_only)
+                for start, end in file_util.file_shards(in_file, n_workers * 4)
+            ],
+        ):
+            dfs.update(shard_dfs)
+    return dfs
+
+
+def document_frequency_path(corpus_file):
+    """Path (without extension) of the document-frequency table of a corpus file, next to it:
+    e.g. trigram/documents.txt -> trigram/documents.dfs.*
+
+    Arguments:
+        corpus_file {str or Path} -- corpus, each line is a sentence
+
+    Returns:
+        str -- path of the table files without extension
+    """
+    return str(Path(corpus_file).with_suffix(".dfs"))
+
+
+def write_document_frequency(corpus_file, dfs=None, n_workers=None):
+    """Write the document-frequency table of a corpus file, next to it (see
+    document_frequency_path), with a meta file recording the corpus it was counted from
+
+    Arguments:
+        corpus_file {str or Path} -- corpus, each line is a sentence
+
+    Keyword Arguments:
+        dfs {mapping} -- token -> number of documents, if counted while writing the corpus (default: {None}, count_document_frequency)
+        n_workers {int} -- number of processes to count with (default: {None}, N_CORES)
+
+    Returns:
+        token_table -- the table
+    """
+    path = document_frequency_path(corpus_file)
+    if os.path.exists(path + ".meta.json"):
+        # the meta file marks a complete table
+        os.remove(path + ".meta.json")
+    if dfs is None:
+        dfs = count_document_frequency(corpus_file, n_workers=n_workers)
+    table = build_token_table(path, dfs)
+    _write_meta(path, corpus_file, len(dfs))
+    return table
+
+
+def _write_meta(path, corpus_file, n_tokens, increments=[]):
+    source_stat = os.stat(str(corpus_file))
+    with open(path + ".meta.json.tmp", "w") as f:
+        json.dump(
+            {
+                "source": str(corpus_file),
+                "source_size": source_stat.st_size,
+                "source_mtime_ns": source_stat.st_mtime_ns,
+                "n_tokens": n_tokens,
+                "increments": increments,
+            },
+            f,
+            indent=2,
+        )
+    os.replace(path + ".meta.json.tmp", path + ".meta.json")
+
+
+def add_document_frequency(corpus_file, increment_file, path=None):
+    """Add the document frequency of an increment (a corpus of new documents, e.g. of
+    clean_and_train.incremental_update) to the table of corpus_file, so that the table counts
+    the documents of both corpora. The increments added are listed in the meta file.
+
+    Arguments:
+        corpus_file {str or Path} -- corpus, each line is a sentence
+        increment_file {str or Path} -- corpus of the new documents
+
+    Keyword Arguments:
+        path {str or Path} -- write the table here instead of in place (without extension), e.g. to replace the table only once an update finishes (default: {None}, document_frequency_path(corpus_file))
+
+    Returns:
+        token_table -- the table
+    """
+    table = load_document_frequency(corpus_file)
+    with open(document_frequency_path(corpus_file) + ".meta.json") as f:
+        increments = json.load(f).get("increments", [])
+    dfs = collections.Counter(dict(table.items()))
+    if str(increment_file) not in increments:
+        dfs.update(dict(load_document_frequency(increment_file).items()))
+        increments = increments + [str(increment_file)]
+    path = str(path or document_frequency_path(corpus_file))
+    if os.path.exists(path + ".meta.json"):
+        os.remove(path + ".meta.json")
+    table = build_token_table(path, dfs)
+    _write_meta(path, corpus_file, len(dfs), increments)
+    return table
+
+
+def load_document_frequency(corpus_file):
+    """Return the document-frequency table of a corpus file (same counts as the dfs of gensim
+    Dictionary(LineSentence(corpus_file)), plus the increments added with
+    add_document_frequency), counting it if it is missing or older than the corpus
+
+    Arguments:
+        corpus_file {str or Path} -- corpus, each line is a sentence
+
+    Returns:
+        token_table -- the table
+    """
+    path = document_frequency_path(corpus_file)
+    if os.path.exists(path + ".meta.json"):
+        with open(path + ".meta.json") as f:
+            meta = json.load(f)
+        source_stat = os.stat(str(corpus_file))
+        if (
+            meta["source_size"] == source_stat.st_size
+            and meta["source_mtime_ns"] == source_stat.st_mtime_ns
+        ):
+            return token_table(path)
+    return write_document_frequency(corpus_file)
@@ -0,0 +1,307 @@
+"""approximate nearest-neighbor index (IVF) of word vectors in memory-mapped files, for repeated most_similar queries
+"""
+import json
+import os
+
+import numpy as np
+
+from generate_word_list.nlp_process import keyed_vectors
+
+
+def most_similar_batch(vectors, positives, topn, block_size=65536):
+    """Exact most_similar for many seed lists at once, with one blocked matrix multiply: the
+    unit vectors are multiplied by the matrix of query vectors block by block, keeping the best
+    rows of each query
+
+    Arguments:
+        vectors {np.ndarray} -- unit word vectors, e.g. keyed_vectors.vectors_norm
+        positives {[[int]]} -- row of each seed word, for each query
+        topn {int} -- number of rows to return per query
+
+    Keyword Arguments:
+        block_size {int} -- number of rows multiplied at a time (default: {65536})
+
+    Returns:
+        [(np.ndarray, np.ndarray)] -- rows and cosine similarities of each query, most similar
+        first, excluding its seed words (as KeyedVectors.most_similar)
+    """
+    queries = np.array([np.asarray(vectors[rows]).mean(axis=0) for rows in positives])
+    queries = (queries / np.linalg.norm(queries, axis=1)[:, np.newaxis]).astype(
+        np.float32
+    )
+    n_best = min(len(vectors), topn + max(len(rows) for rows in positives))
+    best_rows = np.empty((0, len(queries)), dtype=np.int64)
+    best_sims = np.empty((0, len(queries)), dtype=np.float32)
+    for start in range(0, len(vectors), block_size):
+        sims = np.concatenate(
+            [
+                best_sims,
+                np.dot(np.asarray(vectors[start : start + block_size]), queries.T),
+            ]
+        )
+        rows = np.concatenate(
+            [
+                best_rows,
+                np.broadcast_to(
+                    np.arange(start, start + len(sims) - len(best_sims))[:, np.newaxis],
+                    (len(sims) - len(best_sims), len(queries)),
+                ),
+            ]
+        )
+        if len(sims) > n_best:
+            keep = np.argpartition(-sims, n_best - 1, axis=0)[:n_best]
+            sims = np.take_along_axis(sims, keep, axis=0)
+            rows = np.take_along_axis(rows, keep, axis=0)
+        best_sims, best_rows = sims, rows
+    results = []
+    for j, seed_rows in enumerate(positives):
+        order = np.argsort(-best_sims[:, j], kind="stable")
+        keep = order[~np.isin(best_rows[order, j], seed_rows)][:topn]
+        results.append((best_rows[keep, j], best_sims[keep, j]))
+    return results
+
+
+def _nearest_centroids(vectors, centroids, block_size=65536):
+    """Index of the most similar centroid of each row, in blocks of rows"""
+    assignments = np.empty(len(vectors), dtype=np.int64)
+    for i in range(0, len(vectors), block_size):
+        assignments[i : i + block_size] = np.argmax(
+            np.dot(np.nan_to_num(vectors[i : i + block_size]), centroids.T), axis=1
+        )
+    return assignments
+
+
+def _train_centroids(vectors, n_lists, n_iter, sample_size, seed):
+    """Spherical k-means on a sample of the (unit) vectors"""
+    random_state = np.random.RandomState(seed)
+    sample = np.nan_to_num(
+        vectors[
+            np.sort(
+                random_state.choice(
+                    len(vectors), min(len(vectors), sample_size), replace=False
+                )
+            )
+        ]
+    )
+    centroids = sample[random_state.choice(len(sample), n_lists, replace=False)]
+    for _ in range(n_iter):
+        assignments = _nearest_centroids(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assignments, sample)
+        norms = np.linalg.norm(sums, axis=1)
+        empty = norms == 0
+        # restart empty lists from random vectors
+        sums[empty] = sample[random_state.choice(len(sample), int(empty.sum()))]
+        norms[empty] = np.linalg.norm(sums[empty], axis=1)
+        centroids = (sums / np.maximum(norms, 1e-12)[:, np.newaxis]).astype(np.float32)
+    return centroids
+
+
+def build_vector_index(model_path, n_lists=None, n_iter=10, sample_size=None, seed=0):
+    """Build the vector_index of a word2vec model, next to the model ({model_path}.index.*)
+
+    The unit vectors are clustered into n_lists lists (inverted file, IVF) with spherical
+    k-means. Each vector is quantized to int8 (one scale per dimension) and stored ordered by
+    list, for coarse scoring of the candidates; the exact scores are read from the unit vectors
+    of the keyed_vectors of the model.
+
+    Arguments:
+        model_path {str or Path} -- path of the word2vec model
+
+    Keyword Arguments:
+        n_lists {int} -- number of lists (default: {None}, 4 * sqrt(vocab size))
+        n_iter {int} -- number of k-means iterations (default: {10})
+        sample_size {int} -- number of vectors to train k-means on (default: {None}, 64 per list)
+        seed {int} -- random seed of k-means (default: {0})
+
+    Returns:
+        vector_index -- the index
+    """
+    path = str(model_path) + ".index"
+    # the meta file marks a complete index; vectors.npy is left by older versions
+    for suffix in [".meta.json", ".vectors.npy"]:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    vectors = keyed_vectors.load_keyed_vectors(model_path).vectors_norm
+    n_lists = min(len(vectors), n_lists or max(1, int(4 * np.sqrt(len(vectors)))))
+    centroids = _train_centroids(
+        vectors, n_lists, n_iter, sample_size or n_lists * 64, seed
+    )
+    assignments = _nearest_centroids(vectors, centroids)
+    row_ids = np.argsort(assignments, kind="stable")
+    list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+    np.cumsum(np.bincount(assignments, minlength=n_lists), out=list_offsets[1:])
+    scale = np.maximum(np.abs(np.nan_to_num(vectors)).max(axis=0), 1e-12) / 127
+    codes = np.round(np.nan_to_num(vectors[row_ids]) / scale).astype(np.int8)
+
+    np.save(path + ".codes.npy", codes)
+    np.save(path + ".scale.npy", scale.astype(np.float32))
+    np.save(path + ".centroids.npy", centroids)
+    np.save(path + ".list_offsets.npy", list_offsets)
+    np.save(path + ".row_ids.npy", row_ids)
+    model_stat = os.stat(str(model_path))
+    with open(path + ".meta.json", "w") as f:
+        json.dump(
+            {
+                "model_size": model_stat.st_size,
+                "model_mtime_ns": model_stat.st_mtime_ns,
+                "n_vectors": len(vectors),
+                "n_lists": n_lists,
+            },
+            f,
+            indent=2,
+        )
+    return vector_index(model_path)
+
+
+def load_vector_index(model_path):
+    """Return the vector_index of a word2vec model, building it if it is missing or older than
+    the model
+
+    Arguments:
+        model_path {str or Path} -- path of the word2vec model
+
+    Returns:
+        vector_index -- the index
+    """
+    meta_file = str(model_path) + ".index.meta.json"
+    if os.path.exists(meta_file):
+        with open(meta_file) as f:
+            meta = json.load(f)
+        model_stat = os.stat(str(model_path))
+        if (
+            meta["model_size"] == model_stat.st_size
+            and meta["model_mtime_ns"] == model_stat.st_mtime_ns
+        ):
+            return vector_index(model_path)
+    return build_vector_index(model_path)
+
+
+class vector_index(object):
+    """IVF index of the unit word vectors of a word2vec model
+
+    Files ({model_path}.index.*):
+        codes.npy -- unit vectors quantized to int8 (vectors ~ codes * scale), ordered by list
+        scale.npy -- quantization scale of each dimension
+        centroids.npy -- unit centroid of each list
+        list_offsets.npy -- start of each list in codes, plus the end of the last
+        row_ids.npy -- row of each vector in the keyed_vectors of the model (which map rows to words)
+        meta.json -- model file the index was built from, and sizes
+
+    The arrays are opened lazily with mmap, so processes share one copy in the page cache. The
+    exact (float32) unit vectors are not copied: they are read from keyed_vectors.vectors_norm.
+    """
+
+    def __init__(self, model_path):
+        """
+        Arguments:
+            model_path {str or Path} -- path of the word2vec model
+        """
+        self.path = str(model_path) + ".index"
+        self.keyed_vectors = keyed_vectors.keyed_vectors(model_path)
+        with open(self.path + ".meta.json") as f:
+            self.meta = json.load(f)
+        self._codes = None
+
+    def __getstate__(self):
+        return {"path": self.path[: -len(".index")]}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def __len__(self):
+        return self.meta["n_vectors"]
+
+    def _open(self):
+        self._codes = np.load(self.path + ".codes.npy", mmap_mode="r")
+        self._scale = np.load(self.path + ".scale.npy")
+        self._centroids = np.load(self.path + ".centroids.npy")
+        self._list_offsets = np.load(self.path + ".list_offsets.npy")
+        self._row_ids = np.load(self.path + ".row_ids.npy")
+        self._word_rows = np.empty(len(self._row_ids), dtype=np.int64)
+        self._word_rows[self._row_ids] = np.arange(len(self._row_ids))
+
+    def _query(self, positive):
+        """Unit mean of the unit vectors of the words (as KeyedVectors.most_similar)"""
+        if self._codes is None:
+            self._open()
+        if isinstance(positive, str):
+            positive = [positive]
+        rows = []
+        for word in positive:
+            i = self.keyed_vectors.index(word)
+            if i < 0:
+                raise KeyError("word '%s' not in vocabulary" % word)
+            rows.append(self._word_rows[i])
+        mean = np.asarray(self.keyed_vectors.vectors_norm[self._row_ids[rows]]).mean(
+            axis=0
+        )
+        return (mean / np.linalg.norm(mean)).astype(np.float32), set(rows)
+
+    def _results(self, rows, sims, exclude_rows, topn):
+        order = np.argsort(-sims, kind="stable")
+        results = []
+        for i in order:
+            if rows[i] in exclude_rows:
+                continue
+            results.append(
+                (self.keyed_vectors.word(self._row_ids[rows[i]]), float(sims[i]))
+            )
+            if len(results) == topn:
+                break
+        return results
+
+    def most_similar(self, positive, topn=10, nprobe=None, exact_rerank=True):
+        """Approximate KeyedVectors.most_similar(positive, topn): words most similar to the mean of
+        the (unit) vectors of positive, excluding the words in positive
+
+        Arguments:
+            positive {str or [str]} -- seed words
+
+        Keyword Arguments:
+            topn {int} -- number of words (default: {10})
+            nprobe {int} -- number of lists to search (default: {None}, 1/10 of the lists)
+            exact_rerank {bool} -- rerank the best candidates by the exact similarity, otherwise return the int8 scores (default: {True})
+
+        Returns:
+            [(str, float)] -- words and cosine similarities, most similar first
+        """
+        query, exclude_rows = self._query(positive)
+        nprobe = min(self.meta["n_lists"], nprobe or max(1, self.meta["n_lists"] // 10))
+        probe = np.argpartition(-np.dot(self._centroids, query), nprobe - 1)[:nprobe]
+        rows = np.concatenate(
+            [np.arange(self._list_offsets[i], self._list_offsets[i + 1]) for i in probe]
+        )
+        if len(rows) == 0:
+            # all the probed lists are empty
+            return []
+        sims = np.dot(
+            np.asarray(self._codes[rows], dtype=np.float32), query * self._scale
+        )
+        if exact_rerank:
+            n_candidates = min(len(rows), 4 * topn + len(exclude_rows))
+            best = np.argpartition(-sims, n_candidates - 1)[:n_candidates]
+            # read the exact vectors in the order of the keyed_vectors rows
+            rows = rows[best][np.argsort(self._row_ids[rows[best]])]
+            sims = np.dot(
+                np.asarray(self.keyed_vectors.vectors_norm[self._row_ids[rows]]), query
+            )
+        return self._results(rows, sims, exclude_rows, topn)
+
+    def brute_force_most_similar(self, positive, topn=10):
+        """Exact most_similar, by scanning all vectors"""
+        query, exclude_rows = self._query(positive)
+        sims = np.dot(self.keyed_vectors.vectors_norm, query)
+        n_best = min(len(sims), topn + len(exclude_rows))
+        best = np.argpartition(-sims, n_best - 1)[:n_best]
+        return self._results(self._word_rows[best], sims[best], exclude_rows, topn)
+
+    def recall(self, positive, topn=10, **kwargs):
+        """Share of the exact topn words that most_similar(positive, topn, **kwargs) finds
+
+        Returns:
+            float -- recall at topn
+        """
+        exact = {word for word, _ in self.brute_force_most_similar(positive, topn)}
+        found = {word for word, _ in self.most_similar(positive, topn, **kwargs)}
+        return len(exact & found) / max(len(exact), 1)
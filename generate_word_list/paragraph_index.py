@@ -0,0 +1,422 @@
+"""inverted index of the consolidated paragraphs (all_transcripts_parsed.csv.gz), for keyword-in-context lookups without scanning the corpus
+"""
+import argparse
+import collections
+import json
+import os
+import zlib
+from pathlib import Path
+
+import global_options
+import numpy as np
+import pandas as pd
+
+from generate_word_list.nlp_process import token_table
+
+DOC_BLOCK_SIZE = 256  # number of paragraphs in a compressed block of the doc store
+POSTINGS_BLOCK_SIZE = 65536  # max number of postings in a compressed block
+
+
+def _encode_postings(rows, tfs):
+    """Compressed blocks of a postings list: row deltas then term frequencies (uint32)"""
+    blobs = []
+    for i in range(0, len(rows), POSTINGS_BLOCK_SIZE):
+        block_rows = rows[i : i + POSTINGS_BLOCK_SIZE]
+        deltas = np.diff(block_rows, prepend=rows[i - 1] if i > 0 else 0)
+        blob = zlib.compress(
+            deltas.astype("<u4").tobytes()
+            + tfs[i : i + POSTINGS_BLOCK_SIZE].astype("<u4").tobytes(),
+            6,
+        )
+        blobs.append(len(blob).to_bytes(4, "little") + blob)
+    return b"".join(blobs)
+
+
+def _decode_postings(data):
+    rows, tfs = [], []
+    last_row = 0
+    offset = 0
+    while offset < len(data):
+        length = int.from_bytes(data[offset : offset + 4], "little")
+        values = np.frombuffer(
+            zlib.decompress(data[offset + 4 : offset + 4 + length]), dtype="<u4"
+        )
+        block_rows = np.cumsum(values[: len(values) // 2], dtype=np.int64) + last_row
+        rows.append(block_rows)
+        tfs.append(values[len(values) // 2 :].astype(np.int64))
+        last_row = block_rows[-1]
+        offset += 4 + length
+    if not rows:
+        return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    return np.concatenate(rows), np.concatenate(tfs)
+
+
+def _write_doc_block(f, records, doc_offsets):
+    blob = zlib.compress("\n".join(json.dumps(r) for r in records).encode("utf-8"), 6)
+    f.write(blob)
+    doc_offsets.append(doc_offsets[-1] + len(blob))
+
+
+def _tokenize(text_parsed):
+    """Tokens of the parsed text of each paragraph (lower case, split on spaces)"""
+    return text_parsed.fillna("").str.lower().str.split()
+
+
+def build_paragraph_index(in_file, path, chunk_size=100000):
+    """Index the paragraphs of the consolidated corpus
+
+    Each token and phrase of text_parsed gets the rows (paragraph number in in_file, from 0)
+    that contain it and its count in each row, delta-encoded in compressed blocks. The
+    paragraphs themselves are kept in compressed blocks of DOC_BLOCK_SIZE rows for snippets.
+
+    Arguments:
+        in_file {str or Path} -- consolidated paragraphs (output of generate_word_list.word_list)
+        path {str or Path} -- path of the index files without extension
+
+    Keyword Arguments:
+        chunk_size {int} -- number of paragraphs read at a time (default: {100000})
+
+    Returns:
+        paragraph_index -- the index
+    """
+    path = str(path)
+    Path(path).parent.mkdir(parents=True, exist_ok=True)
+    if os.path.exists(path + ".meta.json"):
+        # the meta file marks a complete index
+        os.remove(path + ".meta.json")
+    terms = {}
+    calls = {}
+    posting_terms, posting_rows, posting_tfs = [], [], []
+    call_ids = []
+    records = []
+    doc_offsets = [0]
+    n_rows = 0
+    with open(path + ".docs", "wb") as f_docs:
+        for transcripts in pd.read_csv(
+            in_file, dtype=str, keep_default_na=False, chunksize=chunk_size
+        ):
+            transcripts = transcripts.reset_index(drop=True)
+            tokens = _tokenize(transcripts["text_parsed"]).explode().dropna()
+            term_counts = (
+                pd.DataFrame({"row": tokens.index + n_rows, "term": tokens.to_numpy()})
+                .groupby(["term", "row"], sort=False)
+                .size()
+            )
+            chunk_terms = term_counts.index.get_level_values("term")
+            for term in chunk_terms.unique():
+                if term not in terms:
+                    terms[term] = len(terms)
+            posting_terms.append(chunk_terms.map(terms).to_numpy(dtype=np.int64))
+            posting_rows.append(term_counts.index.get_level_values("row").to_numpy())
+            posting_tfs.append(term_counts.to_numpy())
+
+            for call in transcripts["call_title_date"].unique():
+                if call not in calls:
+                    calls[call] = len(calls)
+            call_ids.append(
+                transcripts["call_title_date"].map(calls).to_numpy(dtype=np.int32)
+            )
+            # blocks of DOC_BLOCK_SIZE rows, across chunks
+            records.extend(
+                transcripts.drop("call_title_date", axis=1).to_dict("records")
+            )
+            while len(records) >= DOC_BLOCK_SIZE:
+                _write_doc_block(f_docs, records[:DOC_BLOCK_SIZE], doc_offsets)
+                del records[:DOC_BLOCK_SIZE]
+            n_rows += len(transcripts)
+            print(f"Indexed {n_rows} paragraphs.")
+        if records:
+            _write_doc_block(f_docs, records, doc_offsets)
+
+    posting_terms = np.concatenate(posting_terms) if posting_terms else np.empty(0)
+    posting_rows = np.concatenate(posting_rows) if posting_rows else np.empty(0)
+    posting_tfs = np.concatenate(posting_tfs) if posting_tfs else np.empty(0)
+    order = np.lexsort((posting_rows, posting_terms))
+    posting_terms = posting_terms[order]
+    posting_rows = posting_rows[order].astype(np.int64)
+    posting_tfs = posting_tfs[order].astype(np.int64)
+    del order
+    term_starts = np.searchsorted(posting_terms, np.arange(len(terms) + 1))
+    term_offsets = np.zeros(len(terms) + 1, dtype=np.int64)
+    with open(path + ".postings", "wb") as f:
+        for term_id in range(len(terms)):
+            start, end = term_starts[term_id], term_starts[term_id + 1]
+            blob = _encode_postings(posting_rows[start:end], posting_tfs[start:end])
+            f.write(blob)
+            term_offsets[term_id + 1] = term_offsets[term_id] + len(blob)
+    np.save(path + ".term_offsets.npy", term_offsets)
+    np.save(path + ".term_dfs.npy", np.diff(term_starts).astype(np.int64))
+    np.save(
+        path + ".term_counts.npy",
+        np.bincount(posting_terms.astype(np.int64), posting_tfs, len(terms)).astype(
+            np.int64
+        ),
+    )
+    token_table.build_token_table(path + ".terms", terms)
+    np.save(path + ".doc_offsets.npy", np.array(doc_offsets, dtype=np.int64))
+    np.save(
+        path + ".call_ids.npy",
+        np.concatenate(call_ids) if call_ids else np.empty(0, dtype=np.int32),
+    )
+    with open(path + ".calls.txt", "w", encoding="utf-8") as f:
+        for call in calls:
+            f.write(call + "\n")
+    source_stat = os.stat(str(in_file))
+    with open(path + ".meta.json", "w") as f:
+        json.dump(
+            {
+                "source": str(in_file),
+                "source_size": source_stat.st_size,
+                "source_mtime_ns": source_stat.st_mtime_ns,
+                "n_paragraphs": n_rows,
+                "n_terms": len(terms),
+                "n_postings": len(posting_rows),
+            },
+            f,
+            indent=2,
+        )
+    return paragraph_index(path)
+
+
+def load_paragraph_index(in_file, path):
+    """Return the paragraph_index of the consolidated corpus, building it if it is missing or
+    older than the corpus
+
+    Arguments:
+        in_file {str or Path} -- consolidated paragraphs
+        path {str or Path} -- path of the index files without extension
+
+    Returns:
+        paragraph_index -- the index
+    """
+    if os.path.exists(str(path) + ".meta.json"):
+        index = paragraph_index(path)
+        if index.is_built_from(in_file):
+            return index
+    return build_paragraph_index(in_file, path)
+
+
+class paragraph_index(object):
+    """An inverted index of paragraphs
+
+    Files:
+        {path}.terms.* -- token_table of the id of each token/phrase
+        {path}.postings -- postings of each term id: compressed blocks of row deltas and counts
+        {path}.term_offsets.npy -- start of each term in postings, plus the end of the last
+        {path}.term_dfs.npy, {path}.term_counts.npy -- number of paragraphs with each term, number of occurrences
+        {path}.docs, {path}.doc_offsets.npy -- compressed blocks of DOC_BLOCK_SIZE paragraphs (json records), and the start of each block plus the end of the last
+        {path}.call_ids.npy, {path}.calls.txt -- call of each paragraph (index in calls.txt), call_title_date of each call
+        {path}.meta.json -- corpus the index was built from, and sizes
+
+    Rows are the paragraph numbers in the corpus, from 0 (id - 1 in the output of
+    topic_model.filter_covid_paragraph). Tokens are looked up in lower case. The index is
+    opened lazily and pickled by path.
+    """
+
+    def __init__(self, path):
+        """
+        Arguments:
+            path {str or Path} -- path of the index files without extension
+        """
+        self.path = str(path)
+        with open(self.path + ".meta.json") as f:
+            self.meta = json.load(f)
+        self._terms = token_table.token_table(self.path + ".terms")
+        self._term_offsets = None
+
+    def __getstate__(self):
+        return {"path": self.path}
+
+    def __setstate__(self, state):
+        self.__init__(state["path"])
+
+    def __len__(self):
+        return self.meta["n_paragraphs"]
+
+    def is_built_from(self, in_file):
+        source_stat = os.stat(str(in_file))
+        return (
+            self.meta["source_size"] == source_stat.st_size
+            and self.meta["source_mtime_ns"] == source_stat.st_mtime_ns
+        )
+
+    def _open(self):
+        self._term_offsets = np.load(self.path + ".term_offsets.npy", mmap_mode="r")
+        self._term_dfs = np.load(self.path + ".term_dfs.npy", mmap_mode="r")
+        self._term_counts = np.load(self.path + ".term_counts.npy", mmap_mode="r")
+        self._doc_offsets = np.load(self.path + ".doc_offsets.npy", mmap_mode="r")
+        self._call_ids = np.load(self.path + ".call_ids.npy", mmap_mode="r")
+        with open(self.path + ".calls.txt", encoding="utf-8") as f:
+            self._calls = [line.rstrip("\n") for line in f]
+
+    def _term_id(self, term):
+        if self._term_offsets is None:
+            self._open()
+        return self._terms.get(term.lower(), -1)
+
+    def postings(self, term):
+        """
+        Returns:
+            (np.ndarray, np.ndarray) -- rows with the term (sorted), and its count in each row
+        """
+        term_id = self._term_id(term)
+        if term_id < 0:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+        start, end = self._term_offsets[term_id], self._term_offsets[term_id + 1]
+        with open(self.path + ".postings", "rb") as f:
+            f.seek(start)
+            return _decode_postings(f.read(end - start))
+
+    def document_frequency(self, term):
+        """
+        Returns:
+            int -- number of paragraphs with the term
+        """
+        term_id = self._term_id(term)
+        return int(self._term_dfs[term_id]) if term_id >= 0 else 0
+
+    def count(self, term):
+        """
+        Returns:
+            int -- number of occurrences of the term
+        """
+        term_id = self._term_id(term)
+        return int(self._term_counts[term_id]) if term_id >= 0 else 0
+
+    def count_words(self, words):
+        """Number of occurrences of any of the words in each paragraph (as counting the tokens of
+        text_parsed that are in words)
+
+        Arguments:
+            words {iterable of str} -- tokens or phrases
+
+        Returns:
+            np.ndarray -- count of each row
+        """
+        counts = np.zeros(len(self), dtype=np.int64)
+        for word in set(w.lower() for w in words):
+            rows, tfs = self.postings(word)
+            counts[rows] += tfs
+        return counts
+
+    def contains_words(self, words):
+        """Whether each paragraph contains any of the words (as file_util.if_contains_words on
+        text_parsed in lower case, see file_util.paragraphs_contain_words)
+
+        Arguments:
+            words {iterable of str} -- tokens or phrases
+
+        Returns:
+            np.ndarray -- bool of each row
+        """
+        return self.count_words(words) > 0
+
+    def call(self, row):
+        """
+        Returns:
+            str -- call_title_date of the paragraph
+        """
+        if self._term_offsets is None:
+            self._open()
+        return self._calls[self._call_ids[row]]
+
+    def paragraph(self, row):
+        """
+        Returns:
+            dict -- the paragraph (columns of the corpus)
+        """
+        if self._term_offsets is None:
+            self._open()
+        block = row // DOC_BLOCK_SIZE
+        with open(self.path + ".docs", "rb") as f:
+            f.seek(self._doc_offsets[block])
+            data = f.read(self._doc_offsets[block + 1] - self._doc_offsets[block])
+        record = json.loads(
+            zlib.decompress(data).decode("utf-8").split("\n")[row % DOC_BLOCK_SIZE]
+        )
+        record["call_title_date"] = self.call(row)
+        return record
+
+    def kwic(self, term, window=8, limit=20):
+        """Keyword in context: the term with the tokens around it in text_parsed
+
+        Arguments:
+            term {str} -- token or phrase
+
+        Keyword Arguments:
+            window {int} -- number of tokens on each side (default: {8})
+            limit {int} -- max number of snippets, in row order (default: {20}, None for all)
+
+        Returns:
+            [dict] -- row, call_title_date, left, keyword and right of each occurrence
+        """
+        term = term.lower()
+        snippets = []
+        rows, _ = self.postings(term)
+        for row in rows:
+            tokens = self.paragraph(int(row))["text_parsed"].lower().split()
+            for i, token in enumerate(tokens):
+                if token == term:
+                    snippets.append(
+                        {
+                            "row": int(row),
+                            "call_title_date": self.call(int(row)),
+                            "left": " ".join(tokens[max(0, i - window) : i]),
+                            "keyword": token,
+                            "right": " ".join(tokens[i + 1 : i + 1 + window]),
+                        }
+                    )
+                    if limit is not None and len(snippets) >= limit:
+                        return snippets
+        return snippets
+
+    def calls(self, term):
+        """
+        Returns:
+            collections.Counter -- number of occurrences of the term in each call
+        """
+        rows, tfs = self.postings(term)
+        if self._term_offsets is None:
+            self._open()
+        counts = collections.Counter()
+        for call_id, tf in zip(np.asarray(self._call_ids[rows]).tolist(), tfs.tolist()):
+            counts[self._calls[call_id]] += tf
+        return counts
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Build or query the inverted index of the consolidated paragraphs."
+    )
+    parser.add_argument("command", choices=["build", "query"])
+    parser.add_argument("terms", nargs="*", help="tokens or phrases to look up")
+    parser.add_argument(
+        "--window", type=int, default=8, help="tokens around each keyword"
+    )
+    parser.add_argument(
+        "--limit", type=int, default=20, help="max number of snippets per term"
+    )
+    args = parser.parse_args()
+    CORPUS = Path(
+        global_options.DATA_PATH, "text_corpra", "all_transcripts_parsed.csv.gz"
+    )
+    INDEX_PATH = Path(
+        global_options.DATA_PATH, "text_corpra", "paragraph_index", "paragraphs"
+    )
+
+    if args.command == "build":
+        index = build_paragraph_index(CORPUS, INDEX_PATH)
+        print(index.meta)
+    else:
+        index = load_paragraph_index(CORPUS, INDEX_PATH)
+        for term in args.terms:
+            term_calls = index.calls(term)
+            print(
+                f"{term}: {index.count(term)} hits in {index.document_frequency(term)} paragraphs of {len(term_calls)} calls"
+            )
+            for snippet in index.kwic(term, window=args.window, limit=args.limit):
+                print(
+                    "  [{row}] {call_title_date}: ... {left} [{keyword}] {right} ...".format(
+                        **snippet
+                    )
+                )
@@ -1,6 +1,13 @@
 import datetime
+import inspect
 import itertools
+import json
 import os
+import queue
+import re
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from multiprocessing import Pool
 from pathlib import Path
 
@@ -8,7 +15,12 @@ import file_util
 import global_options
 from stanfordnlp.server import CoreNLPClient
 
-from generate_word_list.nlp_process import preprocess
+from generate_word_list.nlp_process import (
+    annotation_archive,
+    annotation_cache,
+    corenlp_pool,
+    preprocess,
+)
 
 
 def process_line(line, lineID):
@@ -21,7 +33,9 @@ def process_line(line, lineID):
     Returns:
         str, str -- processed document with each sentence in a line,
                     sentence IDs with each in its own line: lineID_0 lineID_1 ...
+                    (empty if the line fails, as a document without sentences)
     """
+    sentences_processed, doc_sent_ids = [], []
     try:
         sentences_processed, doc_sent_ids = corpus_preprocessor.process_document(
             line, lineID
@@ -32,6 +46,321 @@ def process_line(line, lineID):
     return "\n".join(sentences_processed), "\n".join(doc_sent_ids)
 
 
+def process_lines(lines, lineIDs):
+    """Process a batch of lines with a single CoreNLP request
+
+    Arguments:
+        lines {[str]} -- documents
+        lineIDs {[str]} -- the document IDs
+
+    Returns:
+        [(str, str)] -- for each line, the same output as process_line
+    """
+    try:
+        results = corpus_preprocessor.process_documents(lines, lineIDs)
+    except Exception as e:
+        print(e)
+        print("Exception in lines: {} - {}".format(lineIDs[0], lineIDs[-1]))
+        # retry one line per request so that a single bad document does not lose the batch
+        return [process_line(line, lineID) for line, lineID in zip(lines, lineIDs)]
+    return [
+        ("\n".join(sentences_processed), "\n".join(doc_sent_ids))
+        for sentences_processed, doc_sent_ids in results
+    ]
+
+
+def _init_worker(function_name):
+    """Pool initializer: keep the processing function in each worker, so that it (and
+    everything bound in it, e.g. a Dictionary in a functools.partial) is pickled once per
+    worker instead of once per task.
+    """
+    global _worker_function
+    _worker_function = function_name
+
+
+def _apply_worker(args):
+    return _worker_function(*args)
+
+
+def _bounded(iterable, semaphore, stop):
+    """Yield from iterable, blocking until the consumer releases the semaphore (backpressure).
+    Stops once the stop event is set (the semaphore is then released to wake it up)."""
+    for item in iterable:
+        semaphore.acquire()
+        if stop.is_set():
+            return
+        yield item
+
+
+def _read_manifest(manifest_file, input_file, document_lines):
+    """Return the manifest of an earlier run on the same input file, or None if there is none"""
+    try:
+        manifest = json.loads(Path(manifest_file).read_text())
+    except (OSError, ValueError):
+        return None
+    input_stat = os.stat(str(input_file))
+    if (
+        manifest.get("input_file") != str(input_file)
+        or manifest.get("input_size") != input_stat.st_size
+        or manifest.get("input_mtime_ns") != input_stat.st_mtime_ns
+        or manifest.get("input_lines") != document_lines
+    ):
+        return None
+    return manifest
+
+
+def _write_manifest(manifest_file, manifest):
+    """Atomically replace the manifest file"""
+    tmp_file = Path(str(manifest_file) + ".tmp")
+    tmp_file.write_text(json.dumps(manifest, indent=2))
+    os.replace(str(tmp_file), str(manifest_file))
+
+
+def _remove_manifest(manifest_file):
+    """Remove the manifest of a finished run, so that a later run on the same output starts over
+    instead of resuming after the last line"""
+    if manifest_file is not None:
+        os.remove(str(manifest_file))
+
+
+def _commit_block(
+    manifest_file, manifest, line_lengths, archive, n_lines, f_out, f_index
+):
+    """Make a written block (and the annotation archive) durable, then record it in the manifest.
+
+    Arguments:
+        manifest {dict} -- lines_committed, input_offset (bytes), output sizes (bytes) etc.
+        line_lengths {deque} -- byte length of each input line that has been read
+        archive {annotation_archive} -- archive of the processed lines (can be None)
+        n_lines {int} -- number of input lines in the block
+    """
+    if archive is not None:
+        archive.sync()
+    for f in (f_out, f_index):
+        if f is not None:
+            f.flush()
+            os.fsync(f.fileno())
+    manifest["lines_committed"] += n_lines
+    manifest["input_offset"] += sum(line_lengths.popleft() for _ in range(n_lines))
+    manifest["output_size"] = f_out.tell()
+    if f_index is not None:
+        manifest["output_index_size"] = f_index.tell()
+    _write_manifest(manifest_file, manifest)
+
+
+NEWLINES = re.compile(r"\r\n|\r|\n")
+
+
+def _track_lengths(f_raw, line_lengths):
+    """Yield the lines of a binary file as open() in text mode does (universal newlines, translated
+    to "\n"), recording the byte length of each line in the file"""
+    for raw_line in f_raw:
+        line = raw_line.decode("utf-8")
+        if "\r" not in line:
+            line_lengths.append(len(raw_line))
+            yield line
+            continue
+        start = 0
+        for newline in NEWLINES.finditer(line):
+            line_lengths.append(len(line[start : newline.end()].encode("utf-8")))
+            yield line[start : newline.start()] + "\n"
+            start = newline.end()
+        if start < len(line):
+            line_lengths.append(len(line[start:].encode("utf-8")))
+            yield line[start:]
+
+
+def _write_results(
+    results_queue, output_file, output_index_file, errors, checkpoint=None
+):
+    """Background writer: append blocks of (output_line, output_line_id) until None is received.
+
+    Arguments:
+        results_queue {queue.Queue} -- blocks of processed lines, None marks the end
+        output_file {str or Path} -- processed linesentence file
+        output_index_file {str or Path} -- index file of the output (can be None)
+        errors {list} -- exceptions raised while writing are appended here
+        checkpoint {(Path, dict, deque, annotation_archive)} -- if set, (manifest_file, manifest,
+            line_lengths, archive) used to commit every block, see _commit_block
+    """
+    f_out = open(output_file, "a")
+    f_index = open(output_index_file, "a") if output_index_file is not None else None
+    try:
+        while True:
+            block = results_queue.get()
+            if block is None:
+                break
+            if errors:
+                continue  # keep draining so that the producer never blocks
+            try:
+                f_out.write("".join(output_line + "\n" for output_line, _ in block))
+                if f_index is not None:
+                    f_index.write("".join(line_id + "\n" for _, line_id in block))
+                if checkpoint is not None:
+                    _commit_block(*checkpoint, len(block), f_out, f_index)
+            except Exception as e:
+                errors.append(e)
+    finally:
+        f_out.close()
+        if f_index is not None:
+            f_index.close()
+
+
+def imap_streaming(function_name, args_iterable, max_pending, chunksize=None):
+    """Apply function_name to each tuple of arguments with one long-lived Pool.
+
+    function_name is sent to each worker once (see _init_worker). Results are yielded in input
+    order, and at most max_pending arguments are read ahead of the consumer (backpressure).
+
+    Arguments:
+        function_name {callable} -- function to apply, called as function_name(*args)
+        args_iterable {iterable} -- tuples of arguments
+        max_pending {int} -- max number of tasks submitted but not yet consumed
+
+    Keyword Arguments:
+        chunksize {int} -- number of tasks sent to a worker at once (default: {None}, derived from max_pending)
+
+    Yields:
+        results of function_name
+    """
+    if chunksize is None:
+        chunksize = max(1, min(1000, max_pending // (global_options.N_CORES * 4)))
+    in_flight = threading.Semaphore(max_pending)
+    stop = threading.Event()
+    with Pool(
+        global_options.N_CORES, initializer=_init_worker, initargs=(function_name,)
+    ) as pool:
+        try:
+            for result in pool.imap(
+                _apply_worker,
+                _bounded(args_iterable, in_flight, stop),
+                chunksize=min(chunksize, max_pending),
+            ):
+                in_flight.release()
+                yield result
+        finally:
+            # the task feeder thread of the pool may wait on the semaphore (the window is
+            # full when a task raises or the consumer stops early): wake it up and stop it,
+            # otherwise terminating the pool waits for it forever
+            stop.set()
+            for _ in range(max_pending):
+                in_flight.release()
+
+
+def _process_lines_streaming(
+    lines_and_ids,
+    output_file,
+    output_index_file,
+    function_name,
+    chunk_size,
+    checkpoint=None,
+    line_i=0,
+):
+    """Process (line, line_id) pairs with one long-lived Pool and a background writer thread.
+
+    At most chunk_size lines are in flight at once; results are handed to the writer in
+    input order, so CPU work and disk writes overlap. line_i: number of lines processed before
+    the first pair (for the progress messages).
+    """
+    results_queue = queue.Queue(maxsize=4)
+    errors = []
+    writer = threading.Thread(
+        target=_write_results,
+        args=(results_queue, output_file, output_index_file, errors, checkpoint),
+        daemon=True,
+    )
+    writer.start()
+    block = []
+    try:
+        for result in imap_streaming(function_name, lines_and_ids, chunk_size):
+            block.append(result)
+            line_i += 1
+            if len(block) == chunk_size:
+                print(datetime.datetime.now())
+                print("Processed " + str(line_i) + " lines.")
+                results_queue.put(block)
+                block = []
+                if errors:
+                    break
+        if block:
+            results_queue.put(block)
+    finally:
+        results_queue.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+
+
+def _iter_batches(lines_and_ids, batch_size):
+    """Group (line, line_id) pairs into lists of lines and lists of line ids"""
+    lines_and_ids = iter(lines_and_ids)
+    while True:
+        batch = list(itertools.islice(lines_and_ids, batch_size))
+        if not batch:
+            return
+        yield [line for line, _ in batch], [line_id for _, line_id in batch]
+
+
+def _process_lines_batched(
+    lines_and_ids,
+    output_file,
+    output_index_file,
+    function_name,
+    chunk_size,
+    batch_size,
+    max_in_flight,
+    checkpoint=None,
+    line_i=0,
+):
+    """Process (line, line_id) pairs in batches run by a thread pool.
+
+    Up to max_in_flight batches are processed concurrently (e.g. requests to a multi-threaded
+    CoreNLP server); results are written in input order by a background writer thread. line_i:
+    number of lines processed before the first pair (for the progress messages).
+    """
+    results_queue = queue.Queue(maxsize=4)
+    errors = []
+    writer = threading.Thread(
+        target=_write_results,
+        args=(results_queue, output_file, output_index_file, errors, checkpoint),
+        daemon=True,
+    )
+    writer.start()
+    block = []
+    futures = deque()
+
+    def collect(future):
+        nonlocal line_i, block
+        for result in future.result():
+            block.append(result)
+            line_i += 1
+            if len(block) == chunk_size:
+                print(datetime.datetime.now())
+                print("Processed " + str(line_i) + " lines.")
+                results_queue.put(block)
+                block = []
+
+    try:
+        with ThreadPoolExecutor(max_in_flight) as executor:
+            for lines, line_ids in _iter_batches(lines_and_ids, batch_size):
+                futures.append(executor.submit(function_name, lines, line_ids))
+                if len(futures) > 2 * max_in_flight:
+                    collect(futures.popleft())
+                if errors:
+                    break
+            while futures:
+                collect(futures.popleft())
+        if block:
+            results_queue.put(block)
+    finally:
+        for future in futures:
+            future.cancel()
+        results_queue.put(None)
+        writer.join()
+    if errors:
+        raise errors[0]
+
+
 def process_largefile(
     input_file,
     output_file,
@@ -40,6 +369,11 @@ def process_largefile(
     function_name,
     chunk_size=100,
     start_index=None,
+    streaming=False,
+    batch_size=None,
+    max_in_flight=None,
+    manifest_file=None,
+    archive=None,
 ):
     """A helper function that transforms an input file + a list of IDs of each line (documents + document_IDs) to two output files (processed documents + processed document IDs) by calling function_name on chunks of the input files. Each document can be decomposed into multiple processed documents (e.g. sentences).
     Supports parallel with Pool.
@@ -52,10 +386,52 @@ def process_largefile(
         function_name {callable} -- A function that processes a list of strings, list of ids and return a list of processed strings and ids.
         chunk_size {int} -- number of lines to process each time, increasing the default may increase performance
         start_index {int} -- line number to start from (index starts with 0)
+        streaming {bool} -- keep one Pool for the whole file and write results from a background thread, instead of a new Pool and a blocking write per chunk
+        batch_size {int} -- if set, function_name processes a list of lines and a list of ids (at most batch_size each) and returns a list of (processed string, id) tuples; batches run in threads instead of a Pool
+        max_in_flight {int} -- number of batches processed concurrently when batch_size is set (default: N_CORES)
+        manifest_file {str or Path} -- if set, every written block is committed to this manifest (with the input byte offset), and a run with the same input file resumes after the last committed line. The manifest is removed once the whole file is written. Requires streaming or batch_size.
+        archive {annotation_archive} -- archive written by function_name, made durable before each commit to the manifest (so that a resumed run has the archived paragraphs of all committed lines)
 
     Writes:
         Write the ouput_file and output_index_file
     """
+    if manifest_file is not None and not (streaming or batch_size is not None):
+        raise ValueError("manifest_file requires streaming=True or batch_size.")
+    document_lines = file_util.line_counter(input_file)
+    print(f"document_lines = {document_lines}")
+    assert document_lines == len(
+        input_file_ids
+    ), "Make sure the input file has the same number of rows as the input ID file. "
+
+    checkpoint = None
+    if manifest_file is not None:
+        manifest = None
+        if start_index is None:
+            manifest = _read_manifest(manifest_file, input_file, document_lines)
+        if manifest is not None:
+            # drop any partially written block after the last commit
+            try:
+                os.truncate(str(output_file), manifest["output_size"])
+                if output_index_file is not None:
+                    os.truncate(str(output_index_file), manifest["output_index_size"])
+                print(f"Resuming from line {manifest['lines_committed']}.")
+            except OSError:
+                manifest = None
+        if manifest is None:
+            input_stat = os.stat(str(input_file))
+            manifest = {
+                "input_file": str(input_file),
+                "input_size": input_stat.st_size,
+                "input_mtime_ns": input_stat.st_mtime_ns,
+                "input_lines": document_lines,
+                "lines_committed": 0,
+                "input_offset": 0,
+                "output_size": 0,
+                "output_index_size": 0,
+            }
+        checkpoint = (manifest_file, manifest, deque(), archive)
+        if manifest["lines_committed"] > 0:
+            start_index = manifest["lines_committed"]
     try:
         if start_index is None:
             # if start from the first line, remove existing output file
@@ -64,21 +440,57 @@ def process_largefile(
             os.remove(str(output_index_file))
     except OSError:
         pass
-    document_lines = file_util.line_counter(input_file)
-    print(f"document_lines = {document_lines}")
-    assert document_lines == len(
-        input_file_ids
-    ), "Make sure the input file has the same number of rows as the input ID file. "
 
-    with open(input_file) as f_in:
+    if checkpoint is None:
+        f_in = open(input_file)
+        lines = f_in
+    else:
+        # binary file + seek, so that a resumed run jumps straight to the committed offset
+        f_in = open(input_file, "rb")
+        f_in.seek(manifest["input_offset"])
+        lines = _track_lengths(f_in, checkpoint[2])
+    with f_in:
         line_i = 0
         # jump to index
         if start_index is not None:
-            # start at start_index line
-            for _ in range(start_index):
-                next(f_in)
             input_file_ids = input_file_ids[start_index:]
             line_i = start_index
+            if checkpoint is None:
+                # start at start_index line
+                for _ in range(start_index):
+                    next(lines)
+            elif manifest["lines_committed"] < start_index:
+                # start_index set by hand: walk to it and record its offset
+                for _ in range(start_index - manifest["lines_committed"]):
+                    next(lines)
+                    manifest["input_offset"] += checkpoint[2].popleft()
+                manifest["lines_committed"] = start_index
+        if batch_size is not None:
+            _process_lines_batched(
+                zip(lines, input_file_ids),
+                output_file,
+                output_index_file,
+                function_name,
+                chunk_size,
+                batch_size,
+                max_in_flight or global_options.N_CORES,
+                checkpoint,
+                line_i,
+            )
+            _remove_manifest(manifest_file)
+            return
+        if streaming:
+            _process_lines_streaming(
+                zip(lines, input_file_ids),
+                output_file,
+                output_index_file,
+                function_name,
+                chunk_size,
+                checkpoint,
+                line_i,
+            )
+            _remove_manifest(manifest_file)
+            return
         for next_n_lines, next_n_line_ids in zip(
             itertools.zip_longest(*[f_in] * chunk_size),
             itertools.zip_longest(*[iter(input_file_ids)] * chunk_size),
@@ -109,17 +521,46 @@ if __name__ == "__main__":
     Path(global_options.DATA_PATH, "text_corpra", "parsed").mkdir(
         parents=True, exist_ok=True
     )
-    with CoreNLPClient(
+    corenlp_options = dict(
         properties={
             "ner.applyFineGrained": "false",
             "annotators": "tokenize, ssplit, pos, lemma, ner, depparse",
+            # lines are packed into one request separated by blank lines
+            "ssplit.newlineIsSentenceBreak": "two",
         },
         memory=global_options.RAM_CORENLP,
-        threads=global_options.N_CORES,
         timeout=12000000,
         max_char_length=1000000,
-    ) as client:
-        corpus_preprocessor = preprocess.preprocessor(client)
+    )
+    if global_options.N_CORENLP_SERVERS > 1:
+        corenlp = corenlp_pool.corenlp_pool(
+            global_options.N_CORENLP_SERVERS,
+            threads=max(1, global_options.N_CORES // global_options.N_CORENLP_SERVERS),
+            **corenlp_options,
+        )
+    else:
+        corenlp = CoreNLPClient(threads=global_options.N_CORES, **corenlp_options)
+    with corenlp as client:
+        cache = None
+        if global_options.PARSE_CACHE_PATH is not None:
+            # the cached sentences depend on the CoreNLP properties and models and on the
+            # preprocess rules
+            cache = annotation_cache.annotation_cache(
+                global_options.PARSE_CACHE_PATH,
+                fingerprint=annotation_cache.fingerprint(
+                    corenlp_options["properties"],
+                    os.environ.get("CORENLP_HOME"),
+                    inspect.getsource(preprocess.preprocessor),
+                ),
+            )
+        archive = None
+        if global_options.PARSE_ARCHIVE_PATH is not None:
+            archive = annotation_archive.annotation_archive(
+                global_options.PARSE_ARCHIVE_PATH
+            )
+        corpus_preprocessor = preprocess.preprocessor(
+            client, cache=cache, archive=archive
+        )
         in_file = Path(
             global_options.DATA_PATH, "text_corpra", "input", "documents.txt"
         )
@@ -139,6 +580,16 @@ if __name__ == "__main__":
             output_file=out_file,
             input_file_ids=in_file_index,
             output_index_file=output_index_file,
-            function_name=process_line,
+            function_name=process_lines,
             chunk_size=global_options.PARSE_CHUNK_SIZE,
+            batch_size=global_options.PARSE_BATCH_SIZE,
+            max_in_flight=global_options.PARSE_MAX_IN_FLIGHT,
+            manifest_file=Path(
+                global_options.DATA_PATH, "text_corpra", "parsed", "parse_manifest.json"
+            ),
+            archive=archive,
         )
+        if cache is not None:
+            print(cache.report())
+        if archive is not None:
+            archive.close()
@@ -8,8 +8,8 @@ import pandas as pd
 from tqdm.auto import tqdm
 
 
-def prep_inputs():
-    """prep inputs documents (paragraphs) and IDs for CORENLP processing"""
+def _read_parsed_csvs():
+    """paragraphs of all parsed csv files, with the call primary id"""
     # read all csv_files
     csv_files = file_util.get_csv_files()
     # create list of QA and presentation dfs
@@ -27,7 +27,16 @@ def prep_inputs():
     all_Presentation = pd.concat(all_Presentation, axis=0, ignore_index=True)
     all_QA = pd.concat(all_QA, axis=0, ignore_index=True)
 
-    all_transcripts = pd.concat([all_QA, all_Presentation], axis=0, ignore_index=True)
+    return pd.concat([all_QA, all_Presentation], axis=0, ignore_index=True)
+
+
+def prep_inputs():
+    """prep inputs documents (paragraphs) and IDs for CORENLP processing"""
+    if file_util.parsed_dataset_exists():
+        # the call primary id (call_title_date) is read with the paragraphs
+        all_transcripts = file_util.read_parsed_dataset().drop("Title", axis=1)
+    else:
+        all_transcripts = _read_parsed_csvs()
     all_transcripts = all_transcripts.sort_values(
         ["call_title_date", "ROUND", "Paragraph"]
     )
@@ -67,6 +76,11 @@ def output_input(all_transcripts):
         all_transcripts["text"].tolist(),
         Path(global_options.DATA_PATH, "text_corpra", "input", "documents.txt"),
     )
+    # all columns of each line, so that word_list.consolidate_csvs does not need to read the csvs again
+    all_transcripts.to_csv(
+        Path(global_options.DATA_PATH, "text_corpra", "input", "document_meta.csv"),
+        index=False,
+    )
 
 
 if __name__ == "__main__":
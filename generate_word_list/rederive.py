@@ -0,0 +1,55 @@
+"""regenerate the CoreNLP outputs (parsed/documents.txt and document_sent_ids.txt) from the annotation archive written by parse, without running CoreNLP (e.g. after changing the MWE or NER rules of preprocess.preprocessor)
+"""
+import functools
+from pathlib import Path
+
+import file_util
+import global_options
+
+from generate_word_list import parse
+from generate_word_list.nlp_process import annotation_archive, preprocess
+
+archive_preprocessor = preprocess.preprocessor(None)
+
+
+def rederive_line(line, lineID, archive):
+    """Process the archived annotation of a line, same output as parse.process_line
+
+    Arguments:
+        line {str} -- a document
+        lineID {str} -- the document ID
+        archive {annotation_archive} -- archive with the annotation of the document
+
+    Returns:
+        str, str -- processed document with each sentence in a line,
+                    sentence IDs with each in its own line
+    """
+    doc_ann = archive.get(line)
+    if doc_ann is None:
+        raise KeyError("Document {} is not in the annotation archive.".format(lineID))
+    sentences_processed, doc_sent_ids = archive_preprocessor.process_annotation(
+        doc_ann, lineID
+    )
+    return "\n".join(sentences_processed), "\n".join(doc_sent_ids)
+
+
+if __name__ == "__main__":
+    archive = annotation_archive.annotation_archive(global_options.PARSE_ARCHIVE_PATH)
+    print(f"{len(archive)} documents in the annotation archive.")
+    in_file = Path(global_options.DATA_PATH, "text_corpra", "input", "documents.txt")
+    in_file_index = file_util.file_to_list(
+        Path(global_options.DATA_PATH, "text_corpra", "input", "document_ids.txt")
+    )
+    parse.process_largefile(
+        input_file=in_file,
+        output_file=Path(
+            global_options.DATA_PATH, "text_corpra", "parsed", "documents.txt"
+        ),
+        input_file_ids=in_file_index,
+        output_index_file=Path(
+            global_options.DATA_PATH, "text_corpra", "parsed", "document_sent_ids.txt"
+        ),
+        function_name=functools.partial(rederive_line, archive=archive),
+        chunk_size=200000,
+        streaming=True,
+    )
@@ -1,35 +1,83 @@
 """find covid-19 related keywords using w2v models
 """
 
+import argparse
 import csv
+import functools
+import gzip
+import itertools
 import re
 import shutil
 from pathlib import Path
 
 import file_util
-import gensim
 import global_options
+import numpy as np
 import pandas as pd
-from gensim.models import word2vec
 
 from generate_word_list import prep_coreNLP_inputs
+from generate_word_list.nlp_process import keyed_vectors, token_table, vector_index
 
+# concept names are used in file names (word_list_{concept}.csv): letters, digits, "_", "-",
+# "." and spaces, starting with a letter, digit or "_"
+CONCEPT_NAME = re.compile(r"\w[\w\-. ]*")
 
-def generate_list_single(model_path, outfile, word_dict, **kwargs):
-    # used to tally freq of words
-    w2v_mod = gensim.models.Word2Vec.load(str(model_path))
+
+def generate_list_single(
+    model_path,
+    outfile,
+    word_dict,
+    use_index=False,
+    nprobe=None,
+    exact_rerank=True,
+    check_recall=False,
+    **kwargs
+):
+    """Write the words most similar to the seed words
+
+    Keyword Arguments:
+        use_index {bool} -- query the vector_index of the model (built next to it if missing or stale) instead of scanning all vectors (default: {False})
+        nprobe {int} -- number of index lists to search (default: {None}, see vector_index.most_similar)
+        exact_rerank {bool} -- rerank the index candidates by the exact similarity (default: {True})
+        check_recall {bool} -- print the recall of the index query against the exact query (default: {False})
+    """
+    if use_index:
+        index = vector_index.load_vector_index(model_path)
+        most_similar = functools.partial(
+            index.most_similar, nprobe=nprobe, exact_rerank=exact_rerank
+        )
+        if check_recall:
+            print(
+                "Recall of the vector index: {:.3f}".format(
+                    index.recall(
+                        kwargs.get("seed_words", ["covid-19"]),
+                        topn=1000,
+                        nprobe=nprobe,
+                        exact_rerank=exact_rerank,
+                    )
+                )
+            )
+    else:
+        most_similar = keyed_vectors.load_keyed_vectors(model_path).most_similar
     word_list_details(
-        word_dict=word_dict, w2v_mod=w2v_mod, topn=1000, outfile=outfile, **kwargs
+        word_dict=word_dict,
+        most_similar=most_similar,
+        topn=1000,
+        outfile=outfile,
+        **kwargs
     )
 
 
-def word_list_details(word_dict, w2v_mod, topn, outfile, seed_words=["covid-19"]):
+def word_list_details(word_dict, most_similar, topn, outfile, seed_words=["covid-19"]):
+    """word_dict: number of sentences with each word, looked up with word_dict.get(word)
+    (e.g. token_table.load_document_frequency(corpus_file))
+    most_similar: e.g. keyed_vectors.most_similar or vector_index.most_similar"""
     all_words = []
-    for word, sim in w2v_mod.wv.most_similar(seed_words, topn=topn):
+    for word, sim in most_similar(seed_words, topn=topn):
         word_info = {}
         word_info["word"] = word
         word_info["sim"] = round(sim, 3)
-        word_info["n_sentence"] = word_dict.dfs.get(word_dict.token2id.get(word))
+        word_info["n_sentence"] = word_dict.get(word)
         all_words.append(word_info)
 
     all_words_df = pd.DataFrame(all_words)
@@ -38,75 +86,321 @@ def word_list_details(word_dict, w2v_mod, topn, outfile, seed_words=["covid-19"]
     all_words_df.to_csv(outfile, index=False)
 
 
-def consolidate_csvs():
-    """merge parsed text with raw text and meta-data and output for fitting topic models"""
-    all_transcripts = prep_coreNLP_inputs.prep_inputs()
-    documents = file_util.file_to_list(
+def check_concept_names(concepts):
+    """Raise ValueError if a concept name cannot be used in a file name (see CONCEPT_NAME)
+
+    Arguments:
+        concepts {[str]} -- concept names
+    """
+    invalid = [concept for concept in concepts if not CONCEPT_NAME.fullmatch(concept)]
+    if invalid:
+        raise ValueError(
+            "invalid concept names (letters, digits, _ - . and spaces only): {}".format(
+                invalid
+            )
+        )
+
+
+def read_concepts(concepts_file):
+    """Read the seed words of each concept
+
+    Arguments:
+        concepts_file {str or Path} -- csv with columns concept and seed_words (space-separated tokens, as in the trained corpus, e.g. "covid-19 coronavirus")
+
+    Returns:
+        {str: [str]} -- seed words of each concept, in the order of the file
+    """
+    concepts = pd.read_csv(concepts_file, dtype=str, keep_default_na=False)
+    check_concept_names(concepts["concept"])
+    duplicated = concepts["concept"][concepts["concept"].duplicated()].tolist()
+    if duplicated:
+        raise ValueError("duplicated concepts: {}".format(duplicated))
+    return {
+        concept: seed_words.split()
+        for concept, seed_words in zip(concepts["concept"], concepts["seed_words"])
+    }
+
+
+def generate_lists(
+    model_path,
+    concepts,
+    out_dir,
+    word_dict,
+    topn=1000,
+    use_index=False,
+    nprobe=None,
+    exact_rerank=True,
+    check_recall=False,
+):
+    """Write the word list of many concepts, from one pass over the word vectors (see
+    vector_index.most_similar_batch), or from queries of the vector_index of the model. The
+    model and the document frequencies are read once, instead of once per concept.
+
+    Arguments:
+        model_path {str or Path} -- path of the word2vec model
+        concepts {{str: [str]}} -- seed words of each concept (see read_concepts), names as in CONCEPT_NAME
+        out_dir {str or Path} -- the list of each concept is written to {out_dir}/word_list_{concept}.csv
+        word_dict {mapping} -- number of sentences with each word, looked up with word_dict.get(word)
+
+    Keyword Arguments:
+        topn {int} -- number of words per concept (default: {1000})
+        use_index {bool} -- query the vector_index of the model (built next to it if missing or stale) instead of scanning all vectors (default: {False})
+        nprobe {int} -- number of index lists to search (default: {None}, see vector_index.most_similar)
+        exact_rerank {bool} -- rerank the index candidates by the exact similarity (default: {True})
+        check_recall {bool} -- print the recall of the index query of each concept against the exact query (default: {False})
+    """
+    check_concept_names(concepts)
+    kv = keyed_vectors.load_keyed_vectors(model_path)
+    missing = {
+        concept: [word for word in seed_words if word not in kv]
+        for concept, seed_words in concepts.items()
+    }
+    missing = {
+        concept: seed_words for concept, seed_words in missing.items() if seed_words
+    }
+    if missing:
+        raise KeyError("seed words not in vocabulary: {}".format(missing))
+    if use_index:
+        index = vector_index.load_vector_index(model_path)
+        results = []
+        for concept, seed_words in concepts.items():
+            words_sims = index.most_similar(
+                seed_words, topn=topn, nprobe=nprobe, exact_rerank=exact_rerank
+            )
+            if check_recall:
+                print(
+                    "Recall of the vector index for {}: {:.3f}".format(
+                        concept,
+                        index.recall(
+                            seed_words,
+                            topn=topn,
+                            nprobe=nprobe,
+                            exact_rerank=exact_rerank,
+                        ),
+                    )
+                )
+            results.append(
+                (
+                    np.array(
+                        [kv.index(word) for word, _ in words_sims], dtype=np.int64
+                    ),
+                    np.array([sim for _, sim in words_sims], dtype=np.float32),
+                )
+            )
+    else:
+        results = vector_index.most_similar_batch(
+            kv.vectors_norm,
+            [
+                [kv.index(word) for word in seed_words]
+                for seed_words in concepts.values()
+            ],
+            topn,
+        )
+    # n_sentence of every word in the lists, looked up once
+    result_ids = np.unique(np.concatenate([ids for ids, _ in results]))
+    n_sentences = np.zeros(len(kv), dtype=np.int64)
+    n_sentences[result_ids] = [word_dict.get(kv.word(i)) or 0 for i in result_ids]
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+    for concept, (ids, sims) in zip(concepts, results):
+        pd.DataFrame(
+            {
+                "word": [kv.word(i) for i in ids],
+                "sim": np.round(sims.astype(float), 3),
+                "n_sentence": n_sentences[ids],
+            }
+        ).to_csv(Path(out_dir, "word_list_{}.csv".format(concept)), index=False)
+
+
+def _parsed_paragraphs(documents_file, sent_ids_file, chunk_size=1000000):
+    """Collapse the parsed sentences into paragraphs, in the order of the input documents
+
+    The sentence IDs are Paragraph_ID + "_" + sentence number, so a paragraph is a run of
+    consecutive lines with the same Paragraph_ID that starts at sentence 0. A blank ID line is
+    a paragraph without sentences. IDs are parsed with vectorized string operations on chunks
+    of lines.
+
+    Arguments:
+        documents_file {str or Path} -- processed sentences, each line is a sentence
+        sent_ids_file {str or Path} -- the sentence ID of each line in documents_file
+
+    Yields:
+        (str, str) -- Paragraph_ID ("" if the paragraph has no sentences) and its sentences joined by " "
+    """
+    run_id, run_sentences = None, []
+    with open(documents_file) as f_docs, open(sent_ids_file) as f_ids:
+        while True:
+            sentences = [l.strip() for l in itertools.islice(f_docs, chunk_size)]
+            sent_ids = pd.Series(
+                [l.strip() for l in itertools.islice(f_ids, chunk_size)], dtype=object
+            )
+            assert len(sentences) == len(
+                sent_ids
+            ), "documents and sentence IDs have different numbers of lines"
+            if len(sentences) == 0:
+                break
+            id_fields = sent_ids.str.rpartition("_")
+            paragraph_ids = id_fields[0]
+            starts = (
+                (paragraph_ids != paragraph_ids.shift(1, fill_value=run_id))
+                | (id_fields[2] == "0")
+                | (paragraph_ids == "")
+            ).to_numpy()
+            paragraph_ids = paragraph_ids.to_numpy()
+            bounds = np.flatnonzero(starts).tolist() + [len(sentences)]
+            # lines before the first start continue the paragraph of the last chunk
+            run_sentences.extend(sentences[: bounds[0]])
+            for run_start, run_end in zip(bounds, bounds[1:]):
+                if run_id is not None:
+                    yield run_id, " ".join(run_sentences)
+                run_id, run_sentences = (
+                    paragraph_ids[run_start],
+                    sentences[run_start:run_end],
+                )
+    if run_id is not None:
+        yield run_id, " ".join(run_sentences)
+
+
+def _input_paragraphs(chunk_size):
+    """The input paragraphs (rows of prep_coreNLP_inputs.prep_inputs, one per line of the CoreNLP
+    input) in chunks, read from the sidecar written by prep_coreNLP_inputs.output_input.
+    Falls back to prep_inputs() if there is no sidecar."""
+    meta_file = Path(
+        global_options.DATA_PATH, "text_corpra", "input", "document_meta.csv"
+    )
+    if meta_file.exists():
+        # read as str, so the values are written back exactly as prep_inputs wrote them
+        yield from pd.read_csv(
+            meta_file, dtype=str, keep_default_na=False, chunksize=chunk_size
+        )
+    else:
+        all_transcripts = prep_coreNLP_inputs.prep_inputs()
+        for i in range(0, len(all_transcripts), chunk_size):
+            yield all_transcripts.iloc[i : i + chunk_size]
+
+
+def consolidate_csvs(chunk_size=100000):
+    """merge parsed text with raw text and meta-data and output for fitting topic models
+
+    The input paragraphs and the parsed paragraphs are in the same order, so they are merged
+    by position (checked against Paragraph_ID) in chunks, and each chunk is appended to the
+    output.
+
+    Keyword Arguments:
+        chunk_size {int} -- number of paragraphs merged and written at a time (default: {100000})
+    """
+    parsed_paragraphs = _parsed_paragraphs(
         Path(
             global_options.DATA_PATH,
             "text_corpra",
             "processed",
             "trigram",
             "documents.txt",
-        )
-    )
-    document_sent_ids = file_util.file_to_list(
+        ),
         Path(
             global_options.DATA_PATH,
             "text_corpra",
             "parsed",
             "document_sent_ids.txt",
-        )
-    )
-    assert len(documents) == len(document_sent_ids)
-
-    parsed_doc_metas = []
-    for doc_sent_id in document_sent_ids:
-        doc_meta = {}
-        id_pattern = re.compile("(.+?)(\-\-)(Presentation|QA)(--)(\d+)_(\d+)")
-        id_fields = re.split(id_pattern, doc_sent_id)
-        doc_meta["call_title_date"] = id_fields[1]
-        doc_meta["ROUND"] = id_fields[3]
-        doc_meta["Paragraph"] = id_fields[5]
-        parsed_doc_metas.append(doc_meta)
-    parsed_doc_metas = pd.DataFrame(parsed_doc_metas)
-    parsed_doc_metas["text_parsed"] = documents
-    parsed_doc_metas = parsed_doc_metas.groupby(
-        ["call_title_date", "ROUND", "Paragraph"], as_index=False
-    ).agg({"text_parsed": " ".join})
-    parsed_doc_metas["Paragraph"] = parsed_doc_metas["Paragraph"].astype("int64")
-
-    all_transcripts = all_transcripts.merge(
-        parsed_doc_metas, how="left", on=["call_title_date", "ROUND", "Paragraph"]
+        ),
     )
-    all_transcripts.drop("Paragraph_ID", axis=1, inplace=True)
-
-    all_transcripts.to_csv(
+    with gzip.open(
         Path(global_options.DATA_PATH, "text_corpra", "all_transcripts_parsed.csv.gz"),
-        index=False,
-        quoting=csv.QUOTE_ALL,
-    )
+        "wt",
+        newline="",
+    ) as f:
+        header = True
+        for transcripts in _input_paragraphs(chunk_size):
+            parsed = pd.DataFrame(
+                list(itertools.islice(parsed_paragraphs, len(transcripts))),
+                columns=["Paragraph_ID", "text_parsed"],
+                dtype=object,
+            ).reindex(range(len(transcripts)))
+            matched = (
+                parsed["Paragraph_ID"].to_numpy()
+                == transcripts["Paragraph_ID"].to_numpy()
+            ) | (parsed["Paragraph_ID"].fillna("").to_numpy() == "")
+            if not matched.all():
+                raise ValueError(
+                    "Parsed paragraphs are not in the order of the input paragraphs: "
+                    "{} != {}".format(
+                        parsed["Paragraph_ID"].to_numpy()[~matched][0],
+                        transcripts["Paragraph_ID"].to_numpy()[~matched][0],
+                    )
+                )
+            transcripts = transcripts.drop("Paragraph_ID", axis=1)
+            transcripts["text_parsed"] = parsed["text_parsed"].to_numpy()
+            transcripts.to_csv(f, header=header, index=False, quoting=csv.QUOTE_ALL)
+            header = False
+    if next(parsed_paragraphs, None) is not None:
+        raise ValueError("There are more parsed paragraphs than input paragraphs.")
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Consolidate the parsed corpus and generate the word list."
+    )
+    parser.add_argument(
+        "--concepts",
+        metavar="CONCEPTS_FILE",
+        help="only write the word list of each concept in a csv with columns concept and seed_words (space-separated) to data/word_lists/, from the trained model, without consolidating the corpus or writing word_list.csv",
+    )
+    parser.add_argument(
+        "--use-index",
+        action="store_true",
+        help="with --concepts: query the approximate nearest-neighbor index of the w2v model instead of scanning all vectors",
+    )
+    parser.add_argument(
+        "--nprobe",
+        type=int,
+        default=None,
+        help="with --use-index: number of index lists to search (more -> higher recall, slower)",
+    )
+    parser.add_argument(
+        "--no-rerank",
+        action="store_true",
+        help="with --use-index: rank the index candidates by their quantized scores only",
+    )
+    parser.add_argument(
+        "--check-recall",
+        action="store_true",
+        help="with --use-index: compare the index query of each concept with the exact query",
+    )
+    args = parser.parse_args()
+    if not args.concepts and (
+        args.use_index or args.nprobe is not None or args.no_rerank or args.check_recall
+    ):
+        parser.error("the vector index options are used with --concepts")
     MAIN_CORPUS = Path(
         global_options.DATA_PATH, "text_corpra", "processed", "trigram", "documents.txt"
     )
 
-    consolidate_csvs()
+    if args.concepts:
+        # the concept lists only: the corpus, word_list.csv and word_list_filtered.csv are kept
+        generate_lists(
+            model_path=Path(global_options.MODEL_PATH, "w2v.mod"),
+            concepts=read_concepts(args.concepts),
+            out_dir=Path(global_options.DATA_PATH, "word_lists"),
+            # written with the corpus by clean_and_train (counted here if the corpus changed)
+            word_dict=token_table.load_document_frequency(MAIN_CORPUS),
+            use_index=args.use_index,
+            nprobe=args.nprobe,
+            exact_rerank=not args.no_rerank,
+            check_recall=args.check_recall,
+        )
+    else:
+        consolidate_csvs()
 
-    word_dict = gensim.corpora.dictionary.Dictionary(
-        documents=word2vec.LineSentence(str(MAIN_CORPUS)), prune_at=20000000
-    )
+        # written with the corpus by clean_and_train (counted here if the corpus changed)
+        word_dict = token_table.load_document_frequency(MAIN_CORPUS)
 
-    generate_list_single(
-        model_path=Path(global_options.MODEL_PATH, "w2v.mod"),
-        outfile=Path(global_options.DATA_PATH, "word_list.csv"),
-        word_dict=word_dict,
-        seed_words=["covid-19"],
-    )
+        generate_list_single(
+            model_path=Path(global_options.MODEL_PATH, "w2v.mod"),
+            outfile=Path(global_options.DATA_PATH, "word_list.csv"),
+            word_dict=word_dict,
+            seed_words=["covid-19"],
+        )
 
-    shutil.copy(
-        Path(global_options.DATA_PATH, "word_list.csv"),
-        Path(global_options.DATA_PATH, "word_list_filtered.csv"),
-    )
+        shutil.copy(
+            Path(global_options.DATA_PATH, "word_list.csv"),
+            Path(global_options.DATA_PATH, "word_list_filtered.csv"),
+        )
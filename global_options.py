@@ -8,6 +8,12 @@ MODEL_PATH = "Data/models/"
 PDF_PATH = "Data/pdfs/raw/"  # where to put raw pdf files
 PDF_PARSED_PATH = "Data/pdfs/parsed/"  # where to put parsed pdf files (in csv format)
 N_CORES = 4  # number of CPU cores to use for parsing
+PDF_TIMEOUT = 600  # seconds a single pdf (or page range) may take to parse before its worker is killed (None: no limit)
+PDF_MAX_TASKS_PER_CHILD = 200  # number of tasks (pdfs or page ranges) a worker runs before it is replaced (bounds the memory pdfminer accumulates)
+PDF_PAGES_PER_TASK = 20  # the pages of longer pdfs are extracted in parallel, in ranges of at most this many pages (None: one task per pdf)
+PDF_SPLIT_MIN_BYTES = 1000000  # only pdfs of at least this size are checked for splitting (counting pages opens the pdf)
+PDF_PARSED_DATASET = None  # e.g. "Data/pdfs/parsed_dataset/": write the parsed paragraphs to a parquet dataset partitioned by call date instead of csv files (requires pyarrow); the readers in file_util load from it
+PDF_DATASET_FLUSH_ROWS = 500000  # number of parsed paragraphs kept in memory before they are written to the dataset
 
 Path(DATA_PATH).mkdir(parents=True, exist_ok=True)
 Path(PDF_PARSED_PATH).mkdir(parents=True, exist_ok=True)
@@ -17,8 +23,15 @@ Path(MODEL_PATH).mkdir(parents=True, exist_ok=True)
 
 # ==== training word2vec model ====
 # Hardware options
-RAM_CORENLP: str = "32G"  # max RAM allocated for parsing using CoreNLP
+RAM_CORENLP: str = "32G"  # max RAM allocated for parsing using CoreNLP (per server)
+N_CORENLP_SERVERS: int = 1  # number of CoreNLP servers (ports 9000, 9001, ...); the N_CORES threads are split between them
 PARSE_CHUNK_SIZE: int = 1000  # number of lines in the input file to process uing CoreNLP at once. Increase on workstations with larger RAM (e.g. to 1000 if RAM is 64G)
+PARSE_BATCH_SIZE: int = 50  # number of lines packed into a single CoreNLP request
+PARSE_MAX_IN_FLIGHT: int = N_CORES  # number of CoreNLP requests sent concurrently
+PARSE_CACHE_PATH = str(
+    Path(DATA_PATH, "text_corpra", "annotation_cache.sqlite")
+)  # cache of parsed paragraphs reused across runs; set to None to disable
+PARSE_ARCHIVE_PATH = None  # e.g. "Data/text_corpra/parsed/annotations": keep raw CoreNLP annotations to rerun preprocess rules with generate_word_list.rederive
 
 # CoreNLP directory location
 os.environ[
@@ -28,6 +41,7 @@ os.environ[
 # Parsing and analysis options
 PHRASE_THRESHOLD: int = 10  # threshold of the phraser module (smaller -> more phrases)
 PHRASE_MIN_COUNT: int = 20  # min number of times a bigram needs to appear in the corpus to be considered as a phrase
+PHRASE_SPILL_VOCAB_SIZE = None  # e.g. 20000000: counts kept in memory by each phrase-counting process before spilling them to disk; None keeps all in memory
 W2V_DIM: int = 300  # dimension of word2vec vectors
 W2V_WINDOW: int = 5  # window size in word2vec
 W2V_ITER: int = 40  # number of iterations in word2vec
@@ -1,19 +1,166 @@
 """ 
 Parse earnings call pdf to conversations
 """
+import argparse
+import csv
+import hashlib
+import itertools
 import json
-import re
+import math
+import os
+import time
+import traceback
+from collections import namedtuple
 from functools import partial
 from io import StringIO
-from multiprocessing import Pool
 from pathlib import Path
 
 import global_options
 import pandas as pd
 import pendulum
-from bs4 import BeautifulSoup
 from pdfminer import high_level
-from pdfminer.layout import LAParams
+from pdfminer.converter import PDFPageAggregator
+from pdfminer.layout import (
+    LAParams,
+    LTChar,
+    LTCurve,
+    LTFigure,
+    LTImage,
+    LTText,
+    LTTextBox,
+    LTTextLine,
+)
+from pdfminer.pdfinterp import PDFPageInterpreter, PDFResourceManager
+from pdfminer.pdfdocument import PDFDocument
+from pdfminer.pdfpage import PDFPage
+from pdfminer.pdfparser import PDFParser
+
+from pdf2text import worker_pool
+
+# version of the parsed csvs and meta data: bump it when a change of the parser changes them, so
+# that parse_all_pdfs parses all files again
+PARSER_VERSION = 1
+
+# a run of characters in the same font in a text box, as a <span> of pdfminer's HTMLConverter:
+# font name (without subset tag), font size (truncated to int, as the px size in the html), text
+# (with the "\n" of the line ends), page number (from 1), and index of the text box in the page
+text_span = namedtuple("text_span", ["font", "size", "text", "page", "box"])
+
+
+class _span_writer(object):
+    """Collect the text spans of laid out pages, following HTMLConverter.receive_layout (layoutmode
+    "normal") without writing the html: a span starts when the (font, size) of the characters
+    changes and ends with its text box (or figure)"""
+
+    def __init__(self):
+        self.spans = []
+        self._page = None
+        self._n_boxes = 0
+        self._box = None
+        self._font = None
+        self._text = []
+        self._stack = []
+
+    def _end_span(self):
+        if self._font is not None:
+            self.spans.append(
+                text_span(
+                    self._font[0].split("+")[-1],
+                    int(self._font[1]),
+                    "".join(self._text),
+                    self._page,
+                    self._box,
+                )
+            )
+
+    def _begin_box(self):
+        self._stack.append((self._box, self._font, self._text))
+        self._box, self._font, self._text = self._n_boxes, None, []
+        self._n_boxes += 1
+
+    def _end_box(self):
+        self._end_span()
+        self._box, self._font, self._text = self._stack.pop()
+
+    def render_page(self, ltpage, page_number):
+        self._page = page_number
+        self._n_boxes = 0
+        for child in ltpage:
+            self.render(child)
+
+    def render(self, item):
+        if isinstance(item, (LTCurve, LTImage)):
+            pass
+        elif isinstance(item, LTFigure):
+            self._begin_box()
+            for child in item:
+                self.render(child)
+            self._end_box()
+        elif isinstance(item, LTTextLine):
+            for child in item:
+                self.render(child)
+        elif isinstance(item, LTTextBox):
+            self._begin_box()
+            for child in item:
+                self.render(child)
+            self._end_box()
+        elif isinstance(item, LTChar):
+            font = (item.fontname, item.size)
+            if font != self._font:
+                self._end_span()
+                self._font, self._text = font, []
+            self._text.append(item.get_text())
+        elif isinstance(item, LTText) and self._font is not None:
+            # text outside of a span (e.g. a space before the first character of a box) is not
+            # part of any span
+            self._text.append(item.get_text())
+
+
+def extract_spans(pdf_path, page_numbers=None):
+    """Lay out the pages of a pdf with pdfminer.six and return its text spans, in the order of
+    the html of pdf_to_html, without rendering and parsing the html
+
+    Pages are laid out independently, so the spans of page ranges extracted separately (e.g. in
+    parallel) and concatenated in page order are the spans of the whole pdf.
+
+    Arguments:
+        pdf_path {str or Path} -- path to the pdf file
+
+    Keyword Arguments:
+        page_numbers {iterable of int} -- zero-indexed pages to extract (default: {None}, all pages)
+
+    Returns:
+        [text_span] -- spans of the pages
+    """
+    rsrcmgr = PDFResourceManager()
+    device = PDFPageAggregator(rsrcmgr, laparams=LAParams(boxes_flow=1))
+    interpreter = PDFPageInterpreter(rsrcmgr, device)
+    writer = _span_writer()
+    if page_numbers is not None:
+        page_numbers = set(page_numbers)
+        page_indexes = iter(sorted(page_numbers))
+    else:
+        page_indexes = itertools.count()
+    with open(pdf_path, "rb") as fin:
+        # get_pages yields the pages in page_numbers in document order
+        for page_index, page in zip(
+            page_indexes,
+            PDFPage.get_pages(fin, page_numbers, check_extractable=True),
+        ):
+            interpreter.process_page(page)
+            writer.render_page(device.get_result(), page_index + 1)
+    return writer.spans
+
+
+def count_pages(pdf_path):
+    """number of pages of a pdf (without laying them out)"""
+    with open(pdf_path, "rb") as fin:
+        return sum(1 for _ in PDFPage.create_pages(PDFDocument(PDFParser(fin))))
+
+
+def same_box(span, other):
+    """whether two spans are in the same text box"""
+    return span.page == other.page and span.box == other.box
 
 
 class transcript:
@@ -21,12 +168,17 @@ class transcript:
 
     def __init__(self, pdf_path):
         self.pdf_path = Path(pdf_path)
-        self.presentation_start_marker = """<span style="font-family: Verdana-Bold; font-size:24px">Presentation
-<br></span></div>"""
-        self.QA_start_marker = """<span style="font-family: Verdana-Bold; font-size:24px">Question and Answer
-<br></span></div>"""
-        self.End_marker = """<span style="font-family: Verdana; font-size:8px">These materials have been prepared solely for information purposes based upon information generally available to the public"""
+        # (font, size, text) of the section headings: a span with exactly this text, that ends its text box
+        self.presentation_start_marker = ("Verdana-Bold", 24, "Presentation\n")
+        self.QA_start_marker = ("Verdana-Bold", 24, "Question and Answer\n")
+        # the disclaimer after the QA section: a span that starts with this text
+        self.End_marker = (
+            "Verdana",
+            8,
+            "These materials have been prepared solely for information purposes based upon information generally available to the public",
+        )
         self.call_title = self.pdf_path.stem
+        self.spans = None
         self.html = None
         self.firm_full_name, self.firm_name, self.ticker = [None] * 3
         (
@@ -42,18 +194,15 @@ class transcript:
             self.QA_contents_s,
         ) = [None] * 10
 
-    def parse(self, html_dir=None, parse_contents=True):
-        """the main parse function"""
+    def parse(self, html_dir=None, parse_contents=True, spans=None):
+        """the main parse function; spans: the spans of the pdf if they are already extracted (see extract_spans)"""
         print(f"Parsing {self.call_title}")
-        self.html = self.pdf_to_html(self.pdf_path, html_dir=html_dir)
-        soup = BeautifulSoup(self.html, features="lxml")
+        self.spans = extract_spans(self.pdf_path) if spans is None else spans
+        if html_dir is not None:
+            # for inspection only, the parser works on the spans
+            self.html = self.pdf_to_html(self.pdf_path, html_dir=html_dir)
         # parse firm name
-        self.firm_full_name = self.soup2text(
-            soup.find_all(
-                "span",
-                style=re.compile("font-family: Verdana-Bold; font-size:2[0|3]px"),
-            )
-        )
+        self.firm_full_name = self.spans2text(self.find_spans("Verdana-Bold", (20, 23)))
         firm_splited = self.firm_full_name.split()
         firm_name = []
         for token in firm_splited:
@@ -63,19 +212,9 @@ class transcript:
                 firm_name.append(token)
         self.firm_name = " ".join(firm_name)
 
-        self.call_type = self.soup2text(
-            soup.find(
-                "span",
-                style=re.compile("font-family: Verdana-Bold; font-size:(25|30)px"),
-            )
-        )
+        self.call_type = self.spans2text(self.find_spans("Verdana-Bold", (25, 30))[:1])
         # parse date
-        date_str = self.soup2text(
-            soup.find(
-                "span",
-                style=re.compile("font-family: Verdana-Bold; font-size:1[7|8]px"),
-            )
-        )
+        date_str = self.spans2text(self.find_spans("Verdana-Bold", (17, 18))[:1])
         self.time_raw = date_str
         try:
             date_parsed = pendulum.parse(
@@ -89,20 +228,18 @@ class transcript:
 
     def parse_contents(self):
         """parse the conversation contents"""
-        # spilt the html by sections
+        # spilt the spans by sections
         (
-            before_presentation_html,
-            presentation_html,
-            QA_html,
+            before_presentation_spans,
+            presentation_spans,
+            QA_spans,
         ) = self.seperate_presentation_QA()
         (
             self.call_participants,
             self.call_participants_titles,
-        ) = self.get_call_participants(before_presentation_html)
+        ) = self.get_call_participants(before_presentation_spans)
         try:
-            self.presentation_contents = self.soup2raw_content(
-                BeautifulSoup(presentation_html, features="lxml")
-            )
+            self.presentation_contents = self.spans2raw_content(presentation_spans)
             self.presentation_contents_s = self.structure_content(
                 self.presentation_contents
             )
@@ -115,9 +252,7 @@ class transcript:
             print(f"Unablet to parse presentation for {self.call_title}")
             print(e)
         try:
-            self.QA_contents = self.soup2raw_content(
-                BeautifulSoup(QA_html, features="lxml")
-            )
+            self.QA_contents = self.spans2raw_content(QA_spans)
             self.QA_contents_s = self.structure_content(self.QA_contents)
             self.QA_contents_s.insert(0, "Paragraph", range(len(self.QA_contents_s)))
             self.QA_contents_s.insert(0, "ROUND", "QA")
@@ -146,29 +281,65 @@ class transcript:
         }
         return record
 
-    def seperate_presentation_QA(self) -> "str, str":
-        """using the markers defined in the __init__ to sepearate html into presentation and QA sections (html)"""
-        before_presentation_html, presentation_html, QA_html = "", "", ""
-        if self.presentation_start_marker in self.html:
+    def find_spans(self, font, sizes):
+        """spans in a font, with one of the sizes"""
+        return [s for s in self.spans if s.font == font and s.size in sizes]
+
+    def find_markers(self, marker, whole_span=True):
+        """positions of the spans that match a marker (font, size, text): spans with exactly the
+        text that end their text box, or spans that start with the text (not whole_span)"""
+        font, size, text = marker
+        return [
+            i
+            for i, s in enumerate(self.spans)
+            if s.font == font
+            and s.size == size
+            and (
+                s.text == text
+                and (i + 1 == len(self.spans) or not same_box(s, self.spans[i + 1]))
+                if whole_span
+                else s.text.startswith(text)
+            )
+        ]
+
+    def seperate_presentation_QA(self) -> "[text_span], [text_span], [text_span]":
+        """using the markers defined in the __init__ to sepearate the spans into presentation and QA sections"""
+        before_presentation_spans, presentation_spans, QA_spans = [], [], []
+        presentation_starts = self.find_markers(self.presentation_start_marker)
+        if presentation_starts:
             # print("Presentation exists.")
-            before_presentation_html = self.html.split(self.presentation_start_marker)[
-                0
+            before_presentation_spans = self.spans[: presentation_starts[0]]
+            # a second presentation heading (if any) ends the sections
+            after_presentation_end = (presentation_starts + [len(self.spans)])[1]
+            QA_starts = [
+                i
+                for i in self.find_markers(self.QA_start_marker)
+                if presentation_starts[0] < i < after_presentation_end
             ]
-            after_presentation_html = self.html.split(self.presentation_start_marker)[1]
-            if self.QA_start_marker in self.html:
+            ends = self.find_markers(self.End_marker, whole_span=False)
+            if QA_starts:
                 # print("QA exists.")
-                presentation_html = after_presentation_html.split(self.QA_start_marker)[
-                    0
+                presentation_spans = self.spans[
+                    presentation_starts[0] + 1 : QA_starts[0]
                 ]
-                QA_html = after_presentation_html.split(self.QA_start_marker)[1].split(
-                    self.End_marker
-                )[0]
+                QA_end = min(
+                    [i for i in ends if i > QA_starts[0]]
+                    + QA_starts[1:2]
+                    + [after_presentation_end]
+                )
+                QA_spans = self.spans[QA_starts[0] + 1 : QA_end]
             else:
                 print(f"!!!!! WARNING: {self.call_title} QA does not exist!")
-                presentation_html = after_presentation_html.split(self.End_marker)[0]
+                presentation_end = min(
+                    [i for i in ends if i > presentation_starts[0]]
+                    + [after_presentation_end]
+                )
+                presentation_spans = self.spans[
+                    presentation_starts[0] + 1 : presentation_end
+                ]
         else:
             print(f"!!!!! WARNING: {self.call_title} presentation does not exist!")
-        return before_presentation_html, presentation_html, QA_html
+        return before_presentation_spans, presentation_spans, QA_spans
 
     def pdf_to_html(self, pdf_path, html_dir=None) -> "str (html)":
         """convert pdf file to html using pdfminer.six
@@ -194,32 +365,26 @@ class transcript:
         return html_result
 
     @staticmethod
-    def soup2text(find_results):
-        """return text from soup search results; handles None/find//find_all cases. If find_results is from find_all, then concat texts from all elements using whitespace."""
-        if find_results is None:
-            text = ""
-        elif find_results.__class__.__name__ == "Tag":
-            text = find_results.text.strip()
-        else:
-            text = " ".join([x.text.strip() for x in find_results])
-        return text
+    def spans2text(spans):
+        """return text from a list of spans (empty string if there is no span), concat texts from all spans using whitespace."""
+        return " ".join([x.text.strip() for x in spans])
 
     @staticmethod
-    def soup2raw_content(a_soup) -> "[type (speaker/spearker_title/text), text]":
+    def spans2raw_content(spans) -> "[type (speaker/spearker_title/text), text]":
         """initial parse of the presentation/QA section into spearkers and content
 
         Returns:
             [(str, str)]: a list of tuples - (type (speaker/spearker_title/text), text)
         """
-        content_spans = a_soup.find_all("span", style=re.compile(" font-size:10px"))
+        content_spans = [s for s in spans if s.size == 10]
         contents = []
         last_span = ""
         for s in content_spans:
-            if s["style"] == "font-family: Verdana-Bold; font-size:10px":
+            if s.font == "Verdana-Bold":
                 speaker_type = "speaker"
-            if s["style"] == "font-family: Verdana-Italic; font-size:10px":
+            if s.font == "Verdana-Italic":
                 speaker_type = "speaker_title"
-            if s["style"] == "font-family: Verdana; font-size:10px":
+            if s.font == "Verdana":
                 speaker_type = "text"
             span_text = s.text.strip()
             if " | " not in span_text and span_text.upper() != span_text:
@@ -284,8 +449,8 @@ class transcript:
                 contents_structured.append(paragraph)
         return pd.DataFrame.from_dict(contents_structured)
 
-    def get_call_participants(self, before_presentation_html) -> "[str]":
-        """get a list of call participants from html
+    def get_call_participants(self, before_presentation_spans) -> "[str]":
+        """get a list of call participants from the spans before the presentation
 
         Returns : {str : [str]}, {str: str}
         (example):
@@ -294,16 +459,15 @@ class transcript:
             call_participants_titles: {'Alberto Zanata': 'Executive VP & Head of Professional Products', 'Carlo Caroni': '', 'Fabio Zarpellon': 'Chief Financial Officer of Electrolux Professional Products', 'Jacob Broberg': 'Senior VP of Investor Relations and Corporate Communication at Electrolux Professional AB', 'Philippe Zavattiero': 'Senior VP & GM for Europe - Electrolux Professional AG', 'Torsten Urban': 'Senior Vice President of Product & Marketing at Electrolux AB (publ)', 'Björn Enarson': 'Danske Bank Markets Equity Research', 'Erik Paulsson': 'Pareto Securities, Research Division', 'Johan Eliason': 'Kepler Cheuvreux, Research Division'}
         """
         # call participants
-        participant_spans = BeautifulSoup(
-            before_presentation_html, features="lxml"
-        ).find_all("span", style=re.compile("font-size:10px"))
         call_participants_raw = []
         call_participants = {}
         call_participants_titles = {}
         PARTICIPANTS_TYPES = ["EXECUTIVES", "ANALYSTS", "ATTENDEES"]
         START_ADD_FLAG = 0
         span_text = ""
-        for span in participant_spans:
+        for i, span in enumerate(before_presentation_spans):
+            if span.size != 10:
+                continue
             span_text = span.text.strip()
             if span_text == "EXECUTIVES":
                 START_ADD_FLAG = 1
@@ -311,7 +475,7 @@ class transcript:
                 START_ADD_FLAG = 0
             if START_ADD_FLAG:
                 call_participants_raw.append(span_text.replace("\n", " "))
-                if span["style"] == "font-family: Verdana-Bold; font-size:10px":
+                if span.font == "Verdana-Bold":
                     if span_text in PARTICIPANTS_TYPES:
                         call_participants[span_text] = []
                         PARTICIPANTS_TYPES.remove(span_text)
@@ -319,16 +483,14 @@ class transcript:
                     else:
                         name = span_text.replace("\n", " ")
                         title = ""
-                        for sib in span.next_siblings:
-                            if (
-                                sib["style"]
-                                == "font-family: Verdana-Italic; font-size:10px"
-                            ):
+                        # the next spans in the text box of the name
+                        for sib in itertools.takewhile(
+                            lambda sib: same_box(sib, span),
+                            before_presentation_spans[i + 1 :],
+                        ):
+                            if sib.font == "Verdana-Italic" and sib.size == 10:
                                 title = sib.text.strip().replace("\n", " ")
-                            if (
-                                sib["style"]
-                                == "font-family: Verdana-Bold; font-size:10px"
-                            ):
+                            if sib.font == "Verdana-Bold" and sib.size == 10:
                                 title = ""
                                 break
                         call_participants[TYPE].append(name)
@@ -336,21 +498,32 @@ class transcript:
         return call_participants, call_participants_titles
 
 
-def parse_single_pdf(pdf_path, out_dir, write_content=True, HTML_DIR=None):
+def parse_single_pdf(
+    pdf_path,
+    out_dir,
+    write_content=True,
+    HTML_DIR=None,
+    return_outputs=False,
+    spans=None,
+):
     """parse single pdf and save conversation to csv file
 
     Args:
         pdf_path (str/path): path to the pdf file
         out_dir (str/pth): folder to save results, creates 2 sub-folders QA/presentations automatically
+        return_outputs (bool, optional): also return the csv files written. Defaults to False.
+        spans ([text_span], optional): the spans of the pdf, if they are already extracted (e.g. by page ranges). Defaults to None.
 
     Returns:
         [dict]: a list of meta data about each file
+        (with return_outputs) (dict, [str]): the meta data, and the paths of the csv files written (relative to out_dir)
     """
     Path(out_dir, "QA").mkdir(parents=True, exist_ok=True)
     Path(out_dir, "presentation").mkdir(parents=True, exist_ok=True)
 
     a_transcript = transcript(pdf_path)
-    a_transcript.parse(HTML_DIR)
+    a_transcript.parse(HTML_DIR, spans=spans)
+    outputs = []
     if write_content:
         try:
             if len(a_transcript.QA_contents_s) > 0:
@@ -362,6 +535,9 @@ def parse_single_pdf(pdf_path, out_dir, write_content=True, HTML_DIR=None):
                         index=False,
                     )
                 )
+                outputs.append(
+                    f"QA/{a_transcript.call_title} {a_transcript.date_EST}.csv"
+                )
         except:
             pass
         try:
@@ -374,30 +550,603 @@ def parse_single_pdf(pdf_path, out_dir, write_content=True, HTML_DIR=None):
                         index=False,
                     )
                 )
+                outputs.append(
+                    f"presentation/{a_transcript.call_title} {a_transcript.date_EST}.csv"
+                )
         except:
             pass
+    if return_outputs:
+        return a_transcript.meta2dict(), outputs
     return a_transcript.meta2dict()
 
 
-def parse_all_pdfs(**kwargs):
-    INPUT_DIR = global_options.PDF_PATH
-    OUT_DIR = global_options.PDF_PARSED_PATH
-    pdf_files = list(Path(INPUT_DIR).glob("**/*.pdf"))
-    with Pool(global_options.N_CORES) as p:
-        meta_all = p.map(
-            partial(parse_single_pdf, out_dir=OUT_DIR, **kwargs), pdf_files
+def parse_pdf_contents(pdf_path, write_content=True, HTML_DIR=None, spans=None):
+    """parse single pdf and return the conversation instead of saving it to csv files (see
+    write_dataset_partitions)
+
+    Args:
+        pdf_path (str/path): path to the pdf file
+        write_content (bool, optional): return the conversation. Defaults to True.
+        spans ([text_span], optional): the spans of the pdf, if they are already extracted. Defaults to None.
+
+    Returns:
+        (dict, pd.DataFrame): the meta data, and the paragraphs of the QA and presentation sections
+        with the columns of the csv files (None if there is none)
+    """
+    a_transcript = transcript(pdf_path)
+    a_transcript.parse(HTML_DIR, spans=spans)
+    contents = [
+        content_s
+        for content_s in (
+            a_transcript.QA_contents_s,
+            a_transcript.presentation_contents_s,
         )
-    # fix json representations
-    meta_all = pd.DataFrame(meta_all)
-    meta_all.call_participants = [
-        json.dumps(eval(j)) for j in meta_all.call_participants
-    ]
-    meta_all.call_participants_titles = [
-        json.dumps(eval(j)) for j in meta_all.call_participants_titles
+        if content_s is not None and len(content_s) > 0
     ]
+    if not write_content or not contents:
+        return a_transcript.meta2dict(), None
+    return (
+        a_transcript.meta2dict(),
+        pd.concat(contents, axis=0, ignore_index=True, sort=False),
+    )
+
+
+def dataset_partition(meta):
+    """Partition (folder) of the parsed dataset of a call: its date"""
+    return "date_EST={}".format(meta["date_EST"])
+
+
+DATASET_SCHEMA_COLUMNS = [
+    ("Title", "string"),
+    ("ROUND", "string"),
+    ("Paragraph", "int64"),
+    ("speaker", "string"),
+    ("speaker_title", "string"),
+    ("speaker_role", "string"),
+    ("text", "string"),
+]
+# titles of calls to remove from each partition of the parsed dataset at the next compaction
+DATASET_PENDING_FILE = "pending_removals.json"
+
+
+def _dataset_table(paragraphs):
+    import pyarrow as pa
+
+    schema = pa.schema(
+        [(name, getattr(pa, type_name)()) for name, type_name in DATASET_SCHEMA_COLUMNS]
+    )
+    return pa.Table.from_pandas(
+        paragraphs[schema.names], schema=schema, preserve_index=False
+    )
+
+
+def _write_parquet(table, parquet_file):
+    """Atomically write a table of the parsed dataset, compressed and with dictionary-encoded
+    columns"""
+    import pyarrow.parquet as pq
+
+    parquet_file.parent.mkdir(parents=True, exist_ok=True)
+    tmp_file = Path(str(parquet_file) + ".tmp")
+    pq.write_table(table, str(tmp_file), compression="zstd", use_dictionary=True)
+    os.replace(str(tmp_file), str(parquet_file))
+
+
+def write_dataset_partitions(dataset_dir, contents, part_name, removed=None):
+    """Add the paragraphs of parsed calls to the parsed dataset: a folder per call date
+    (date_EST=<date>), where the paragraphs of each flush are written to a new part file, so
+    that a flush does not read or rewrite the earlier rows. The earlier rows of the calls are
+    replaced, and the removed calls dropped, when the partitions are compacted (see
+    compact_dataset_partitions). Requires pyarrow.
+
+    Arguments:
+        dataset_dir {str or Path} -- folder of the dataset
+        contents {[(str, pd.DataFrame)]} -- partition and paragraphs (see parse_pdf_contents) of the parsed calls
+        part_name {str} -- name of the part files, unique and ordered by time (part-<run>-<flush>)
+
+    Keyword Arguments:
+        removed {{str: {str}}} -- titles of calls to remove from each partition, e.g. calls whose date changed (default: {None})
+    """
+    if removed:
+        # recorded before the new parts, so that a compaction never misses them
+        pending_file = Path(dataset_dir, DATASET_PENDING_FILE)
+        pending = json.loads(pending_file.read_text()) if pending_file.exists() else {}
+        for partition, titles in removed.items():
+            pending[partition] = sorted(set(pending.get(partition, [])) | set(titles))
+        Path(dataset_dir).mkdir(parents=True, exist_ok=True)
+        tmp_file = Path(str(pending_file) + ".tmp")
+        tmp_file.write_text(json.dumps(pending, indent=1))
+        os.replace(str(tmp_file), str(pending_file))
+    new_contents = {}
+    for partition, paragraphs in contents:
+        new_contents.setdefault(partition, []).append(paragraphs)
+    for partition, frames in sorted(new_contents.items()):
+        paragraphs = pd.concat(frames, axis=0, ignore_index=True, sort=False)
+        _write_parquet(
+            _dataset_table(paragraphs),
+            Path(dataset_dir, partition, part_name + ".parquet"),
+        )
+
+
+def _compact_partition(partition_dir, removed_titles):
+    """Merge the part files of a partition into part-0.parquet, see compact_dataset_partitions"""
+    import pyarrow.parquet as pq
+
+    base_file = Path(partition_dir, "part-0.parquet")
+    parts = sorted(p for p in partition_dir.glob("part-*.parquet") if p != base_file)
+    if base_file.exists():
+        # parts already merged by an interrupted compaction
+        metadata = pq.read_schema(str(base_file)).metadata or {}
+        merged = set(json.loads(metadata.get(b"merged_parts", b"[]")))
+        for part in parts:
+            if part.name in merged:
+                part.unlink()
+        parts = [part for part in parts if part.name not in merged]
+    if not parts and not removed_titles:
+        return
+    # the rows of a call in a part replace its rows in the earlier files
+    frames = []
+    for parquet_file in ([base_file] if base_file.exists() else []) + parts:
+        paragraphs = pq.read_table(str(parquet_file)).to_pandas()
+        titles = set(paragraphs.Title)
+        frames = [frame[~frame.Title.isin(titles)] for frame in frames]
+        frames.append(paragraphs)
+    paragraphs = (
+        pd.concat(frames, axis=0, ignore_index=True, sort=False)
+        if frames
+        else pd.DataFrame(columns=[name for name, _ in DATASET_SCHEMA_COLUMNS])
+    )
+    paragraphs = paragraphs[~paragraphs.Title.isin(removed_titles)]
+    if len(paragraphs) == 0:
+        for parquet_file in [base_file] + parts:
+            if parquet_file.exists():
+                parquet_file.unlink()
+        return
+    paragraphs = paragraphs.sort_values(
+        ["Title", "ROUND", "Paragraph"], kind="mergesort"
+    )
+    table = _dataset_table(paragraphs)
+    table = table.replace_schema_metadata(
+        dict(
+            table.schema.metadata or {},
+            merged_parts=json.dumps([part.name for part in parts]),
+        )
+    )
+    _write_parquet(table, base_file)
+    for part in parts:
+        part.unlink()
+
+
+def compact_dataset_partitions(dataset_dir):
+    """Merge the part files of each partition of the parsed dataset into one file
+    (part-0.parquet, sorted by Title, ROUND and Paragraph), keeping the rows of each call from
+    its last part and dropping the calls removed from the partition. Each partition is read and
+    written once, however many flushes added part files to it. A compaction that is
+    interrupted is completed by the next one. Requires pyarrow.
+
+    Arguments:
+        dataset_dir {str or Path} -- folder of the dataset
+    """
+    pending_file = Path(dataset_dir, DATASET_PENDING_FILE)
+    pending = json.loads(pending_file.read_text()) if pending_file.exists() else {}
+    partitions = set(pending) | {
+        part.parent.name
+        for part in Path(dataset_dir).glob("date_EST=*/part-*.parquet")
+        if part.name != "part-0.parquet"
+    }
+    for partition in sorted(partitions):
+        _compact_partition(
+            Path(dataset_dir, partition), set(pending.get(partition, []))
+        )
+    if pending_file.exists():
+        pending_file.unlink()
+
+
+def file_sha1(path, block_size=1 << 20):
+    """SHA-1 (hex) of the content of a file"""
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def read_manifest(manifest_file):
+    """Return the files recorded in the manifest of parse_all_pdfs ({} if there is none)"""
+    try:
+        return json.loads(Path(manifest_file).read_text())["files"]
+    except (OSError, ValueError, KeyError):
+        return {}
+
+
+def _write_manifest(manifest_file, files):
+    """Atomically replace the manifest file"""
+    tmp_file = Path(str(manifest_file) + ".tmp")
+    tmp_file.write_text(
+        json.dumps({"parser_version": PARSER_VERSION, "files": files}, indent=1)
+    )
+    os.replace(str(tmp_file), str(manifest_file))
+
+
+def pdfs_to_parse(pdf_files, input_dir, manifest, dataset=False):
+    """Find the pdf files that are new, changed, or parsed by an earlier PARSER_VERSION or to the
+    other output (csv files or the parsed dataset)
+
+    Files are hashed only if their size or modification time differs from the manifest, so a
+    file that is only touched is not parsed again.
+
+    Arguments:
+        pdf_files {[Path]} -- pdf files in input_dir
+        input_dir {str or Path} -- folder of the pdf files (the manifest keys are relative to it)
+        manifest {{str: dict}} -- files recorded in the manifest (see read_manifest)
+
+    Keyword Arguments:
+        dataset {bool} -- the paragraphs are written to the parsed dataset (default: {False})
+
+    Returns:
+        ([Path], {str: dict}) -- files to parse, and the manifest record of every file (the
+        outputs of the files to parse are set when they are parsed)
+    """
+    to_parse = []
+    records = {}
+    for pdf_file in pdf_files:
+        key = Path(pdf_file).relative_to(input_dir).as_posix()
+        stat = os.stat(pdf_file)
+        record = manifest.get(key)
+        if (
+            record is None
+            or record["size"] != stat.st_size
+            or record["mtime_ns"] != stat.st_mtime_ns
+        ):
+            sha1 = file_sha1(pdf_file)
+        else:
+            sha1 = record["sha1"]
+        if (
+            record is None
+            or record["sha1"] != sha1
+            or record["parser_version"] != PARSER_VERSION
+            or ("dataset_partitions" in record) != dataset
+        ):
+            to_parse.append(pdf_file)
+            record = {"outputs": [], "dataset_partitions": []}
+        records[key] = {
+            "sha1": sha1,
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "parser_version": PARSER_VERSION,
+            "outputs": record["outputs"],
+        }
+        if dataset:
+            records[key]["dataset_partitions"] = record["dataset_partitions"]
+    return to_parse, records
+
+
+def schedule_tasks(pdf_files, pages_per_task=None, split_min_bytes=0):
+    """Tasks of parse_all_pdfs, largest first, so that the longest pdfs do not start last and set
+    the total runtime: a pdf is one task, unless it has more than pages_per_task pages, then its
+    pages are split into (about equal) ranges of at most pages_per_task pages, which are
+    extracted in parallel. Only the pdfs of at least split_min_bytes are opened to count their
+    pages. The size of a task is the byte size of its pdf (times its share of the pages).
+
+    Arguments:
+        pdf_files {[Path]} -- pdf files to parse
+
+    Keyword Arguments:
+        pages_per_task {int} -- max number of pages per task of a split pdf (default: {None}, no split)
+        split_min_bytes {int} -- min byte size of a pdf to split (default: {0})
+
+    Returns:
+        [(Path, (int, int))] -- pdf file, and range of (zero-indexed) pages to extract (first, end), or None for the whole pdf
+    """
+    tasks = []
+    for pdf_file in pdf_files:
+        size = os.path.getsize(pdf_file)
+        n_pages = None
+        if pages_per_task is not None and size >= split_min_bytes:
+            try:
+                n_pages = count_pages(pdf_file)
+            except Exception:
+                # the error shows up when the pdf is parsed
+                pass
+        if n_pages is not None and n_pages > pages_per_task:
+            n_ranges = math.ceil(n_pages / pages_per_task)
+            bounds = [n_pages * i // n_ranges for i in range(n_ranges + 1)]
+            for first, end in zip(bounds, bounds[1:]):
+                tasks.append((size * (end - first) / n_pages, pdf_file, (first, end)))
+        else:
+            tasks.append((size, pdf_file, None))
+    tasks.sort(key=lambda task: -task[0])
+    return [(pdf_file, page_range) for _, pdf_file, page_range in tasks]
 
-    meta_all.to_csv(Path(global_options.DATA_PATH, "meta_data.csv"), index=False)
+
+def _parse_pdf(pdf_file, out_dir, dataset=False, spans=None, **kwargs):
+    """Parse a pdf to csv files (see parse_single_pdf) or for the parsed dataset (see
+    parse_pdf_contents), returning its meta data, csv files and paragraphs"""
+    if dataset:
+        meta, contents = parse_pdf_contents(pdf_file, spans=spans, **kwargs)
+        return meta, [], contents
+    meta, outputs = parse_single_pdf(
+        pdf_file, out_dir, return_outputs=True, spans=spans, **kwargs
+    )
+    return meta, outputs, None
+
+
+def _parse_task(task, out_dir, dataset=False, **kwargs):
+    """Parse a whole pdf (see _parse_pdf), or extract the spans of a page range"""
+    pdf_file, page_range = task
+    if page_range is None:
+        return _parse_pdf(pdf_file, out_dir, dataset=dataset, **kwargs)
+    return extract_spans(pdf_file, range(*page_range))
+
+
+def _log_error(error_file, pdf_file, page_range, seconds, error):
+    """Append a failed task to the error file and print its last line"""
+    # the traceback is in the error file
+    print(
+        f"!!!!! ERROR: {pdf_file} failed after {seconds:.1f}s: {error.strip().splitlines()[-1]}"
+    )
+    write_header = not error_file.exists()
+    with open(error_file, "a", newline="") as f_error:
+        writer = csv.writer(f_error)
+        if write_header:
+            writer.writerow(["time", "pdf_file", "pages", "seconds", "error"])
+        writer.writerow(
+            [
+                time.strftime("%Y-%m-%d %H:%M:%S"),
+                str(pdf_file),
+                "" if page_range is None else "{}-{}".format(*page_range),
+                round(seconds, 3),
+                error,
+            ]
+        )
+
+
+def _write_journal(f_journal, out_dir, manifest, entries):
+    """Append parsed pdfs (pdf, manifest record and meta data) to the journal of parse_all_pdfs,
+    removing the csv files of their last parse that were not written again (e.g. the date
+    changed)"""
+    for entry in entries:
+        old_outputs = manifest.get(entry["pdf"], {}).get("outputs", [])
+        for output in set(old_outputs) - set(entry["record"]["outputs"]):
+            if Path(out_dir, output).exists():
+                Path(out_dir, output).unlink()
+        f_journal.write(json.dumps(entry) + "\n")
+    f_journal.flush()
+
+
+def _apply_journal(journal_file, meta_file, manifest_file, records, replace_meta=False):
+    """Merge the pdfs recorded in the journal of parse_all_pdfs (one json line per parsed pdf, with
+    its manifest record and meta data) into meta_data.csv and the manifest, and remove the journal
+
+    Arguments:
+        journal_file {Path} -- the journal
+        meta_file {Path} -- meta_data.csv
+        manifest_file {Path} -- the manifest
+        records {{str: dict}} -- manifest records of the pdfs that are not in the journal
+
+    Keyword Arguments:
+        replace_meta {bool} -- replace meta_data.csv by the meta data in the journal, instead of replacing or extending its rows (default: {False})
+
+    Returns:
+        {str: dict} -- manifest records written
+    """
+    entries = []
+    with open(journal_file) as f:
+        for line in f:
+            try:
+                entries.append(json.loads(line))
+            except ValueError:
+                # the last line of an interrupted run may be incomplete
+                pass
+    if entries:
+        # fix json representations
+        meta_all = pd.DataFrame([entry["meta"] for entry in entries])
+        meta_all.call_participants = [
+            json.dumps(eval(j)) for j in meta_all.call_participants
+        ]
+        meta_all.call_participants_titles = [
+            json.dumps(eval(j)) for j in meta_all.call_participants_titles
+        ]
+        if not replace_meta and meta_file.exists():
+            # read as str, so the other rows are written back as they are
+            meta_old = pd.read_csv(meta_file, dtype=str, keep_default_na=False)
+            meta_all = pd.concat(
+                [
+                    meta_old[~meta_old.call_title.isin(meta_all.call_title)],
+                    meta_all,
+                ],
+                ignore_index=True,
+            )
+        tmp_file = Path(str(meta_file) + ".tmp")
+        meta_all.to_csv(tmp_file, index=False)
+        os.replace(str(tmp_file), str(meta_file))
+    records = dict(records)
+    records.update({entry["pdf"]: entry["record"] for entry in entries})
+    _write_manifest(manifest_file, records)
+    journal_file.unlink()
+    return records
+
+
+def parse_all_pdfs(incremental=True, **kwargs):
+    """Parse the pdfs in PDF_PATH to csv files in PDF_PARSED_PATH, and write the meta data of the
+    calls to DATA_PATH/meta_data.csv
+
+    The content hash, size, parser version and csv files of each pdf are recorded in
+    PDF_PARSED_PATH/manifest.json. With incremental, only the pdfs that are new or changed since
+    the last run (see pdfs_to_parse) are parsed, and their meta data replace or extend the rows of
+    the existing meta_data.csv. Rows and csv files of pdfs that were removed from PDF_PATH are
+    kept.
+
+    The pdfs are parsed by worker processes (see worker_pool.imap_unordered_timeout), largest
+    first, and the pages of pdfs with more than PDF_PAGES_PER_TASK pages are extracted in parallel
+    by page ranges (see schedule_tasks); the spans of the ranges are put back in page order and
+    parsed when the last range is extracted. A task that takes longer than PDF_TIMEOUT seconds is
+    stopped, and the workers are replaced after PDF_MAX_TASKS_PER_CHILD tasks. Each parsed pdf is appended to PDF_PARSED_PATH/manifest.journal
+    as it completes (and merged into meta_data.csv and the manifest at the end, or at the start of
+    the next run if the run is interrupted). Failed pdfs are appended to PDF_PARSED_PATH/errors.csv
+    with the error and the seconds they took; they are not in the manifest, so the next run parses
+    them again.
+
+    If PDF_PARSED_DATASET is set, the paragraphs are written to the parsed dataset instead of csv
+    files, in new part files every PDF_DATASET_FLUSH_ROWS paragraphs and at the end (see
+    write_dataset_partitions); the pdfs are appended to the journal once their paragraphs are
+    written. The partitions are compacted to one file each at the end of the run (or at the
+    start of the next run if the run is interrupted, see compact_dataset_partitions). The
+    partitions of each pdf are recorded in the manifest, and the pdfs parsed to the other output
+    are parsed again.
+
+    Keyword Arguments:
+        incremental {bool} -- parse only new or changed pdfs, otherwise parse all pdfs and rewrite meta_data.csv (default: {True})
+        **kwargs -- passed to parse_single_pdf (e.g. write_content)
+    """
+    INPUT_DIR = global_options.PDF_PATH
+    OUT_DIR = global_options.PDF_PARSED_PATH
+    meta_file = Path(global_options.DATA_PATH, "meta_data.csv")
+    manifest_file = Path(OUT_DIR, "manifest.json")
+    journal_file = Path(OUT_DIR, "manifest.journal")
+    error_file = Path(OUT_DIR, "errors.csv")
+    dataset_dir = global_options.PDF_PARSED_DATASET
+    dataset = dataset_dir is not None
+    manifest = read_manifest(manifest_file) if meta_file.exists() else {}
+    if journal_file.exists():
+        print("Merging the PDFs parsed by an interrupted run.")
+        manifest = _apply_journal(journal_file, meta_file, manifest_file, manifest)
+    if dataset:
+        # the part files of an interrupted run
+        compact_dataset_partitions(dataset_dir)
+    pdf_files = list(Path(INPUT_DIR).glob("**/*.pdf"))
+    to_parse, records = pdfs_to_parse(
+        pdf_files, INPUT_DIR, manifest if incremental else {}, dataset=dataset
+    )
+    print(f"Parsing {len(to_parse)} of {len(pdf_files)} PDFs (new or changed).")
+    tasks = schedule_tasks(
+        to_parse,
+        pages_per_task=global_options.PDF_PAGES_PER_TASK,
+        split_min_bytes=global_options.PDF_SPLIT_MIN_BYTES,
+    )
+    n_ranges = {}
+    for pdf_file, page_range in tasks:
+        n_ranges[pdf_file] = n_ranges.get(pdf_file, 0) + 1
+    # spans of the extracted page ranges of each split pdf
+    range_spans = {}
+    failed = set()
+    # parsed pdfs whose paragraphs are not written to the dataset yet: (partition, paragraphs)
+    # and journal entries, and the partitions to remove the pdfs from
+    dataset_contents, dataset_entries, dataset_removed = [], [], {}
+    n_buffered = 0
+    # part files of the flushes of this run: part-<run>-<flush>
+    dataset_run = "part-{:020d}".format(time.time_ns())
+    n_flushes = 0
+    with open(journal_file, "a") as f_journal:
+        for (
+            (pdf_file, page_range),
+            result,
+            error,
+            seconds,
+        ) in worker_pool.imap_unordered_timeout(
+            partial(_parse_task, out_dir=OUT_DIR, dataset=dataset, **kwargs),
+            tasks,
+            n_workers=global_options.N_CORES,
+            timeout=global_options.PDF_TIMEOUT,
+            max_tasks_per_child=global_options.PDF_MAX_TASKS_PER_CHILD,
+        ):
+            key = Path(pdf_file).relative_to(INPUT_DIR).as_posix()
+            if error is not None:
+                _log_error(error_file, pdf_file, page_range, seconds, error)
+                failed.add(pdf_file)
+                range_spans.pop(pdf_file, None)
+                continue
+            if page_range is not None:
+                if pdf_file in failed:
+                    continue
+                range_spans.setdefault(pdf_file, {})[page_range] = result
+                if len(range_spans[pdf_file]) < n_ranges[pdf_file]:
+                    continue
+                spans = [
+                    span
+                    for _, part in sorted(range_spans.pop(pdf_file).items())
+                    for span in part
+                ]
+                start = time.perf_counter()
+                try:
+                    result = _parse_pdf(
+                        pdf_file, OUT_DIR, dataset=dataset, spans=spans, **kwargs
+                    )
+                except Exception:
+                    _log_error(
+                        error_file,
+                        pdf_file,
+                        None,
+                        time.perf_counter() - start,
+                        traceback.format_exc(),
+                    )
+                    failed.add(pdf_file)
+                    continue
+            meta, outputs, contents = result
+            record = dict(records[key], outputs=outputs)
+            if dataset:
+                partitions = []
+                if contents is not None:
+                    partitions.append(dataset_partition(meta))
+                    dataset_contents.append((partitions[0], contents))
+                    n_buffered += len(contents)
+                record["dataset_partitions"] = partitions
+                # partitions of the last parse that are not written again
+                for partition in set(
+                    manifest.get(key, {}).get("dataset_partitions", [])
+                ) - set(partitions):
+                    dataset_removed.setdefault(partition, set()).add(
+                        Path(pdf_file).stem
+                    )
+                dataset_entries.append({"pdf": key, "record": record, "meta": meta})
+                if n_buffered >= global_options.PDF_DATASET_FLUSH_ROWS:
+                    write_dataset_partitions(
+                        dataset_dir,
+                        dataset_contents,
+                        "{}-{:06d}".format(dataset_run, n_flushes),
+                        dataset_removed,
+                    )
+                    _write_journal(f_journal, OUT_DIR, manifest, dataset_entries)
+                    dataset_contents, dataset_entries, dataset_removed = [], [], {}
+                    n_buffered = 0
+                    n_flushes += 1
+            else:
+                _write_journal(
+                    f_journal,
+                    OUT_DIR,
+                    manifest,
+                    [{"pdf": key, "record": record, "meta": meta}],
+                )
+        if dataset_entries:
+            write_dataset_partitions(
+                dataset_dir,
+                dataset_contents,
+                "{}-{:06d}".format(dataset_run, n_flushes),
+                dataset_removed,
+            )
+            _write_journal(f_journal, OUT_DIR, manifest, dataset_entries)
+    if dataset:
+        compact_dataset_partitions(dataset_dir)
+    if failed:
+        print(f"{len(failed)} PDFs failed, see {error_file}.")
+    # the pdfs to parse are recorded only if they were parsed (in the journal)
+    to_parse_keys = {Path(f).relative_to(INPUT_DIR).as_posix() for f in to_parse}
+    _apply_journal(
+        journal_file,
+        meta_file,
+        manifest_file,
+        {key: r for key, r in records.items() if key not in to_parse_keys},
+        replace_meta=not incremental,
+    )
 
 
 if __name__ == "__main__":
-    parse_all_pdfs(write_content=True)
+    parser = argparse.ArgumentParser(
+        description="Parse the pdf transcripts to csv files (or the parsed dataset) and meta data."
+    )
+    parser.add_argument(
+        "--full",
+        action="store_true",
+        help="parse all pdfs, not only the ones that are new or changed since the last run",
+    )
+    args = parser.parse_args()
+    parse_all_pdfs(incremental=not args.full, write_content=True)
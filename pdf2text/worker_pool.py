@@ -0,0 +1,185 @@
+"""worker processes with a wall-clock timeout per task: a worker that runs over the timeout (or dies) is killed and replaced, without stopping the other tasks
+"""
+import multiprocessing
+import time
+import traceback
+from collections import deque
+from multiprocessing.connection import wait
+
+
+def _worker(function, conn):
+    """Run the chunks of tasks received on conn until None. For each task, send ("start", time)
+    when it starts (time.monotonic(), a system-wide clock, so the parent can compare it with its
+    own), then ("done", (result, error, seconds))"""
+    while True:
+        try:
+            tasks = conn.recv()
+        except EOFError:
+            break
+        if tasks is None:
+            break
+        for args in tasks:
+            conn.send(("start", time.monotonic()))
+            start = time.perf_counter()
+            try:
+                result, error = function(args), None
+            except Exception:
+                result, error = None, traceback.format_exc()
+            try:
+                conn.send(("done", (result, error, time.perf_counter() - start)))
+            except Exception:
+                # e.g. a result that cannot be pickled
+                conn.send(
+                    (
+                        "done",
+                        (None, traceback.format_exc(), time.perf_counter() - start),
+                    )
+                )
+    conn.close()
+
+
+class _worker_process(object):
+    """A worker process with its own pipe (killing it does not affect the other workers), the
+    tasks sent to it that are not finished yet, and when its current task started (when the
+    chunk was sent, until the worker reports the start)"""
+
+    def __init__(self, function):
+        self.conn, child_conn = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=_worker, args=(function, child_conn), daemon=True
+        )
+        self.process.start()
+        # the pipe reaches EOF when the worker exits
+        child_conn.close()
+        self.tasks = deque()
+        self.task_start = None
+        self.n_tasks = 0
+
+    def submit(self, tasks):
+        self.tasks.extend(tasks)
+        self.task_start = time.monotonic()
+        self.conn.send(list(tasks))
+
+    def receive(self, results):
+        """Read the messages waiting in the pipe, without blocking, and append (args, result,
+        error, seconds) of each finished task to results. Raises EOFError (after the results
+        sent before) if the worker exited."""
+        while self.tasks and self.conn.poll():
+            kind, message = self.conn.recv()
+            if kind == "start":
+                self.task_start = message
+            else:
+                results.append((self.tasks.popleft(),) + message)
+                self.n_tasks += 1
+
+    def stop(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join()
+        self.conn.close()
+
+    def kill(self):
+        self.process.kill()
+        self.process.join()
+        self.conn.close()
+
+
+def imap_unordered_timeout(
+    function,
+    args_iterable,
+    n_workers,
+    timeout=None,
+    max_tasks_per_child=None,
+    chunksize=1,
+):
+    """Apply function to each argument in worker processes, yielding results as they complete
+    (as Pool.imap_unordered), with fault isolation:
+
+    - an exception in function is returned as the error of its task;
+    - a task that runs longer than timeout seconds (from when its worker starts it) is stopped by
+      killing its worker, and a worker that dies (e.g. out of memory) only fails its current
+      task; the worker is replaced and the other tasks of its chunk are sent again. Results
+      already sent by a worker are read before it is killed, and the time the caller spends
+      between results is not charged to the running tasks;
+    - a worker is replaced after max_tasks_per_child tasks, which bounds the memory it can
+      accumulate.
+
+    Arguments:
+        function {callable} -- function of one argument (must be picklable, e.g. a functools.partial of a module-level function)
+        args_iterable {iterable} -- arguments
+        n_workers {int} -- number of worker processes
+
+    Keyword Arguments:
+        timeout {float} -- wall-clock seconds per task (default: {None}, no timeout)
+        max_tasks_per_child {int} -- number of tasks a worker runs before it is replaced (default: {None}, never)
+        chunksize {int} -- number of tasks sent to a worker at once. Tasks that take seconds (e.g. a pdf) are best sent one at a time, so that the last tasks spread over all workers (default: {1})
+
+    Yields:
+        (arg, result, str, float) -- argument, result (None if the task failed), error (None, or
+        the traceback / reason of the failure), and seconds the task took
+    """
+    pending = deque(args_iterable)
+    workers = []
+    try:
+        while pending or any(w.tasks for w in workers):
+            # recycle idle workers, and send tasks to idle workers
+            for i, w in enumerate(workers):
+                if (
+                    not w.tasks
+                    and max_tasks_per_child is not None
+                    and w.n_tasks >= max_tasks_per_child
+                ):
+                    w.stop()
+                    workers[i] = _worker_process(function)
+            while len(workers) < n_workers and len(workers) < len(pending):
+                workers.append(_worker_process(function))
+            for w in workers:
+                if not w.tasks and pending:
+                    w.submit(
+                        [pending.popleft() for _ in range(min(chunksize, len(pending)))]
+                    )
+            busy = [i for i, w in enumerate(workers) if w.tasks]
+            wait_timeout = None
+            if timeout is not None:
+                wait_timeout = max(
+                    0,
+                    min(workers[i].task_start for i in busy)
+                    + timeout
+                    - time.monotonic(),
+                )
+            wait([workers[i].conn for i in busy], timeout=wait_timeout)
+            # read every pipe before judging timeouts, and yield only after, so that neither a
+            # finished result nor the time spent by the caller counts against a running task
+            results = []
+            for i in busy:
+                w = workers[i]
+                failure = None
+                try:
+                    w.receive(results)
+                except (EOFError, OSError):
+                    w.process.join()
+                    failure = "worker exited with code {}".format(w.process.exitcode)
+                if (
+                    failure is None
+                    and w.tasks
+                    and timeout is not None
+                    and time.monotonic() - w.task_start > timeout
+                ):
+                    failure = "timeout after {} seconds".format(timeout)
+                if failure is not None:
+                    args = w.tasks.popleft()
+                    seconds = time.monotonic() - w.task_start
+                    w.kill()
+                    # the other tasks of the chunk are sent again
+                    pending.extendleft(reversed(w.tasks))
+                    workers[i] = _worker_process(function)
+                    results.append((args, None, failure, seconds))
+            yield from results
+    finally:
+        for w in workers:
+            if w.tasks:
+                w.kill()
+            else:
+                w.stop()
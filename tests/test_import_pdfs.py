@@ -0,0 +1,310 @@
+import os
+import re
+import time
+
+import pandas as pd
+import pytest
+from bs4 import BeautifulSoup
+
+import file_util
+import global_options
+from pdf2text import import_pdfs
+
+BOLD, ITALIC, REGULAR = "Verdana-Bold", "Verdana-Italic", "Verdana"
+# (font, size, y, text) of the lines of each page, laid out like the transcripts
+PAGES = [
+    [
+        (BOLD, 20, 740, "Vishay Precision Group, Inc. NYSE:VPG"),
+        (BOLD, 25, 700, "Q4 2019 Earnings Call"),
+        (BOLD, 17, 670, "Tuesday, February 18, 2020 2:00 PM GMT"),
+        (BOLD, 10, 620, "EXECUTIVES"),
+        (BOLD, 10, 590, "William M. Clancy"),
+        (ITALIC, 10, 578, "Executive VP, CFO"),
+        (BOLD, 10, 540, "ANALYSTS"),
+        (BOLD, 10, 510, "John Doe"),
+        (ITALIC, 10, 498, "Big Bank, Research Division"),
+        (BOLD, 24, 440, "Presentation"),
+        (BOLD, 10, 400, "Operator"),
+        (REGULAR, 10, 370, "Good day and welcome to the call."),
+        (BOLD, 10, 330, "William M. Clancy"),
+        (ITALIC, 10, 318, "Executive VP, CFO"),
+        (REGULAR, 10, 290, "Thank you. Revenue grew this year."),
+    ],
+    [
+        (BOLD, 24, 740, "Question and Answer"),
+        (BOLD, 10, 690, "Operator"),
+        (REGULAR, 10, 660, "Our first question comes from John Doe."),
+        (BOLD, 10, 620, "John Doe"),
+        (ITALIC, 10, 608, "Big Bank, Research Division"),
+        (REGULAR, 10, 580, "How is demand?"),
+        (BOLD, 10, 540, "William M. Clancy"),
+        (ITALIC, 10, 528, "Executive VP, CFO"),
+        (REGULAR, 10, 500, "Demand is strong."),
+        (
+            REGULAR,
+            8,
+            100,
+            "These materials have been prepared solely for information purposes based upon "
+            "information generally available to the public",
+        ),
+    ],
+]
+
+
+def write_pdf(path, pages):
+    """Write a pdf of lines of text in (not embedded) Type1 fonts with fixed widths"""
+    fonts = [REGULAR, BOLD, ITALIC]
+    objects = []
+
+    def add(body):
+        objects.append(body)
+        return len(objects)
+
+    font_ids = []
+    for font in fonts:
+        descriptor = add(
+            "<< /Type /FontDescriptor /FontName /{} /Flags 32 /FontBBox [0 -200 1000 900] "
+            "/ItalicAngle 0 /Ascent 900 /Descent -200 /CapHeight 700 /StemV 80 >>".format(
+                font
+            )
+        )
+        font_ids.append(
+            add(
+                "<< /Type /Font /Subtype /Type1 /BaseFont /{} /FirstChar 32 /LastChar 126 "
+                "/Widths [{}] /FontDescriptor {} 0 R >>".format(
+                    font, " ".join(["600"] * 95), descriptor
+                )
+            )
+        )
+    resources = "<< /Font << {} >> >>".format(
+        " ".join("/F{} {} 0 R".format(i, font_id) for i, font_id in enumerate(font_ids))
+    )
+    pages_id = len(objects) + 2 * len(pages) + 1
+    page_ids = []
+    for lines in pages:
+        stream = "".join(
+            "BT /F{} {} Tf 50 {} Td ({}) Tj ET\n".format(
+                fonts.index(font), size, y, text
+            )
+            for font, size, y, text in lines
+        )
+        content = add(
+            "<< /Length {} >>\nstream\n{}endstream".format(len(stream), stream)
+        )
+        page_ids.append(
+            add(
+                "<< /Type /Page /Parent {} 0 R /MediaBox [0 0 612 792] /Resources {} "
+                "/Contents {} 0 R >>".format(pages_id, resources, content)
+            )
+        )
+    add(
+        "<< /Type /Pages /Kids [{}] /Count {} >>".format(
+            " ".join("{} 0 R".format(i) for i in page_ids), len(page_ids)
+        )
+    )
+    catalog = add("<< /Type /Catalog /Pages {} 0 R >>".format(pages_id))
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for i, body in enumerate(objects):
+        offsets.append(len(pdf))
+        pdf += "{} 0 obj\n{}\nendobj\n".format(i + 1, body).encode()
+    xref = len(pdf)
+    pdf += "xref\n0 {}\n0000000000 65535 f \n".format(len(objects) + 1).encode()
+    pdf += "".join("{:010d} 00000 n \n".format(offset) for offset in offsets).encode()
+    pdf += "trailer\n<< /Size {} /Root {} 0 R >>\nstartxref\n{}\n%%EOF\n".format(
+        len(objects) + 1, catalog, xref
+    ).encode()
+    path.write_bytes(pdf)
+    return path
+
+
+@pytest.fixture
+def pdf_file(tmp_path):
+    return write_pdf(tmp_path / "VPG Q4 2019.pdf", PAGES)
+
+
+def test_spans_equal_html_spans(pdf_file):
+    # the <span>s of the html of pdf_to_html, as BeautifulSoup finds them
+    style = re.compile(r"font-family: (\S+); font-size:(\d+)px")
+    soup = BeautifulSoup(
+        import_pdfs.transcript(pdf_file).pdf_to_html(pdf_file), features="lxml"
+    )
+    html_spans = [
+        (match.group(1), int(match.group(2)), span.get_text())
+        for span in soup.find_all("span", style=style)
+        for match in [style.search(span["style"])]
+    ]
+    assert [
+        (span.font, span.size, span.text)
+        for span in import_pdfs.extract_spans(pdf_file)
+    ] == html_spans
+    assert len(html_spans) == sum(len(lines) for lines in PAGES)
+
+    # the output of the html parser
+    a_transcript = import_pdfs.transcript(pdf_file)
+    a_transcript.parse()
+    assert a_transcript.meta2dict() == {
+        "call_title": "VPG Q4 2019",
+        "firm_full_name": "Vishay Precision Group, Inc. NYSE:VPG",
+        "firm_name": "Vishay Precision Group, Inc.",
+        "ticker": "NYSE:VPG",
+        "call_type": "Q4 2019 Earnings Call",
+        "date_EST": "2020-02-18",
+        "time_EST": "2020-02-18 09:00:00",
+        "time_raw": "Tuesday, February 18, 2020 2:00 PM GMT",
+        "call_participants": '{"EXECUTIVES": ["William M. Clancy"], "ANALYSTS": ["John Doe"]}',
+        "call_participants_titles": '{"William M. Clancy": "Executive VP, CFO", "John Doe": "Big Bank, Research Division"}',
+    }
+    assert a_transcript.presentation_contents_s[
+        ["speaker", "speaker_role", "text"]
+    ].values.tolist() == [
+        ["Operator", "", "Good day and welcome to the call."],
+        ["William M. Clancy", "EXECUTIVES", "Thank you. Revenue grew this year."],
+    ]
+    assert a_transcript.QA_contents_s[
+        ["speaker", "speaker_role", "text"]
+    ].values.tolist() == [
+        ["Operator", "", "Our first question comes from John Doe."],
+        ["John Doe", "ANALYSTS", "How is demand?"],
+        ["William M. Clancy", "EXECUTIVES", "Demand is strong."],
+    ]
+
+
+def test_page_ranges_equal_whole_file(pdf_file, tmp_path):
+    tasks = import_pdfs.schedule_tasks([pdf_file], pages_per_task=1)
+    assert tasks == [(pdf_file, (0, 1)), (pdf_file, (1, 2))]
+    # the ranges in any order of completion, put back in page order as in parse_all_pdfs
+    range_spans = {
+        task[1]: import_pdfs._parse_task(task, tmp_path) for task in reversed(tasks)
+    }
+    spans = [span for _, part in sorted(range_spans.items()) for span in part]
+    assert [span.page for span in spans[:1] + spans[-1:]] == [1, 2]
+    assert spans == import_pdfs.extract_spans(pdf_file)
+    meta, _, contents = import_pdfs._parse_pdf(
+        pdf_file, tmp_path, dataset=True, spans=spans
+    )
+    whole_meta, _, whole_contents = import_pdfs._parse_pdf(
+        pdf_file, tmp_path, dataset=True
+    )
+    assert meta == whole_meta
+    assert contents.equals(whole_contents)
+    assert len(contents) == 5
+
+
+def test_parse_all_pdfs_skips_unchanged_and_reparses_changed(
+    tmp_path, monkeypatch, capsys
+):
+    input_dir, out_dir = tmp_path / "raw", tmp_path / "parsed"
+    input_dir.mkdir()
+    out_dir.mkdir()
+    monkeypatch.setattr(global_options, "DATA_PATH", str(tmp_path))
+    monkeypatch.setattr(global_options, "PDF_PATH", str(input_dir))
+    monkeypatch.setattr(global_options, "PDF_PARSED_PATH", str(out_dir))
+    monkeypatch.setattr(global_options, "PDF_PARSED_DATASET", None)
+    monkeypatch.setattr(global_options, "N_CORES", 1)
+    pdf_file = write_pdf(input_dir / "VPG Q4 2019.pdf", PAGES)
+    import_pdfs.parse_all_pdfs(write_content=True)
+    assert "Parsing 1 of 1 PDFs" in capsys.readouterr().out
+    assert sorted(p.name for p in (out_dir / "QA").iterdir()) == [
+        "VPG Q4 2019 2020-02-18.csv"
+    ]
+
+    # unchanged, and only touched: skipped
+    os.utime(pdf_file, ns=(time.time_ns(), time.time_ns() + 10**9))
+    import_pdfs.parse_all_pdfs(write_content=True)
+    assert "Parsing 0 of 1 PDFs" in capsys.readouterr().out
+
+    # a new pdf, and a changed one (its date): parsed, and its rows of the meta data replaced
+    write_pdf(input_dir / "other.pdf", PAGES)
+    write_pdf(
+        pdf_file,
+        [
+            [
+                line[:3] + ("Wednesday, February 19, 2020 2:00 PM GMT",)
+                if line[1] == 17
+                else line
+                for line in PAGES[0]
+            ],
+            PAGES[1],
+        ],
+    )
+    import_pdfs.parse_all_pdfs(write_content=True)
+    assert "Parsing 2 of 2 PDFs" in capsys.readouterr().out
+    # the csv of the last parse of the changed pdf is removed
+    assert sorted(p.name for p in (out_dir / "QA").iterdir()) == [
+        "VPG Q4 2019 2020-02-19.csv",
+        "other 2020-02-18.csv",
+    ]
+    meta = pd.read_csv(tmp_path / "meta_data.csv")
+    assert sorted(zip(meta.call_title, meta.date_EST)) == [
+        ("VPG Q4 2019", "2020-02-19"),
+        ("other", "2020-02-18"),
+    ]
+    assert set(import_pdfs.read_manifest(out_dir / "manifest.json")) == {
+        "VPG Q4 2019.pdf",
+        "other.pdf",
+    }
+
+
+def test_dataset_readers_equal_csv_readers(tmp_path, monkeypatch):
+    pytest.importorskip("pyarrow")
+    from generate_word_list import prep_coreNLP_inputs
+
+    input_dir, out_dir = tmp_path / "raw", tmp_path / "parsed"
+    dataset_dir = tmp_path / "parsed_dataset"
+    input_dir.mkdir()
+    out_dir.mkdir()
+    monkeypatch.setattr(global_options, "DATA_PATH", str(tmp_path))
+    monkeypatch.setattr(global_options, "PDF_PATH", str(input_dir))
+    monkeypatch.setattr(global_options, "PDF_PARSED_PATH", str(out_dir))
+    monkeypatch.setattr(global_options, "N_CORES", 1)
+    # a flush every 3 paragraphs: part files of several flushes are compacted
+    monkeypatch.setattr(global_options, "PDF_DATASET_FLUSH_ROWS", 3)
+    write_pdf(input_dir / "VPG Q4 2019.pdf", PAGES)
+    write_pdf(
+        input_dir / "other.pdf",
+        [
+            [
+                line[:3] + ("Wednesday, March 4, 2020 2:00 PM GMT",)
+                if line[1] == 17
+                else line
+                for line in PAGES[0]
+            ],
+            PAGES[1],
+        ],
+    )
+    monkeypatch.setattr(global_options, "PDF_PARSED_DATASET", None)
+    import_pdfs.parse_all_pdfs(write_content=True)
+    # the csv files are removed when the pdfs are parsed to the dataset
+    csv_files = file_util.get_csv_files(out_dir)
+    csv_paragraphs = file_util.combine_all_csv(csv_files)
+    monkeypatch.setattr(file_util, "get_csv_files", lambda: csv_files)
+    csv_inputs = prep_coreNLP_inputs._read_parsed_csvs()
+    monkeypatch.setattr(global_options, "PDF_PARSED_DATASET", str(dataset_dir))
+    import_pdfs.parse_all_pdfs(write_content=True)
+    assert not list(out_dir.glob("**/*.csv"))
+    assert sorted(
+        p.relative_to(dataset_dir).as_posix() for p in dataset_dir.glob("*/*")
+    ) == [
+        "date_EST=2020-02-18/part-0.parquet",
+        "date_EST=2020-03-04/part-0.parquet",
+    ]
+
+    keys = ["Title", "ROUND", "Paragraph"]
+    pd.testing.assert_frame_equal(
+        file_util.read_parsed_dataset(dataset_dir)
+        .drop("call_title_date", axis=1)
+        .sort_values(keys, ignore_index=True),
+        csv_paragraphs.sort_values(keys, ignore_index=True),
+    )
+    assert sorted(
+        file_util.read_parsed_dataset(dataset_dir, columns=["text"]).text
+    ) == sorted(csv_paragraphs.text)
+    # the paragraphs of prep_coreNLP_inputs.prep_inputs, with the call primary id
+    keys = ["call_title_date", "ROUND", "Paragraph"]
+    pd.testing.assert_frame_equal(
+        file_util.read_parsed_dataset(dataset_dir)
+        .drop("Title", axis=1)
+        .sort_values(keys, ignore_index=True),
+        csv_inputs.sort_values(keys, ignore_index=True),
+    )
@@ -0,0 +1,89 @@
+import random
+
+import pytest
+
+gensim = pytest.importorskip("gensim")
+pytest.importorskip("stanfordnlp")
+if not hasattr(gensim.models.phrases.Phrases(), "common_terms"):
+    pytest.skip(
+        "the phrase models are gensim 3 models (common_terms)", allow_module_level=True
+    )
+
+import global_options
+from generate_word_list.nlp_process import nlp_models
+
+PHRASES = [
+    "supply chain disruption",
+    "interest rate",
+    "new york",
+    "bank of america",
+    "cost of the goods",
+    "covid-19 pandemic",
+]
+# fillers, so that the phrases score above the threshold of the pipeline (original_scorer
+# grows with the size of the vocab)
+WORDS = "demand chain rate new of the a and bank cost".split() + [
+    "w{}".format(i) for i in range(300)
+]
+
+
+def _corpus(n_lines, seed=0):
+    rng = random.Random(seed)
+    return [
+        " ".join(
+            rng.choice(PHRASES) if rng.random() < 0.3 else rng.choice(WORDS)
+            for _ in range(rng.randint(0, 12))
+        )
+        for _ in range(n_lines)
+    ]
+
+
+def _phrase_model(lines):
+    model = nlp_models.new_phrase_model()
+    model.add_vocab([line.split() for line in lines])
+    return nlp_models.set_phrase_scoring(model, 10, "original_scorer")
+
+
+@pytest.fixture(autouse=True)
+def _options(monkeypatch):
+    monkeypatch.setattr(global_options, "PHRASE_MIN_COUNT", 5)
+    monkeypatch.setattr(global_options, "N_CORES", 2)
+
+
+def test_frozen_phrases_equal_phrases():
+    lines = _corpus(2000)
+    bigram_model = _phrase_model(lines)
+    bigram_phraser = nlp_models.frozen_phrases(bigram_model)
+    bigram_lines = [" ".join(bigram_model[line.split()]) for line in lines]
+    assert [" ".join(bigram_phraser[line.split()]) for line in lines] == bigram_lines
+    assert {"supply_chain", "bank_of_america"} <= set(" ".join(bigram_lines).split())
+    # the trigram model joins bigrams (tokens with the delimiter)
+    trigram_model = _phrase_model(bigram_lines)
+    trigram_phraser = nlp_models.frozen_phrases(trigram_model)
+    trigram_lines = [" ".join(trigram_model[line.split()]) for line in bigram_lines]
+    assert [
+        " ".join(trigram_phraser[line.split()]) for line in bigram_lines
+    ] == trigram_lines
+    assert "supply_chain_disruption" in " ".join(trigram_lines)
+
+
+def test_file_bigramer_equals_phrases(tmp_path):
+    # more lines than a block of read_large_file: blocks are written in order
+    lines = _corpus(25000, seed=1)
+    input_path = tmp_path / "documents.txt"
+    input_path.write_text("".join(line + "\n" for line in lines))
+    model_path = tmp_path / "bigram.mod"
+    bigram_model = nlp_models.new_phrase_model()
+    bigram_model.add_vocab([line.split() for line in lines])
+    bigram_model.save(str(model_path))
+    output_path = tmp_path / "bigram" / "documents.txt"
+    nlp_models.file_bigramer(
+        input_path, output_path, model_path, threshold=10, scoring="original_scorer"
+    )
+    # the output of file_bigramer with the Phrases model
+    bigram_model = nlp_models.set_phrase_scoring(bigram_model, 10, "original_scorer")
+    assert (
+        output_path.read_text()
+        == "\n".join(nlp_models.bigram_transform(line, bigram_model) for line in lines)
+        + "\n"
+    )
@@ -0,0 +1,62 @@
+import csv
+import gzip
+
+import pandas as pd
+
+import file_util
+from generate_word_list import paragraph_index
+
+PARAGRAPHS = pd.DataFrame(
+    {
+        "call_title_date": [
+            "a 2020-03-01",
+            "a 2020-03-01",
+            "b 2020-04-02",
+            "b 2020-04-02",
+        ],
+        "text": ["raw"] * 4,
+        "text_parsed": [
+            "covid-19 supply_chain supply_chain impact",
+            "",
+            "Covid-19 outbreak hurt demand",
+            "strong demand",
+        ],
+    }
+)
+
+
+def _write_corpus(tmp_path):
+    corpus_file = tmp_path / "all_transcripts_parsed.csv.gz"
+    with gzip.open(corpus_file, "wt", newline="") as f:
+        PARAGRAPHS.to_csv(f, index=False, quoting=csv.QUOTE_ALL)
+    return corpus_file
+
+
+def test_contains_words_equals_if_contains_words(tmp_path):
+    corpus_file = _write_corpus(tmp_path)
+    index_path = tmp_path / "index" / "paragraphs"
+    words = {"covid-19", "Supply_Chain", "missing"}
+    expected = file_util.if_contains_words(
+        PARAGRAPHS.text_parsed.str.lower(), {w.lower() for w in words}
+    )
+    assert expected == [True, False, True, False]
+    # text_parsed is scanned without an index
+    assert (
+        file_util.paragraphs_contain_words(words, corpus_file, index_path) == expected
+    )
+    index = paragraph_index.build_paragraph_index(corpus_file, index_path)
+    assert index.contains_words(words).tolist() == expected
+    assert index.count_words(words).tolist() == [3, 0, 1, 0]
+    assert (
+        file_util.paragraphs_contain_words(words, corpus_file, index_path) == expected
+    )
+    assert index.calls("demand") == {"b 2020-04-02": 2}
+    assert index.kwic("hurt", window=1) == [
+        {
+            "row": 2,
+            "call_title_date": "b 2020-04-02",
+            "left": "outbreak",
+            "keyword": "hurt",
+            "right": "demand",
+        }
+    ]
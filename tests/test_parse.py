@@ -0,0 +1,140 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+import global_options
+
+pytest.importorskip("stanfordnlp")
+from generate_word_list import parse
+
+
+def _raise_at_50(i):
+    if i == 50:
+        raise ValueError("bad line")
+    return i
+
+
+def _consume(results, errors):
+    try:
+        for result in parse.imap_streaming(
+            _raise_at_50, ((i,) for i in range(100000)), 10
+        ):
+            # a slow consumer: the window is full when the task raises
+            time.sleep(0.001)
+            results.append(result)
+    except Exception as e:
+        errors.append(e)
+
+
+def test_imap_streaming_raises_with_full_window(monkeypatch):
+    monkeypatch.setattr(global_options, "N_CORES", 2)
+    results, errors = [], []
+    consumer = threading.Thread(target=_consume, args=(results, errors), daemon=True)
+    consumer.start()
+    consumer.join(60)
+    assert not consumer.is_alive(), "imap_streaming hangs when a task raises"
+    assert len(errors) == 1 and isinstance(errors[0], ValueError)
+    assert results == list(range(50))
+
+
+def test_imap_streaming_early_stop(monkeypatch):
+    monkeypatch.setattr(global_options, "N_CORES", 2)
+    results = parse.imap_streaming(_raise_at_50, ((i,) for i in range(100000)), 10)
+    assert [next(results) for _ in range(20)] == list(range(20))
+    results.close()
+
+
+def test_imap_streaming_order(monkeypatch):
+    monkeypatch.setattr(global_options, "N_CORES", 2)
+    args = ((i,) for i in range(1000) if i != 50)
+    assert list(parse.imap_streaming(_raise_at_50, args, 7)) == [
+        i for i in range(1000) if i != 50
+    ]
+
+
+def _upper(line, line_id):
+    if line.startswith("fail"):
+        raise ValueError("bad line")
+    return line.rstrip("\n").upper(), line_id
+
+
+def test_process_largefile_resume(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(global_options, "N_CORES", 2)
+    input_file = tmp_path / "documents.txt"
+    lines = ["line {}".format(i) for i in range(20)]
+    # CRLF and CR line ends are read as by open() (universal newlines)
+    input_file.write_bytes(
+        "\r\n".join(lines[:8]).encode() + b"\r" + "\n".join(lines[8:]).encode()
+    )
+    ids = ["id{}".format(i) for i in range(20)]
+    expected_output = "".join("LINE {}\n".format(i) for i in range(20))
+    expected_ids = "".join(line_id + "\n" for line_id in ids)
+
+    output_file = tmp_path / "out.txt"
+    output_index_file = tmp_path / "out_ids.txt"
+    manifest_file = tmp_path / "manifest.json"
+    kwargs = dict(
+        input_file=input_file,
+        output_file=output_file,
+        input_file_ids=ids,
+        output_index_file=output_index_file,
+        chunk_size=3,
+        streaming=True,
+        manifest_file=manifest_file,
+    )
+    parse.process_largefile(function_name=_upper, **kwargs)
+    assert output_file.read_bytes() == expected_output.encode()
+    assert output_index_file.read_text() == expected_ids
+    # a finished run leaves no manifest, so a rerun on a new input with the same size and
+    # time starts over
+    assert not manifest_file.exists()
+    stat = os.stat(str(input_file))
+    input_file.write_bytes(input_file.read_bytes().replace(b"line", b"LINX"))
+    os.utime(str(input_file), ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    parse.process_largefile(function_name=_upper, **kwargs)
+    assert output_file.read_text() == expected_output.replace("LINE", "LINX")
+    input_file.write_bytes(input_file.read_bytes().replace(b"LINX", b"line"))
+
+    # a run that fails at line 10 commits the blocks before it, and the next run resumes
+    input_file.write_bytes(input_file.read_bytes().replace(b"line 10", b"fail 10"))
+    output_file.unlink()
+    output_index_file.unlink()
+    with pytest.raises(ValueError):
+        parse.process_largefile(function_name=_upper, **kwargs)
+    input_file.write_bytes(input_file.read_bytes().replace(b"fail 10", b"line 10"))
+    manifest = json.loads(manifest_file.read_text())
+    # the input changed: the manifest is matched against the new size and time
+    stat = os.stat(str(input_file))
+    manifest.update(input_size=stat.st_size, input_mtime_ns=stat.st_mtime_ns)
+    manifest_file.write_text(json.dumps(manifest))
+    capsys.readouterr()
+    parse.process_largefile(function_name=_upper, **kwargs)
+    out = capsys.readouterr().out
+    assert "Resuming from line 9." in out
+    assert "Processed 12 lines." in out
+    assert output_file.read_bytes() == expected_output.encode()
+    assert output_index_file.read_text() == expected_ids
+
+
+class _failing_preprocessor(object):
+    def process_document(self, doc, doc_id):
+        if doc.startswith("fail"):
+            raise ValueError("bad line")
+        return [doc.upper()], ["{}_0".format(doc_id)]
+
+    def process_documents(self, docs, doc_ids):
+        raise ValueError("bad batch")
+
+
+def test_process_lines_failed_line(monkeypatch):
+    monkeypatch.setattr(
+        parse, "corpus_preprocessor", _failing_preprocessor(), raising=False
+    )
+    assert parse.process_lines(["a b", "fail", "c"], ["id0", "id1", "id2"]) == [
+        ("A B", "id0_0"),
+        ("", ""),
+        ("C", "id2_0"),
+    ]
@@ -0,0 +1,150 @@
+import re
+
+import pytest
+
+pytest.importorskip("stanfordnlp")
+from stanfordnlp.protobuf import Document
+
+from generate_word_list.nlp_process import preprocess
+
+ENTITIES = {"ohio", "new", "york", "stanford"}
+COMPOUNDS = {"stock", "interest"}
+
+
+class _client(object):
+    """Annotates like CoreNLP with "ssplit.newlineIsSentenceBreak": "two": sentences end after
+    "." and at blank lines, offsets are for the whole request, entities are runs of ENTITIES and
+    a word of COMPOUNDS is a compound of the next word"""
+
+    def annotate(self, text):
+        doc_ann = Document(text=text)
+        words = list(re.finditer(r"\S+", text))
+        sentences, sentence = [], []
+        for i, word in enumerate(words):
+            sentence.append(word)
+            if (
+                word.group().endswith(".")
+                or i + 1 == len(words)
+                or "\n\n" in text[word.end() : words[i + 1].start()]
+            ):
+                sentences.append(sentence)
+                sentence = []
+        n_tokens, n_mentions = 0, 0
+        for sentence_i, sentence in enumerate(sentences):
+            sentence_ann = doc_ann.sentence.add(
+                sentenceIndex=sentence_i,
+                tokenOffsetBegin=n_tokens,
+                tokenOffsetEnd=n_tokens + len(sentence),
+                characterOffsetBegin=sentence[0].start(),
+                characterOffsetEnd=sentence[-1].end(),
+            )
+            for i, word in enumerate(sentence):
+                lemma = word.group().strip(".").lower()
+                token = sentence_ann.token.add(
+                    word=word.group(),
+                    lemma=lemma,
+                    pos="NNP" if lemma in ENTITIES else "NN",
+                    ner="LOCATION" if lemma in ENTITIES else "O",
+                    beginChar=word.start(),
+                    endChar=word.end(),
+                    tokenBeginIndex=n_tokens + i,
+                    tokenEndIndex=n_tokens + i + 1,
+                )
+                sentence_ann.enhancedPlusPlusDependencies.node.add(
+                    sentenceIndex=sentence_i, index=i + 1
+                )
+                if token.ner != "O":
+                    if i == 0 or sentence_ann.token[i - 1].ner == "O":
+                        sentence_ann.mentions.add(
+                            sentenceIndex=sentence_i,
+                            tokenStartInSentenceInclusive=i,
+                            entityType=token.ner,
+                            entityMentionIndex=n_mentions,
+                            canonicalEntityMentionIndex=n_mentions,
+                        )
+                        n_mentions += 1
+                    sentence_ann.mentions[-1].tokenEndInSentenceExclusive = i + 1
+                    token.entityMentionIndex = n_mentions - 1
+                if lemma in COMPOUNDS and i + 1 < len(sentence):
+                    sentence_ann.enhancedPlusPlusDependencies.edge.add(
+                        source=i + 2, target=i + 1, dep="compound"
+                    )
+            n_tokens += len(sentence)
+        return doc_ann
+
+
+class _archive(dict):
+    def put(self, doc, doc_ann):
+        self[doc] = doc_ann
+
+
+DOCS = [
+    "I went to Ohio and Stanford. Stock prices fell in New York.",
+    "New York has high interest rates. We left Ohio.",
+    "",
+    "Interest rates in New York. Stanford.",
+]
+
+
+def test_process_documents_equals_process_document():
+    packed = preprocess.preprocessor(_client()).process_documents(
+        DOCS, ["d{}".format(i) for i in range(len(DOCS))], max_chars=100
+    )
+    single = [
+        preprocess.preprocessor(_client()).process_document(doc, "d{}".format(i))
+        for i, doc in enumerate(DOCS)
+    ]
+    assert packed == single
+    # the first sentence of a paragraph after the first keeps its entity tag and joins
+    assert packed[1][0][0].startswith("[NER:LOCATION]new[pos:NNP]_york[pos:NNP] ")
+    assert "interest[pos:NN]_rates[pos:NN]" in packed[1][0][0]
+
+
+def test_packed_annotations_are_rebased():
+    archive = _archive()
+    preprocess.preprocessor(_client(), archive=archive).process_documents(
+        DOCS, ["d{}".format(i) for i in range(len(DOCS))]
+    )
+    for doc in DOCS:
+        assert archive[doc] == _client().annotate(doc)
+
+
+LINES = [
+    "[NER:PERCENT]16[pos:CD]_%[pos:NN] of [NER:ORGANIZATION]Apple[pos:NNP]_Inc.[pos:NNP] sales",
+    "[NER:MISC]covid-19[pos:NN] hit the [NER:ORDINAL]first[pos:JJ] quarter[pos:NN] .[pos:.]",
+    "-lrb- see[pos:VB] note[pos:NN] -rrb- 's a[pos:DT] b 2020 x2",
+    "  Leading[pos:VBG]  double  spaces and\ttabs[pos:NNS] ",
+    "[pos:NN] -lsb- [NER:DATE]2020[pos:CD]",
+    "",
+    " ",
+    "supply_chain[pos:NN] Disruption[pos:NN] [NER:LOCATION]New[pos:NNP]_York[pos:NNP]",
+]
+
+
+@pytest.mark.parametrize("lower_case", [False, True])
+def test_clean_equals_chained_filters(lower_case):
+    cleaner = preprocess.text_cleaner(lower_case=lower_case)
+    chained = [
+        cleaner.lower_case_transform(
+            cleaner.remove_puct_num(cleaner.remove_pos(cleaner.remove_NER(line)))
+        )
+        for line in LINES
+    ]
+    assert [cleaner.clean(line, "id")[0] for line in LINES] == chained
+    assert cleaner.clean_lines(LINES) == chained
+    assert chained[0] == cleaner.lower_case_transform(
+        "[NER:PERCENT] [NER:ORGANIZATION] sales"
+    )
+
+
+def test_return_lemmas_equals_regex_filters():
+    cleaner = preprocess.text_cleaner()
+    expected = [
+        " ".join(
+            re.sub(r"\[NER:.*?\]", "", re.sub(r"\[pos:.*?\]", "", t))
+            for t in line.strip().split(" ")
+        )
+        for line in LINES
+    ]
+    assert [cleaner.return_lemmas(line, "id")[0] for line in LINES] == expected
+    assert cleaner.return_lemmas_lines(LINES) == expected
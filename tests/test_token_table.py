@@ -0,0 +1,27 @@
+from generate_word_list.nlp_process import token_table
+
+
+def test_add_document_frequency_equals_concatenated_corpus(tmp_path):
+    corpus_file = tmp_path / "documents.txt"
+    corpus_file.write_text("a b_c a\nb_c d\n")
+    increment_file = tmp_path / "increments" / "documents_0001.txt"
+    increment_file.parent.mkdir()
+    increment_file.write_text("a e\ne e\n")
+    staged = tmp_path / "staging" / "documents.dfs"
+    staged.parent.mkdir()
+    token_table.add_document_frequency(corpus_file, increment_file, path=staged)
+    # the table in place is unchanged until the staged one replaces it
+    assert dict(token_table.load_document_frequency(corpus_file).items()) == {
+        "a": 1,
+        "b_c": 2,
+        "d": 1,
+    }
+    for staged_file in sorted(staged.parent.iterdir()):
+        staged_file.replace(tmp_path / staged_file.name)
+    expected = token_table.count_lines_document_frequency(
+        (corpus_file.read_text() + increment_file.read_text()).splitlines()
+    )
+    assert dict(token_table.load_document_frequency(corpus_file).items()) == expected
+    # an increment is counted once
+    token_table.add_document_frequency(corpus_file, increment_file)
+    assert dict(token_table.load_document_frequency(corpus_file).items()) == expected
@@ -0,0 +1,48 @@
+import os
+import time
+
+from pdf2text import worker_pool
+
+
+def _sleep(seconds):
+    if seconds < 0:
+        # the worker dies
+        os._exit(1)
+    time.sleep(seconds)
+    return seconds
+
+
+def test_slow_consumer_is_not_charged_to_tasks():
+    # the tasks take at most 0.5 s against a 1 s timeout, the consumer 1.5 s per result: the
+    # other worker finishes while the consumer holds a result
+    results = []
+    for args, result, error, seconds in worker_pool.imap_unordered_timeout(
+        _sleep, [0.05, 0.5, 0.2, 0.2], n_workers=2, timeout=1, chunksize=1
+    ):
+        time.sleep(1.5)
+        results.append((args, result, error))
+    assert sorted(results) == [
+        (0.05, 0.05, None),
+        (0.2, 0.2, None),
+        (0.2, 0.2, None),
+        (0.5, 0.5, None),
+    ]
+
+
+def test_timeout_and_crash():
+    results = sorted(
+        worker_pool.imap_unordered_timeout(
+            _sleep, [0.1, 30, -1, 0.1, 0.1], n_workers=2, timeout=1, chunksize=2
+        ),
+        key=lambda r: r[0],
+    )
+    assert [(args, result) for args, result, _, _ in results] == [
+        (-1, None),
+        (0.1, 0.1),
+        (0.1, 0.1),
+        (0.1, 0.1),
+        (30, None),
+    ]
+    assert results[0][2].startswith("worker exited")
+    assert results[-1][2] == "timeout after 1 seconds"
+    assert results[-1][3] < 5
@@ -0,0 +1,135 @@
+"""filter covid paragraphs using a two-step procedure (same as filter_covid_paragraph.R), streaming the corpus in chunks
+"""
+import csv
+import gzip
+import re
+from pathlib import Path
+
+import global_options
+import pandas as pd
+
+ORIGINAL_LIST = ["covid-19"]  # seed word
+
+# words of the raw text, approximating tidytext::unnest_tokens(word, text) (Unicode word
+# boundaries, lower case): letters, digits and "_", joined by ' . : between letters and by
+# ' . , ; between digits
+WORD_PATTERN = re.compile(
+    r"\w+(?:(?:(?<=[^\W\d_])[.:'’·](?=[^\W\d_])|(?<=\d)[.,;'’](?=\d))\w+)*"
+)
+
+
+def read_keywords(word_list_file):
+    """Read the covid-related keywords
+
+    Arguments:
+        word_list_file {str or Path} -- the filtered word list (column word)
+
+    Returns:
+        (set(str), set(str)) -- keywords, and keywords that are single words (without "_"), both with the seed word
+    """
+    words = set(
+        pd.read_csv(word_list_file, dtype=str, keep_default_na=False)["word"]
+    ) | set(ORIGINAL_LIST)
+    return words, {w for w in words if "_" not in w} | set(ORIGINAL_LIST)
+
+
+def count_hits(tokens, words_set):
+    """Number of tokens in words_set of each document
+
+    Arguments:
+        tokens {pd.Series} -- list of tokens of each document
+        words_set {set(str)} -- keywords
+
+    Returns:
+        pd.Series -- number of keyword occurrences of each document (0 if none)
+    """
+    exploded = tokens.explode()
+    return (
+        exploded.isin(words_set)
+        .groupby(level=0)
+        .sum()
+        .reindex(tokens.index, fill_value=0)
+        .astype(int)
+    )
+
+
+def expanded_counts(transcripts, words, single_words):
+    """Count the keyword hits of each paragraph in text_parsed. Keywords are sometimes missed in
+    the parsed text because they are part of named entities, so paragraphs without hits in
+    text_parsed are counted on the words of the raw text (single-word keywords only).
+
+    Arguments:
+        transcripts {pd.DataFrame} -- paragraphs with columns text and text_parsed
+        words {set(str)} -- keywords
+        single_words {set(str)} -- keywords without "_"
+
+    Returns:
+        pd.Series -- number of keyword matches of each paragraph
+    """
+    parsed_n = count_hits(
+        transcripts["text_parsed"].fillna("").str.lower().str.split(" "), words
+    )
+    raw_n = count_hits(
+        transcripts["text"].fillna("").str.lower().str.findall(WORD_PATTERN),
+        single_words,
+    )
+    return parsed_n.where(parsed_n > 0, raw_n)
+
+
+def filter_covid_paragraphs(in_file, word_list_file, out_file, chunk_size=100000):
+    """Keep the paragraphs with covid-related keywords, reading in_file in chunks
+
+    The output has the columns of in_file, the row number of the paragraph in in_file (id,
+    starting from 1), and its number of keyword matches (expanded_n, see expanded_counts).
+
+    Arguments:
+        in_file {str or Path} -- consolidated paragraphs (output of generate_word_list.word_list)
+        word_list_file {str or Path} -- the filtered word list
+        out_file {str or Path} -- gzipped csv of the covid-related paragraphs
+
+    Keyword Arguments:
+        chunk_size {int} -- number of paragraphs read at a time (default: {100000})
+
+    Returns:
+        int -- number of covid-related paragraphs
+    """
+    words, single_words = read_keywords(word_list_file)
+    n_related = 0
+    with gzip.open(out_file, "wt", newline="") as f:
+        header = True
+        first_id = 1
+        # read as str, so the values are written back as they are (trimmed, as readr does)
+        for transcripts in pd.read_csv(
+            in_file, dtype=str, keep_default_na=False, chunksize=chunk_size
+        ):
+            transcripts = transcripts.apply(lambda column: column.str.strip(" \t"))
+            transcripts["id"] = range(first_id, first_id + len(transcripts))
+            first_id += len(transcripts)
+            transcripts["expanded_n"] = expanded_counts(
+                transcripts, words, single_words
+            )
+            related = transcripts[transcripts["expanded_n"] > 0]
+            related.to_csv(
+                f,
+                header=header,
+                index=False,
+                quoting=csv.QUOTE_MINIMAL,
+            )
+            header = False
+            n_related += len(related)
+    return n_related
+
+
+if __name__ == "__main__":
+    n_related = filter_covid_paragraphs(
+        in_file=Path(
+            global_options.DATA_PATH, "text_corpra", "all_transcripts_parsed.csv.gz"
+        ),
+        word_list_file=Path(global_options.DATA_PATH, "word_list_filtered.csv"),
+        out_file=Path(
+            global_options.DATA_PATH,
+            "text_corpra",
+            "all_transcripts_covid_related.csv.gz",
+        ),
+    )
+    print(f"{n_related} covid-related paragraphs.")